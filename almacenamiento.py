@@ -0,0 +1,1456 @@
+# --- ALMACENAMIENTO DE CITAS ---
+# Interfaz común (RepositorioCitas) con dos implementaciones:
+#   * RepositorioSQLite: la de producción, sobre meetmanager.db.
+#   * RepositorioMemoria: estructuras ordenadas por usuario, sin disco (pruebas y benchmarks).
+# Las filas de citas siempre son tuplas (id, fecha, hora, duracion, asunto), ordenadas por fecha y hora.
+import asyncio
+import bisect
+import contextvars
+import heapq
+import logging
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from abc import ABC, abstractmethod
+from contextlib import contextmanager, nullcontext
+from datetime import datetime, timedelta
+from functools import lru_cache
+
+logger = logging.getLogger(__name__)
+
+# Duración de las citas en minutos
+DURACION_POR_DEFECTO = 60
+DURACION_MAXIMA = 24 * 60
+# Longitud máxima del asunto de una cita
+ASUNTO_MAXIMO = 100
+
+
+def ventana_solapamiento(fecha, hora, duracion):
+    # Una cita [inicio, fin) choca con otra si esta empieza antes de 'fin' y termina después de 'inicio'.
+    # Como ninguna cita dura más de DURACION_MAXIMA, solo hace falta mirar las que empiezan en
+    # [inicio - DURACION_MAXIMA, fin): es un rango acotado, no un recorrido de toda la agenda.
+    inicio = datetime.strptime(f"{fecha} {hora}", "%Y-%m-%d %H:%M")
+    fin = inicio + timedelta(minutes=duracion)
+    desde = inicio - timedelta(minutes=DURACION_MAXIMA)
+    return inicio, fin, desde
+
+
+# --- Recurrencias ---
+# Una regla es la tupla (id, fecha_inicio, hora, duracion, asunto, frecuencia, intervalo, hasta,
+# repeticiones, excepciones), con 'excepciones' como tupla de fechas. Las ocurrencias no se guardan:
+# se calculan para la ventana que se consulta y tienen como ID "R<id de la regla>".
+FRECUENCIAS = ("diaria", "semanal", "mensual")
+PREFIJO_RECURRENCIA = "R"
+
+
+@lru_cache(maxsize=2048)
+def expandir_regla(regla, fecha_ini, fecha_fin):
+    # La clave de la caché es la regla entera: si cambia (nueva excepción...), es otra entrada
+    id_regla, inicio, hora, duracion, asunto, frecuencia, intervalo, hasta, repeticiones, excepciones = regla
+    inicio = datetime.strptime(inicio, "%Y-%m-%d").date()
+    ini = datetime.strptime(fecha_ini, "%Y-%m-%d").date()
+    fin = datetime.strptime(fecha_fin, "%Y-%m-%d").date()
+    if hasta:
+        fin = min(fin, datetime.strptime(hasta, "%Y-%m-%d").date())
+    if fin < inicio:
+        return ()
+
+    fechas = []
+    if frecuencia == "mensual":
+        # Mismo día de cada mes; los meses que no lo tienen (un 31 en abril) se saltan sin contar
+        anio, mes, contadas = inicio.year, inicio.month, 0
+        while (anio, mes) <= (fin.year, fin.month) and (not repeticiones or contadas < repeticiones):
+            try:
+                dia = inicio.replace(year=anio, month=mes)
+            except ValueError:
+                dia = None
+            if dia and dia > fin:
+                break
+            if dia:
+                contadas += 1
+                if dia >= ini:
+                    fechas.append(dia)
+            anio, mes = anio + (mes - 1 + intervalo) // 12, (mes - 1 + intervalo) % 12 + 1
+    else:
+        # Diaria o semanal: saltamos directamente a la primera ocurrencia de la ventana
+        paso = intervalo * (7 if frecuencia == "semanal" else 1)
+        primera = max(0, -(-(ini - inicio).days // paso))
+        ultima = (fin - inicio).days // paso
+        if repeticiones:
+            ultima = min(ultima, repeticiones - 1)
+        fechas = [inicio + timedelta(days=k * paso) for k in range(primera, ultima + 1)]
+
+    # Como en iCalendar, las excepciones quitan ocurrencias pero siguen contando para 'repeticiones'
+    excluidas = set(excepciones)
+    return tuple(
+        (f"{PREFIJO_RECURRENCIA}{id_regla}", dia.strftime("%Y-%m-%d"), hora, duracion, asunto)
+        for dia in fechas if dia.strftime("%Y-%m-%d") not in excluidas
+    )
+
+
+def construir_consulta_fts(texto):
+    # Cada palabra se busca como prefijo ("acm" encuentra "Acme") y todas deben aparecer
+    palabras = re.findall(r"\w+", texto)
+    return " ".join(f'"{palabra}"*' for palabra in palabras)
+
+
+class RepositorioCitas(ABC):
+    # Todas las operaciones de almacenamiento que usan los handlers pasan por aquí.
+
+    # Si respaldar() sabe hacer copias de seguridad en caliente
+    admite_copias = False
+
+    def __init__(self):
+        self._oyentes = []
+        # Estado del lote en curso; es por hilo, así las lecturas de otros hilos no lo ven
+        self._local = threading.local()
+
+    def al_cambiar(self, funcion):
+        # Registra funcion(user_id), que se llama después de cada escritura que afecta a ese usuario
+        # (por ejemplo, para invalidar cachés)
+        self._oyentes.append(funcion)
+
+    def _notificar(self, user_id):
+        pendientes = getattr(self._local, "pendientes", None)
+        if pendientes is not None:
+            # Dentro de un lote avisamos después del commit: si no, alguien podría volver a
+            # llenar la caché con datos que todavía no están confirmados
+            pendientes.add(user_id)
+            return
+        for funcion in self._oyentes:
+            funcion(user_id)
+
+    @contextmanager
+    def lote(self):
+        # Todas las escrituras hechas dentro del bloque (en este hilo) van en una sola transacción.
+        # Si una falla, solo se deshace esa; las demás se confirman juntas al salir.
+        self._local.pendientes = set()
+        try:
+            with self._abrir_lote():
+                yield
+        finally:
+            pendientes, self._local.pendientes = self._local.pendientes, None
+            for user_id in pendientes:
+                self._notificar(user_id)
+
+    def _abrir_lote(self):
+        return nullcontext()
+
+    @abstractmethod
+    def inicializar(self):
+        pass
+
+    # --- Citas ---
+    @abstractmethod
+    def crear(self, user_id, fecha, hora, asunto, duracion=DURACION_POR_DEFECTO):
+        # False si ya existe una cita del usuario exactamente en esa fecha y hora
+        pass
+
+    @abstractmethod
+    def crear_varios(self, user_id, eventos):
+        # 'eventos' es un iterable de (fecha, hora, duracion, asunto) que se consume poco a poco.
+        # Omite las que ya existen en esa fecha y hora. Devuelve cuántas se insertaron.
+        pass
+
+    @abstractmethod
+    def rango(self, user_id, fecha_ini=None, fecha_fin=None):
+        # Sin fechas devuelve toda la agenda del usuario
+        pass
+
+    @abstractmethod
+    def iterar(self, user_id, fecha_ini=None, fecha_fin=None):
+        # Como rango(), pero fila a fila: la memoria no crece con el tamaño de la agenda
+        pass
+
+    @abstractmethod
+    def solapamientos(self, user_id, fecha, hora, duracion, excluir_id=None):
+        pass
+
+    @abstractmethod
+    def citas_que_empiezan(self, desde, hasta):
+        # Citas de todos los usuarios que empiezan en [desde, hasta) (datetimes), ordenadas por inicio,
+        # como filas (user_id, id, fecha, hora, duracion, asunto)
+        pass
+
+    @abstractmethod
+    def actualizar_asunto(self, user_id, id_cita, asunto):
+        # Solo cambia la cita si es de 'user_id'. Devuelve si la encontró
+        pass
+
+    @abstractmethod
+    def reprogramar(self, user_id, id_cita, fecha, hora, duracion=None):
+        # 'id_cita' es un entero. Solo mueve la cita si es de 'user_id'. Devuelve (estado, conflictos) con estado "exito", "no_encontrado" o "solapamiento"
+        pass
+
+    @abstractmethod
+    def eliminar_fecha(self, user_id, fecha):
+        # Devuelve cuántas citas se borraron
+        pass
+
+    @abstractmethod
+    def eliminar_todo(self, user_id):
+        pass
+
+    @abstractmethod
+    def buscar(self, user_id, texto, limite, desplazamiento=0):
+        pass
+
+    # --- Operaciones masivas ---
+    # Todas filtran las citas del usuario por rango de fechas (sin fechas: toda la agenda) y,
+    # opcionalmente, por texto del asunto con las mismas reglas que buscar().
+    @abstractmethod
+    def contar(self, user_id, fecha_ini=None, fecha_fin=None, texto=None):
+        pass
+
+    @abstractmethod
+    def eliminar_rango(self, user_id, fecha_ini=None, fecha_fin=None, texto=None):
+        # Devuelve cuántas citas se borraron
+        pass
+
+    @abstractmethod
+    def desplazar(self, user_id, dias, fecha_ini=None, fecha_fin=None, texto=None):
+        # Mueve las citas 'dias' días (puede ser negativo). Devuelve (movidas, conflictos):
+        # si alguna chocaría con una cita que no se mueve, no se mueve ninguna.
+        pass
+
+    @abstractmethod
+    def renombrar(self, user_id, viejo, nuevo, fecha_ini=None, fecha_fin=None):
+        # Sustituye 'viejo' por 'nuevo' en el asunto (distingue mayúsculas). Las citas cuyo asunto pasaría
+        # de ASUNTO_MAXIMO caracteres se dejan como están. Devuelve (cambiadas, omitidas).
+        pass
+
+    @abstractmethod
+    def contar_renombrar(self, user_id, viejo, nuevo, fecha_ini=None, fecha_fin=None):
+        # Lo que haría renombrar() con el mismo filtro, sin cambiar nada: (cambiarían, se omitirían)
+        pass
+
+    # --- Recurrencias ---
+    @abstractmethod
+    def crear_recurrencia(self, user_id, fecha, hora, duracion, asunto, frecuencia, intervalo=1, hasta=None, repeticiones=None):
+        # Devuelve el ID de la regla
+        pass
+
+    @abstractmethod
+    def recurrencias(self, user_id):
+        # Reglas del usuario, como tuplas (ver expandir_regla)
+        pass
+
+    @abstractmethod
+    def agregar_excepcion(self, user_id, id_regla, fecha):
+        pass
+
+    @abstractmethod
+    def eliminar_recurrencia(self, user_id, id_regla):
+        pass
+
+    @abstractmethod
+    def recurrencias_vigentes(self, fecha):
+        # (user_id, regla) de todas las reglas que no terminan antes de 'fecha'
+        pass
+
+    def ocurrencias(self, user_id, fecha_ini, fecha_fin):
+        filas = []
+        for regla in self.recurrencias(user_id):
+            filas.extend(expandir_regla(regla, fecha_ini, fecha_fin))
+        filas.sort(key=lambda fila: (fila[1], fila[2]))
+        return filas
+
+    def agenda(self, user_id, fecha_ini, fecha_fin):
+        # Citas sueltas y ocurrencias de las reglas, juntas y ordenadas por fecha y hora
+        return list(heapq.merge(
+            self.rango(user_id, fecha_ini, fecha_fin), self.ocurrencias(user_id, fecha_ini, fecha_fin),
+            key=lambda fila: (fila[1], fila[2])
+        ))
+
+    def solapamientos_recurrentes(self, user_id, fecha, hora, duracion, excluir_regla=None):
+        inicio, fin, desde = ventana_solapamiento(fecha, hora, duracion)
+        conflictos = []
+        for fila in self.ocurrencias(user_id, desde.strftime("%Y-%m-%d"), fin.strftime("%Y-%m-%d")):
+            if fila[0] == excluir_regla:
+                continue
+            inicio_o = datetime.strptime(f"{fila[1]} {fila[2]}", "%Y-%m-%d %H:%M")
+            if inicio_o < fin and inicio_o + timedelta(minutes=fila[3]) > inicio:
+                conflictos.append(fila)
+        return conflictos
+
+    def _choques_recurrentes(self, user_id, horarios):
+        # Ocurrencias que chocan con alguno de los horarios (fecha, hora, duracion) dados
+        if not horarios or not self.recurrencias(user_id):
+            return []
+        conflictos = {}
+        for fecha, hora, duracion in horarios:
+            for fila in self.solapamientos_recurrentes(user_id, fecha, hora, duracion):
+                conflictos[fila[:2]] = fila
+        return sorted(conflictos.values(), key=lambda fila: (fila[1], fila[2]))
+
+    # --- Archivo ---
+    @abstractmethod
+    def archivar(self, antes_de, lote=500, pausa=0.05):
+        # Mueve al archivo las citas con fecha anterior a 'antes_de'. Devuelve cuántas se movieron.
+        pass
+
+    @abstractmethod
+    def historial(self, user_id, fecha_ini, fecha_fin):
+        pass
+
+    # --- Usuarios ---
+    @abstractmethod
+    def registrar_usuario(self, user_id, username):
+        pass
+
+    @abstractmethod
+    def buscar_usuarios(self, usernames):
+        # Devuelve {username: user_id} de los que se conocen
+        pass
+
+    # Permisos de /coordinar: nadie ve los huecos de otro usuario si este no se lo ha permitido
+    @abstractmethod
+    def permitir_coordinacion(self, user_id, autorizado_id, permitir=True):
+        # 'autorizado_id' podrá (o dejará de poder) cruzar su agenda con la de 'user_id'.
+        # Devuelve si ha cambiado algo
+        pass
+
+    @abstractmethod
+    def permisos_coordinacion(self, user_id):
+        # Usernames de las personas a las que 'user_id' ha dado permiso, ordenados
+        pass
+
+    @abstractmethod
+    def autorizan_coordinacion(self, autorizado_id, user_ids):
+        # Conjunto de los 'user_ids' que han dado permiso a 'autorizado_id'
+        pass
+
+    # --- Resumen diario ---
+    @abstractmethod
+    def suscribir_resumen(self, user_id, hora):
+        # hora "HH:MM", o None para darse de baja
+        pass
+
+    @abstractmethod
+    def suscripcion_resumen(self, user_id):
+        pass
+
+    @abstractmethod
+    def resumen_del_dia(self, hora, fecha):
+        # {user_id: citas y ocurrencias de 'fecha'} de todos los suscritos a esa hora, aunque no tengan nada
+        pass
+
+    def _agregar_ocurrencias(self, resumen, reglas, fecha):
+        for user_id, regla in reglas:
+            resumen[user_id].extend(expandir_regla(regla, fecha, fecha))
+        for filas in resumen.values():
+            filas.sort(key=lambda fila: fila[2])
+        return resumen
+
+    # --- Copias de seguridad ---
+    def respaldar(self, destino, paginas=256, pausa=0.01):
+        raise NotImplementedError("Este almacenamiento no admite copias de seguridad")
+
+
+class CopiaReiniciada(Exception):
+    pass
+
+
+class RepositorioSQLite(RepositorioCitas):
+
+    admite_copias = True
+    # Veces que dejamos que la copia por pasos vuelva a empezar antes de terminarla de una vez
+    REINICIOS_COPIA_MAX = 3
+
+    def __init__(self, ruta="meetmanager.db"):
+        super().__init__()
+        self.ruta = ruta
+        # Se desactiva en inicializar() si el SQLite instalado no trae FTS5
+        self.fts_disponible = True
+
+    @contextmanager
+    def _conexion(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            # Dentro de un lote: cada operación es un SAVEPOINT de la transacción compartida
+            conn.execute("SAVEPOINT operacion")
+            try:
+                yield conn
+            except BaseException:
+                conn.execute("ROLLBACK TO operacion")
+                conn.execute("RELEASE operacion")
+                raise
+            else:
+                conn.execute("RELEASE operacion")
+            return
+
+        # Una conexión por operación: commit si todo fue bien, rollback (al cerrar) si hubo excepción
+        conn = sqlite3.connect(self.ruta)
+        try:
+            yield conn
+            conn.commit()
+        finally:
+            conn.close()
+
+    @contextmanager
+    def _abrir_lote(self):
+        # Transacción manual (isolation_level=None) para que los SAVEPOINT no hagan commit por su cuenta
+        conn = sqlite3.connect(self.ruta, isolation_level=None)
+        conn.execute("BEGIN IMMEDIATE")
+        self._local.conn = conn
+        try:
+            yield
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        finally:
+            self._local.conn = None
+            conn.close()
+
+    def inicializar(self):
+        conn = sqlite3.connect(self.ruta)
+        c = conn.cursor()
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS citas (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER,
+                fecha TEXT,
+                hora TEXT,
+                asunto TEXT,
+                duracion INTEGER DEFAULT 60
+            )
+        ''')
+        # Migración: las bases de datos antiguas no tienen la columna de duración
+        columnas = [fila[1] for fila in c.execute("PRAGMA table_info(citas)")]
+        if "duracion" not in columnas:
+            c.execute(f"ALTER TABLE citas ADD COLUMN duracion INTEGER DEFAULT {DURACION_POR_DEFECTO}")
+        # Índice para las consultas por rango de fechas (/agenda hoy, semana, mes...)
+        # y para la detección de solapamientos
+        c.execute("CREATE INDEX IF NOT EXISTS idx_citas_usuario_fecha ON citas (user_id, fecha, hora)")
+        # Usuarios que han hablado con el bot, para poder buscarlos por @username en /coordinar
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS usuarios (
+                user_id INTEGER PRIMARY KEY,
+                username TEXT
+            )
+        ''')
+        c.execute("CREATE INDEX IF NOT EXISTS idx_usuarios_username ON usuarios (username)")
+        # Quién puede ver los huecos de quién en /coordinar
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS permisos_coordinacion (
+                user_id INTEGER,
+                autorizado_id INTEGER,
+                PRIMARY KEY (user_id, autorizado_id)
+            )
+        ''')
+
+        # Índice de texto completo sobre el asunto, sincronizado con 'citas' mediante triggers.
+        # remove_diacritics hace que "reunion" encuentre "Reunión".
+        try:
+            existia = c.execute("SELECT 1 FROM sqlite_master WHERE name='citas_fts'").fetchone()
+            c.execute(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS citas_fts USING fts5("
+                "asunto, content='citas', content_rowid='id', tokenize='unicode61 remove_diacritics 2')"
+            )
+            c.executescript('''
+                CREATE TRIGGER IF NOT EXISTS citas_fts_insertar AFTER INSERT ON citas BEGIN
+                    INSERT INTO citas_fts (rowid, asunto) VALUES (new.id, new.asunto);
+                END;
+                CREATE TRIGGER IF NOT EXISTS citas_fts_borrar AFTER DELETE ON citas BEGIN
+                    INSERT INTO citas_fts (citas_fts, rowid, asunto) VALUES ('delete', old.id, old.asunto);
+                END;
+                CREATE TRIGGER IF NOT EXISTS citas_fts_actualizar AFTER UPDATE OF asunto ON citas BEGIN
+                    INSERT INTO citas_fts (citas_fts, rowid, asunto) VALUES ('delete', old.id, old.asunto);
+                    INSERT INTO citas_fts (rowid, asunto) VALUES (new.id, new.asunto);
+                END;
+            ''')
+            if not existia:
+                # Primera vez: indexamos las citas que ya había
+                c.execute("INSERT INTO citas_fts (citas_fts) VALUES ('rebuild')")
+        except sqlite3.OperationalError as e:
+            self.fts_disponible = False
+            logger.warning(f"SQLite sin FTS5 ({e}). /buscar usará LIKE.")
+
+        # Índice por fecha para encontrar rápido las citas pasadas al archivar
+        c.execute("CREATE INDEX IF NOT EXISTS idx_citas_fecha ON citas (fecha, hora)")
+        # Tabla de archivo: las citas pasadas se mueven aquí para que 'citas' no crezca sin fin
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS citas_archivo (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                cita_id INTEGER,
+                user_id INTEGER,
+                fecha TEXT,
+                hora TEXT,
+                asunto TEXT,
+                duracion INTEGER,
+                archivada_en TEXT
+            )
+        ''')
+        c.execute("CREATE INDEX IF NOT EXISTS idx_archivo_usuario_fecha ON citas_archivo (user_id, fecha, hora)")
+        # Reglas de citas recurrentes: se guardan una vez y se expanden al consultar
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS recurrencias (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER,
+                fecha_inicio TEXT,
+                hora TEXT,
+                duracion INTEGER,
+                asunto TEXT,
+                frecuencia TEXT,
+                intervalo INTEGER DEFAULT 1,
+                hasta TEXT,
+                repeticiones INTEGER,
+                excepciones TEXT DEFAULT ''
+            )
+        ''')
+        c.execute("CREATE INDEX IF NOT EXISTS idx_recurrencias_usuario ON recurrencias (user_id)")
+        # Suscripciones al resumen diario, agrupadas por la hora de envío
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS suscripciones_resumen (
+                user_id INTEGER PRIMARY KEY,
+                hora TEXT
+            )
+        ''')
+        c.execute("CREATE INDEX IF NOT EXISTS idx_resumen_hora ON suscripciones_resumen (hora)")
+
+        conn.commit()
+
+        # Con auto_vacuum=INCREMENTAL podemos devolver espacio al disco poco a poco en lugar de
+        # hacer un VACUUM completo (que bloquea la base de datos). Cambiarlo exige un VACUUM, una sola vez.
+        if c.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            logger.info(f"Activando auto_vacuum incremental en {self.ruta} (solo la primera vez)...")
+            c.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            c.execute("VACUUM")
+        # WAL: las lecturas no esperan al escritor y cada commit es una escritura secuencial al final del log
+        c.execute("PRAGMA journal_mode = WAL")
+        conn.close()
+
+    # --- Citas ---
+    def crear(self, user_id, fecha, hora, asunto, duracion=DURACION_POR_DEFECTO):
+        with self._conexion() as conn:
+            c = conn.cursor()
+            # Verifica si ya existe para no duplicar al crear
+            c.execute("SELECT 1 FROM citas WHERE user_id=? AND fecha=? AND hora=?", (user_id, fecha, hora))
+            if c.fetchone():
+                return False
+            c.execute(
+                "INSERT INTO citas (user_id, fecha, hora, asunto, duracion) VALUES (?, ?, ?, ?, ?)",
+                (user_id, fecha, hora, asunto, duracion)
+            )
+        self._notificar(user_id)
+        return True
+
+    def crear_varios(self, user_id, eventos):
+        with self._conexion() as conn:
+            # executemany consume el generador poco a poco. Solo insertamos si no existe ya una cita
+            # del usuario en esa fecha y hora (las filas insertadas antes en esta misma transacción
+            # también cuentan como duplicadas). Todo va en una única transacción.
+            c = conn.executemany(
+                "INSERT INTO citas (user_id, fecha, hora, duracion, asunto) "
+                "SELECT ?, ?, ?, ?, ? WHERE NOT EXISTS (SELECT 1 FROM citas WHERE user_id=? AND fecha=? AND hora=?)",
+                ((user_id, fecha, hora, duracion, asunto, user_id, fecha, hora) for fecha, hora, duracion, asunto in eventos)
+            )
+            # rowcount suma las filas de cada ejecución sin contar las que añaden los triggers del FTS
+            insertadas = c.rowcount
+        self._notificar(user_id)
+        return insertadas
+
+    def rango(self, user_id, fecha_ini=None, fecha_fin=None):
+        return list(self.iterar(user_id, fecha_ini, fecha_fin))
+
+    def iterar(self, user_id, fecha_ini=None, fecha_fin=None):
+        # Recorremos el cursor fila a fila en lugar de usar fetchall()
+        conn = sqlite3.connect(self.ruta)
+        try:
+            c = conn.cursor()
+            if fecha_ini:
+                # Una sola consulta por rango que aprovecha el índice (user_id, fecha, hora)
+                c.execute(
+                    "SELECT id, fecha, hora, duracion, asunto FROM citas "
+                    "WHERE user_id=? AND fecha BETWEEN ? AND ? ORDER BY fecha, hora",
+                    (user_id, fecha_ini, fecha_fin)
+                )
+            else:
+                c.execute("SELECT id, fecha, hora, duracion, asunto FROM citas WHERE user_id=? ORDER BY fecha, hora", (user_id,))
+            for fila in c:
+                yield fila
+        finally:
+            conn.close()
+
+    def _solapamientos(self, c, user_id, fecha, hora, duracion, excluir_id=None):
+        inicio, fin, desde = ventana_solapamiento(fecha, hora, duracion)
+        c.execute(
+            "SELECT id, fecha, hora, duracion, asunto FROM citas "
+            "WHERE user_id=? AND (fecha, hora) >= (?, ?) AND (fecha, hora) < (?, ?) "
+            "AND datetime(fecha || ' ' || hora, '+' || duracion || ' minutes') > ? AND id IS NOT ? "
+            "ORDER BY fecha, hora",
+            (
+                user_id,
+                desde.strftime("%Y-%m-%d"), desde.strftime("%H:%M"),
+                fin.strftime("%Y-%m-%d"), fin.strftime("%H:%M"),
+                inicio.strftime("%Y-%m-%d %H:%M:%S"), excluir_id
+            )
+        )
+        return c.fetchall()
+
+    def solapamientos(self, user_id, fecha, hora, duracion, excluir_id=None):
+        with self._conexion() as conn:
+            return self._solapamientos(conn.cursor(), user_id, fecha, hora, duracion, excluir_id)
+
+    def citas_que_empiezan(self, desde, hasta):
+        # Rango sobre el índice (fecha, hora): no se recorre la tabla entera
+        with self._conexion() as conn:
+            return conn.execute(
+                "SELECT user_id, id, fecha, hora, duracion, asunto FROM citas "
+                "WHERE (fecha, hora) >= (?, ?) AND (fecha, hora) < (?, ?) ORDER BY fecha, hora",
+                (desde.strftime("%Y-%m-%d"), desde.strftime("%H:%M"), hasta.strftime("%Y-%m-%d"), hasta.strftime("%H:%M"))
+            ).fetchall()
+
+    def actualizar_asunto(self, user_id, id_cita, asunto):
+        with self._conexion() as conn:
+            c = conn.cursor()
+            c.execute("UPDATE citas SET asunto=? WHERE id=? AND user_id=?", (asunto, id_cita, user_id))
+            cambiadas = c.rowcount
+        if not cambiadas:
+            return False
+        self._notificar(user_id)
+        return True
+
+    def reprogramar(self, user_id, id_cita, fecha, hora, duracion=None):
+        with self._conexion() as conn:
+            c = conn.cursor()
+            c.execute("SELECT duracion FROM citas WHERE id=? AND user_id=?", (id_cita, user_id))
+            fila = c.fetchone()
+            if not fila:
+                return "no_encontrado", []
+
+            duracion_actual = fila[0]
+            duracion = duracion or duracion_actual or DURACION_POR_DEFECTO
+            # Comprobamos solapamientos con el resto de citas del usuario (excepto ella misma)
+            conflictos = self._solapamientos(c, user_id, fecha, hora, duracion, excluir_id=id_cita)
+            conflictos += self.solapamientos_recurrentes(user_id, fecha, hora, duracion)
+            if conflictos:
+                return "solapamiento", conflictos
+
+            # UPDATE sobrescribe fecha y hora en el registro existente.
+            c.execute("UPDATE citas SET fecha=?, hora=?, duracion=? WHERE id=? AND user_id=?", (fecha, hora, duracion, id_cita, user_id))
+        self._notificar(user_id)
+        return "exito", []
+
+    def eliminar_fecha(self, user_id, fecha):
+        with self._conexion() as conn:
+            c = conn.cursor()
+            c.execute("DELETE FROM citas WHERE user_id=? AND fecha=?", (user_id, fecha))
+            borrados = c.rowcount
+        self._notificar(user_id)
+        return borrados
+
+    def eliminar_todo(self, user_id):
+        with self._conexion() as conn:
+            c = conn.cursor()
+            c.execute("DELETE FROM citas WHERE user_id=?", (user_id,))
+            c.execute("DELETE FROM recurrencias WHERE user_id=?", (user_id,))
+            # Si la tabla queda completamente vacía (sin datos de nadie),
+            # borramos la memoria del contador para que los IDs empiecen en 1
+            c.execute("SELECT COUNT(*) FROM citas")
+            if c.fetchone()[0] == 0:
+                c.execute("DELETE FROM sqlite_sequence WHERE name='citas'")
+        self._notificar(user_id)
+
+    def buscar(self, user_id, texto, limite, desplazamiento=0):
+        consulta = construir_consulta_fts(texto)
+        if not consulta:
+            return []
+        with self._conexion() as conn:
+            c = conn.cursor()
+            if self.fts_disponible:
+                # Ordenado por relevancia (bm25) y después por fecha
+                c.execute(
+                    "SELECT c.id, c.fecha, c.hora, c.duracion, c.asunto FROM citas_fts f JOIN citas c ON c.id = f.rowid "
+                    "WHERE citas_fts MATCH ? AND c.user_id=? ORDER BY f.rank, c.fecha, c.hora LIMIT ? OFFSET ?",
+                    (consulta, user_id, limite, desplazamiento)
+                )
+            else:
+                c.execute(
+                    "SELECT id, fecha, hora, duracion, asunto FROM citas WHERE user_id=? AND asunto LIKE ? "
+                    "ORDER BY fecha, hora LIMIT ? OFFSET ?",
+                    (user_id, f"%{texto.strip()}%", limite, desplazamiento)
+                )
+            return c.fetchall()
+
+    # --- Operaciones masivas ---
+    def _filtro(self, user_id, fecha_ini, fecha_fin, texto):
+        condiciones, parametros = ["user_id=?"], [user_id]
+        if fecha_ini:
+            condiciones.append("fecha BETWEEN ? AND ?")
+            parametros += [fecha_ini, fecha_fin]
+        if texto:
+            if self.fts_disponible:
+                condiciones.append("id IN (SELECT rowid FROM citas_fts WHERE citas_fts MATCH ?)")
+                parametros.append(construir_consulta_fts(texto))
+            else:
+                condiciones.append("asunto LIKE ?")
+                parametros.append(f"%{texto.strip()}%")
+        return " AND ".join(condiciones), parametros
+
+    def contar(self, user_id, fecha_ini=None, fecha_fin=None, texto=None):
+        filtro, parametros = self._filtro(user_id, fecha_ini, fecha_fin, texto)
+        with self._conexion() as conn:
+            return conn.execute(f"SELECT COUNT(*) FROM citas WHERE {filtro}", parametros).fetchone()[0]
+
+    def eliminar_rango(self, user_id, fecha_ini=None, fecha_fin=None, texto=None):
+        filtro, parametros = self._filtro(user_id, fecha_ini, fecha_fin, texto)
+        with self._conexion() as conn:
+            borrados = conn.execute(f"DELETE FROM citas WHERE {filtro}", parametros).rowcount
+        self._notificar(user_id)
+        return borrados
+
+    def desplazar(self, user_id, dias, fecha_ini=None, fecha_fin=None, texto=None):
+        filtro, parametros = self._filtro(user_id, fecha_ini, fecha_fin, texto)
+        dias = f"{int(dias):+d} days"
+        with self._conexion() as conn:
+            # Citas que no se mueven y chocarían con alguna de las movidas. Como ninguna cita dura
+            # más de un día, basta mirar el día anterior y el siguiente a la nueva fecha (índice por fecha).
+            conflictos = conn.execute(
+                f"WITH sel AS (SELECT id, fecha, hora, duracion FROM citas WHERE {filtro}) "
+                "SELECT DISTINCT o.id, o.fecha, o.hora, o.duracion, o.asunto FROM sel m JOIN citas o "
+                "ON o.user_id=? AND o.fecha BETWEEN date(m.fecha, ?, '-1 day') AND date(m.fecha, ?, '+1 day') "
+                "WHERE o.id NOT IN (SELECT id FROM sel) "
+                "AND o.fecha || ' ' || o.hora < strftime('%Y-%m-%d %H:%M', m.fecha || ' ' || m.hora, ?, '+' || m.duracion || ' minutes') "
+                "AND strftime('%Y-%m-%d %H:%M', o.fecha || ' ' || o.hora, '+' || o.duracion || ' minutes') "
+                "> strftime('%Y-%m-%d %H:%M', m.fecha || ' ' || m.hora, ?) "
+                "ORDER BY o.fecha, o.hora",
+                [*parametros, user_id, dias, dias, dias, dias]
+            ).fetchall()
+            if not conflictos:
+                movidas = conn.execute(
+                    f"SELECT date(fecha, ?), hora, duracion FROM citas WHERE {filtro}", [dias, *parametros]
+                ).fetchall()
+                conflictos = self._choques_recurrentes(user_id, movidas)
+            if conflictos:
+                return 0, conflictos
+            # Una sola sentencia para todas las citas
+            movidas = conn.execute(f"UPDATE citas SET fecha = date(fecha, ?) WHERE {filtro}", [dias, *parametros]).rowcount
+        self._notificar(user_id)
+        return movidas, []
+
+    def _filtro_renombrar(self, user_id, viejo, nuevo, fecha_ini, fecha_fin):
+        # Citas del rango cuyo asunto contiene 'viejo', y la condición de que el resultado quepa
+        filtro, parametros = self._filtro(user_id, fecha_ini, fecha_fin, None)
+        cabe = "length(replace(asunto, ?, ?)) <= ?"
+        return f"{filtro} AND instr(asunto, ?) > 0", [*parametros, viejo], cabe, [viejo, nuevo, ASUNTO_MAXIMO]
+
+    def renombrar(self, user_id, viejo, nuevo, fecha_ini=None, fecha_fin=None):
+        filtro, parametros, cabe, parametros_cabe = self._filtro_renombrar(user_id, viejo, nuevo, fecha_ini, fecha_fin)
+        with self._conexion() as conn:
+            omitidas = conn.execute(
+                f"SELECT COUNT(*) FROM citas WHERE {filtro} AND NOT {cabe}", [*parametros, *parametros_cabe]
+            ).fetchone()[0]
+            cambiadas = conn.execute(
+                f"UPDATE citas SET asunto = replace(asunto, ?, ?) WHERE {filtro} AND {cabe}",
+                [viejo, nuevo, *parametros, *parametros_cabe]
+            ).rowcount
+        self._notificar(user_id)
+        return cambiadas, omitidas
+
+    def contar_renombrar(self, user_id, viejo, nuevo, fecha_ini=None, fecha_fin=None):
+        filtro, parametros, cabe, parametros_cabe = self._filtro_renombrar(user_id, viejo, nuevo, fecha_ini, fecha_fin)
+        with self._conexion() as conn:
+            total, caben = conn.execute(
+                f"SELECT COUNT(*), COALESCE(SUM({cabe}), 0) FROM citas WHERE {filtro}", [*parametros_cabe, *parametros]
+            ).fetchone()
+        return caben, total - caben
+
+    # --- Recurrencias ---
+    def crear_recurrencia(self, user_id, fecha, hora, duracion, asunto, frecuencia, intervalo=1, hasta=None, repeticiones=None):
+        with self._conexion() as conn:
+            c = conn.execute(
+                "INSERT INTO recurrencias (user_id, fecha_inicio, hora, duracion, asunto, frecuencia, intervalo, hasta, repeticiones) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (user_id, fecha, hora, duracion, asunto, frecuencia, intervalo, hasta, repeticiones)
+            )
+            id_regla = c.lastrowid
+        self._notificar(user_id)
+        return id_regla
+
+    def recurrencias(self, user_id):
+        with self._conexion() as conn:
+            filas = conn.execute(
+                "SELECT id, fecha_inicio, hora, duracion, asunto, frecuencia, intervalo, hasta, repeticiones, excepciones "
+                "FROM recurrencias WHERE user_id=? ORDER BY id",
+                (user_id,)
+            ).fetchall()
+        return [(*fila[:9], tuple(filter(None, fila[9].split(",")))) for fila in filas]
+
+    def recurrencias_vigentes(self, fecha):
+        with self._conexion() as conn:
+            filas = conn.execute(
+                "SELECT user_id, id, fecha_inicio, hora, duracion, asunto, frecuencia, intervalo, hasta, repeticiones, excepciones "
+                "FROM recurrencias WHERE hasta IS NULL OR hasta >= ?",
+                (fecha,)
+            ).fetchall()
+        return [(fila[0], (*fila[1:10], tuple(filter(None, fila[10].split(","))))) for fila in filas]
+
+    def agregar_excepcion(self, user_id, id_regla, fecha):
+        with self._conexion() as conn:
+            cambios = conn.execute(
+                "UPDATE recurrencias SET excepciones = CASE WHEN excepciones = '' THEN ? ELSE excepciones || ',' || ? END "
+                "WHERE id=? AND user_id=?",
+                (fecha, fecha, id_regla, user_id)
+            ).rowcount
+        self._notificar(user_id)
+        return cambios > 0
+
+    def eliminar_recurrencia(self, user_id, id_regla):
+        with self._conexion() as conn:
+            cambios = conn.execute("DELETE FROM recurrencias WHERE id=? AND user_id=?", (id_regla, user_id)).rowcount
+        self._notificar(user_id)
+        return cambios > 0
+
+    # --- Archivo ---
+    def archivar(self, antes_de, lote=500, pausa=0.05):
+        # Lotes pequeños: cada uno es una transacción corta, así los demás escritores
+        # no esperan más de unos milisegundos.
+        conn = sqlite3.connect(self.ruta)
+        c = conn.cursor()
+        total = 0
+        usuarios = set()
+        while True:
+            c.execute("SELECT id, user_id FROM citas WHERE fecha < ? ORDER BY fecha LIMIT ?", (antes_de, lote))
+            filas = c.fetchall()
+            if not filas:
+                break
+
+            ids = [fila[0] for fila in filas]
+            marcadores = ",".join("?" * len(ids))
+            c.execute(
+                "INSERT INTO citas_archivo (cita_id, user_id, fecha, hora, asunto, duracion, archivada_en) "
+                f"SELECT id, user_id, fecha, hora, asunto, duracion, ? FROM citas WHERE id IN ({marcadores})",
+                [datetime.now().strftime("%Y-%m-%d %H:%M:%S"), *ids]
+            )
+            c.execute(f"DELETE FROM citas WHERE id IN ({marcadores})", ids)
+            conn.commit()
+
+            total += len(ids)
+            usuarios.update(fila[1] for fila in filas)
+            if len(filas) < lote:
+                break
+            time.sleep(pausa)
+
+        # Mantenimiento ligero: liberar unas cuantas páginas y actualizar estadísticas del planificador.
+        # analysis_limit acota el ANALYZE que lanza 'optimize' para que no recorra tablas enteras.
+        c.execute("PRAGMA incremental_vacuum(256)")
+        c.execute("PRAGMA analysis_limit = 400")
+        c.execute("PRAGMA optimize")
+        conn.close()
+
+        for user_id in usuarios:
+            self._notificar(user_id)
+        return total
+
+    def historial(self, user_id, fecha_ini, fecha_fin):
+        with self._conexion() as conn:
+            c = conn.cursor()
+            c.execute(
+                "SELECT cita_id, fecha, hora, duracion, asunto FROM citas_archivo "
+                "WHERE user_id=? AND fecha BETWEEN ? AND ? ORDER BY fecha, hora",
+                (user_id, fecha_ini, fecha_fin)
+            )
+            return c.fetchall()
+
+    # --- Resumen diario ---
+    def suscribir_resumen(self, user_id, hora):
+        with self._conexion() as conn:
+            if hora:
+                conn.execute(
+                    "INSERT INTO suscripciones_resumen (user_id, hora) VALUES (?, ?) "
+                    "ON CONFLICT(user_id) DO UPDATE SET hora=excluded.hora",
+                    (user_id, hora)
+                )
+            else:
+                conn.execute("DELETE FROM suscripciones_resumen WHERE user_id=?", (user_id,))
+
+    def suscripcion_resumen(self, user_id):
+        with self._conexion() as conn:
+            fila = conn.execute("SELECT hora FROM suscripciones_resumen WHERE user_id=?", (user_id,)).fetchone()
+        return fila[0] if fila else None
+
+    def resumen_del_dia(self, hora, fecha):
+        # Una consulta para todos los suscritos de esa hora (y otra para sus reglas recurrentes),
+        # en lugar de una consulta por usuario
+        with self._conexion() as conn:
+            filas = conn.execute(
+                "SELECT s.user_id, c.id, c.fecha, c.hora, c.duracion, c.asunto FROM suscripciones_resumen s "
+                "LEFT JOIN citas c ON c.user_id = s.user_id AND c.fecha = ? "
+                "WHERE s.hora = ? ORDER BY s.user_id, c.hora",
+                (fecha, hora)
+            ).fetchall()
+            reglas = conn.execute(
+                "SELECT r.user_id, r.id, r.fecha_inicio, r.hora, r.duracion, r.asunto, r.frecuencia, r.intervalo, "
+                "r.hasta, r.repeticiones, r.excepciones FROM recurrencias r "
+                "JOIN suscripciones_resumen s ON s.user_id = r.user_id "
+                "WHERE s.hora = ? AND r.fecha_inicio <= ? AND (r.hasta IS NULL OR r.hasta >= ?)",
+                (hora, fecha, fecha)
+            ).fetchall()
+
+        resumen = {}
+        for user_id, *cita in filas:
+            citas = resumen.setdefault(user_id, [])
+            if cita[0] is not None:
+                citas.append(tuple(cita))
+        reglas = [(fila[0], (*fila[1:10], tuple(filter(None, fila[10].split(","))))) for fila in reglas]
+        return self._agregar_ocurrencias(resumen, reglas, fecha)
+
+    # --- Copias de seguridad ---
+    def respaldar(self, destino, paginas=256, pausa=0.01):
+        # Copia en caliente con la API de backup de SQLite: 'paginas' páginas por paso y una pausa
+        # entre pasos en la que la base de datos queda libre. Devuelve el número de páginas copiadas.
+        origen = sqlite3.connect(self.ruta)
+        copia = sqlite3.connect(destino)
+        progreso = {"restantes": None, "total": 0, "reinicios": 0}
+
+        def al_avanzar(estado, restantes, total):
+            # Si otra conexión escribe entre dos pasos, SQLite empieza la copia desde el principio
+            if progreso["restantes"] is not None and restantes > progreso["restantes"]:
+                progreso["reinicios"] += 1
+                if progreso["reinicios"] > self.REINICIOS_COPIA_MAX:
+                    raise CopiaReiniciada()
+            progreso["restantes"] = restantes
+            progreso["total"] = total
+            # El parámetro 'sleep' de backup() solo actúa si la base de datos está ocupada:
+            # la pausa entre pasos la hacemos nosotros
+            if restantes:
+                time.sleep(pausa)
+
+        try:
+            try:
+                origen.backup(copia, pages=paginas, progress=al_avanzar)
+            except CopiaReiniciada:
+                # Con mucha escritura los pasos no llegan a terminar: copiamos todo en un solo paso.
+                # En modo WAL eso es una transacción de lectura y no bloquea a los escritores.
+                logger.info(f"Copia de {self.ruta} reiniciada {progreso['reinicios']} veces; se termina en un solo paso.")
+                origen.backup(copia)
+                progreso["total"] = origen.execute("PRAGMA page_count").fetchone()[0]
+        finally:
+            copia.close()
+            origen.close()
+        return progreso["total"]
+
+    # --- Usuarios ---
+    def registrar_usuario(self, user_id, username):
+        with self._conexion() as conn:
+            conn.execute(
+                "INSERT INTO usuarios (user_id, username) VALUES (?, ?) "
+                "ON CONFLICT(user_id) DO UPDATE SET username=excluded.username",
+                (user_id, username)
+            )
+
+    def buscar_usuarios(self, usernames):
+        usernames = list(usernames)
+        if not usernames:
+            return {}
+        with self._conexion() as conn:
+            marcadores = ",".join("?" * len(usernames))
+            c = conn.execute(f"SELECT username, user_id FROM usuarios WHERE username IN ({marcadores})", usernames)
+            return dict(c.fetchall())
+
+    def permitir_coordinacion(self, user_id, autorizado_id, permitir=True):
+        with self._conexion() as conn:
+            if permitir:
+                c = conn.execute(
+                    "INSERT OR IGNORE INTO permisos_coordinacion (user_id, autorizado_id) VALUES (?, ?)",
+                    (user_id, autorizado_id)
+                )
+            else:
+                c = conn.execute(
+                    "DELETE FROM permisos_coordinacion WHERE user_id=? AND autorizado_id=?", (user_id, autorizado_id)
+                )
+            return c.rowcount > 0
+
+    def permisos_coordinacion(self, user_id):
+        with self._conexion() as conn:
+            c = conn.execute(
+                "SELECT u.username FROM permisos_coordinacion p JOIN usuarios u ON u.user_id = p.autorizado_id "
+                "WHERE p.user_id=? AND u.username IS NOT NULL ORDER BY u.username",
+                (user_id,)
+            )
+            return [fila[0] for fila in c.fetchall()]
+
+    def autorizan_coordinacion(self, autorizado_id, user_ids):
+        user_ids = list(user_ids)
+        if not user_ids:
+            return set()
+        with self._conexion() as conn:
+            marcadores = ",".join("?" * len(user_ids))
+            c = conn.execute(
+                f"SELECT user_id FROM permisos_coordinacion WHERE autorizado_id=? AND user_id IN ({marcadores})",
+                [autorizado_id, *user_ids]
+            )
+            return {fila[0] for fila in c.fetchall()}
+
+
+def normalizar_texto(texto):
+    # Minúsculas y sin tildes, igual que el tokenizador unicode61 con remove_diacritics
+    descompuesto = unicodedata.normalize("NFKD", texto.lower())
+    return "".join(caracter for caracter in descompuesto if not unicodedata.combining(caracter))
+
+
+class RepositorioMemoria(RepositorioCitas):
+    # Por usuario mantenemos una lista ordenada de claves (fecha, hora, id): los rangos y los
+    # solapamientos son búsquedas binarias (bisect), igual que el índice (user_id, fecha, hora) de SQLite.
+
+    def __init__(self):
+        super().__init__()
+        self._cerrojo = threading.RLock()
+        self._citas = {}      # id -> [user_id, fecha, hora, duracion, asunto]
+        self._indices = {}    # user_id -> lista ordenada de (fecha, hora, id)
+        self._archivo = {}    # user_id -> lista de filas archivadas
+        self._usuarios = {}   # user_id -> username
+        self._permisos = {}   # user_id -> conjunto de user_id que pueden coordinar con él
+        self._recurrencias = {}  # user_id -> {id_regla: regla}
+        self._resumenes = {}  # user_id -> hora del resumen diario
+        self._siguiente_id = 1
+        self._siguiente_regla = 1
+
+    def inicializar(self):
+        pass
+
+    def _abrir_lote(self):
+        # En memoria no hay commits: basta con que nadie más escriba mientras dura el lote
+        return self._cerrojo
+
+    def _fila(self, id_cita):
+        user_id, fecha, hora, duracion, asunto = self._citas[id_cita]
+        return id_cita, fecha, hora, duracion, asunto
+
+    def _posiciones(self, indice, fecha_ini, hora_ini, fecha_fin, hora_fin):
+        # Posiciones de las claves con (fecha_ini, hora_ini) <= (fecha, hora) < (fecha_fin, hora_fin)
+        return bisect.bisect_left(indice, (fecha_ini, hora_ini)), bisect.bisect_left(indice, (fecha_fin, hora_fin))
+
+    def _insertar(self, user_id, fecha, hora, duracion, asunto):
+        indice = self._indices.setdefault(user_id, [])
+        i = bisect.bisect_left(indice, (fecha, hora))
+        if i < len(indice) and indice[i][:2] == (fecha, hora):
+            return False
+        id_cita = self._siguiente_id
+        self._siguiente_id += 1
+        self._citas[id_cita] = [user_id, fecha, hora, duracion, asunto]
+        indice.insert(i, (fecha, hora, id_cita))
+        return True
+
+    def _quitar(self, id_cita):
+        user_id, fecha, hora, _, _ = self._citas.pop(id_cita)
+        indice = self._indices[user_id]
+        del indice[bisect.bisect_left(indice, (fecha, hora, id_cita))]
+        return user_id
+
+    # --- Citas ---
+    def crear(self, user_id, fecha, hora, asunto, duracion=DURACION_POR_DEFECTO):
+        with self._cerrojo:
+            creada = self._insertar(user_id, fecha, hora, duracion, asunto)
+        if creada:
+            self._notificar(user_id)
+        return creada
+
+    def crear_varios(self, user_id, eventos):
+        insertadas = 0
+        with self._cerrojo:
+            for fecha, hora, duracion, asunto in eventos:
+                insertadas += self._insertar(user_id, fecha, hora, duracion, asunto)
+        self._notificar(user_id)
+        return insertadas
+
+    def rango(self, user_id, fecha_ini=None, fecha_fin=None):
+        with self._cerrojo:
+            indice = self._indices.get(user_id, [])
+            if fecha_ini:
+                # "￿" es mayor que cualquier hora: incluye todo el día 'fecha_fin'
+                i, j = self._posiciones(indice, fecha_ini, "", fecha_fin, "￿")
+            else:
+                i, j = 0, len(indice)
+            return [self._fila(clave[2]) for clave in indice[i:j]]
+
+    def iterar(self, user_id, fecha_ini=None, fecha_fin=None):
+        return iter(self.rango(user_id, fecha_ini, fecha_fin))
+
+    def _solapamientos(self, user_id, fecha, hora, duracion, excluidos=()):
+        inicio, fin, desde = ventana_solapamiento(fecha, hora, duracion)
+        indice = self._indices.get(user_id, [])
+        i, j = self._posiciones(
+            indice,
+            desde.strftime("%Y-%m-%d"), desde.strftime("%H:%M"),
+            fin.strftime("%Y-%m-%d"), fin.strftime("%H:%M")
+        )
+        conflictos = []
+        for fecha_c, hora_c, id_cita in indice[i:j]:
+            if id_cita in excluidos:
+                continue
+            duracion_c = self._citas[id_cita][3]
+            inicio_c = datetime.strptime(f"{fecha_c} {hora_c}", "%Y-%m-%d %H:%M")
+            if inicio_c + timedelta(minutes=duracion_c) > inicio:
+                conflictos.append(self._fila(id_cita))
+        return conflictos
+
+    def solapamientos(self, user_id, fecha, hora, duracion, excluir_id=None):
+        with self._cerrojo:
+            return self._solapamientos(user_id, fecha, hora, duracion, {excluir_id})
+
+    def citas_que_empiezan(self, desde, hasta):
+        filas = []
+        with self._cerrojo:
+            for user_id, indice in self._indices.items():
+                i, j = self._posiciones(
+                    indice, desde.strftime("%Y-%m-%d"), desde.strftime("%H:%M"), hasta.strftime("%Y-%m-%d"), hasta.strftime("%H:%M")
+                )
+                filas.extend((user_id, *self._fila(clave[2])) for clave in indice[i:j])
+        filas.sort(key=lambda fila: (fila[2], fila[3]))
+        return filas
+
+    def actualizar_asunto(self, user_id, id_cita, asunto):
+        with self._cerrojo:
+            cita = self._citas.get(self._id(id_cita))
+            if not cita or cita[0] != user_id:
+                return False
+            cita[4] = asunto
+        self._notificar(user_id)
+        return True
+
+    def _id(self, id_cita):
+        # Los IDs llegan como texto desde los comandos
+        try:
+            return int(id_cita)
+        except (TypeError, ValueError):
+            return None
+
+    def reprogramar(self, user_id, id_cita, fecha, hora, duracion=None):
+        with self._cerrojo:
+            id_cita = self._id(id_cita)
+            cita = self._citas.get(id_cita)
+            if not cita or cita[0] != user_id:
+                return "no_encontrado", []
+
+            duracion = duracion or cita[3] or DURACION_POR_DEFECTO
+            conflictos = self._solapamientos(user_id, fecha, hora, duracion, {id_cita})
+            conflictos += self.solapamientos_recurrentes(user_id, fecha, hora, duracion)
+            if conflictos:
+                return "solapamiento", conflictos
+
+            indice = self._indices[user_id]
+            del indice[bisect.bisect_left(indice, (cita[1], cita[2], id_cita))]
+            cita[1], cita[2], cita[3] = fecha, hora, duracion
+            bisect.insort(indice, (fecha, hora, id_cita))
+        self._notificar(user_id)
+        return "exito", []
+
+    def eliminar_fecha(self, user_id, fecha):
+        with self._cerrojo:
+            indice = self._indices.get(user_id, [])
+            i, j = self._posiciones(indice, fecha, "", fecha, "￿")
+            for _, _, id_cita in indice[i:j]:
+                del self._citas[id_cita]
+            del indice[i:j]
+        self._notificar(user_id)
+        return j - i
+
+    def eliminar_todo(self, user_id):
+        with self._cerrojo:
+            for _, _, id_cita in self._indices.pop(user_id, []):
+                del self._citas[id_cita]
+            self._recurrencias.pop(user_id, None)
+            # Igual que en SQLite: si no queda nada de nadie, los IDs vuelven a empezar en 1
+            if not self._citas:
+                self._siguiente_id = 1
+        self._notificar(user_id)
+
+    def _coincide(self, asunto, palabras_buscadas):
+        # Cada palabra buscada debe ser prefijo de alguna palabra del asunto
+        palabras = re.findall(r"\w+", normalizar_texto(asunto))
+        return all(any(p.startswith(buscada) for p in palabras) for buscada in palabras_buscadas)
+
+    def buscar(self, user_id, texto, limite, desplazamiento=0):
+        palabras_buscadas = re.findall(r"\w+", normalizar_texto(texto))
+        if not palabras_buscadas:
+            return []
+        with self._cerrojo:
+            resultados = [
+                self._fila(id_cita) for _, _, id_cita in self._indices.get(user_id, [])
+                if self._coincide(self._citas[id_cita][4], palabras_buscadas)
+            ]
+        return resultados[desplazamiento:desplazamiento + limite]
+
+    # --- Operaciones masivas ---
+    def _seleccionar(self, user_id, fecha_ini, fecha_fin, texto):
+        # IDs de las citas que cumplen el filtro, en orden de fecha y hora
+        indice = self._indices.get(user_id, [])
+        if fecha_ini:
+            i, j = self._posiciones(indice, fecha_ini, "", fecha_fin, "￿")
+        else:
+            i, j = 0, len(indice)
+        palabras_buscadas = re.findall(r"\w+", normalizar_texto(texto)) if texto else []
+        return [
+            id_cita for _, _, id_cita in indice[i:j]
+            if not palabras_buscadas or self._coincide(self._citas[id_cita][4], palabras_buscadas)
+        ]
+
+    def contar(self, user_id, fecha_ini=None, fecha_fin=None, texto=None):
+        with self._cerrojo:
+            return len(self._seleccionar(user_id, fecha_ini, fecha_fin, texto))
+
+    def eliminar_rango(self, user_id, fecha_ini=None, fecha_fin=None, texto=None):
+        with self._cerrojo:
+            ids = self._seleccionar(user_id, fecha_ini, fecha_fin, texto)
+            for id_cita in ids:
+                self._quitar(id_cita)
+        self._notificar(user_id)
+        return len(ids)
+
+    def desplazar(self, user_id, dias, fecha_ini=None, fecha_fin=None, texto=None):
+        with self._cerrojo:
+            ids = self._seleccionar(user_id, fecha_ini, fecha_fin, texto)
+            movidas = set(ids)
+            nuevas = {}
+            conflictos = {}
+            for id_cita in ids:
+                _, fecha, hora, duracion, _ = self._citas[id_cita]
+                nueva = (datetime.strptime(fecha, "%Y-%m-%d") + timedelta(days=int(dias))).strftime("%Y-%m-%d")
+                nuevas[id_cita] = nueva
+                for fila in self._solapamientos(user_id, nueva, hora, duracion, movidas):
+                    conflictos[fila[0]] = fila
+            if not conflictos:
+                horarios = [(nuevas[id_cita], *self._citas[id_cita][2:4]) for id_cita in ids]
+                conflictos = {fila[:2]: fila for fila in self._choques_recurrentes(user_id, horarios)}
+            if conflictos:
+                return 0, sorted(conflictos.values(), key=lambda fila: (fila[1], fila[2]))
+
+            indice = self._indices.get(user_id, [])
+            for id_cita, nueva in nuevas.items():
+                cita = self._citas[id_cita]
+                del indice[bisect.bisect_left(indice, (cita[1], cita[2], id_cita))]
+                cita[1] = nueva
+            for id_cita in ids:
+                bisect.insort(indice, (nuevas[id_cita], self._citas[id_cita][2], id_cita))
+        self._notificar(user_id)
+        return len(ids), []
+
+    def _a_renombrar(self, user_id, viejo, nuevo, fecha_ini, fecha_fin):
+        # (citas que cambiarían con su asunto nuevo, cuántas se omitirían por pasar de ASUNTO_MAXIMO)
+        cambios, omitidas = [], 0
+        for id_cita in self._seleccionar(user_id, fecha_ini, fecha_fin, None):
+            cita = self._citas[id_cita]
+            if viejo in cita[4]:
+                asunto = cita[4].replace(viejo, nuevo)
+                if len(asunto) <= ASUNTO_MAXIMO:
+                    cambios.append((cita, asunto))
+                else:
+                    omitidas += 1
+        return cambios, omitidas
+
+    def renombrar(self, user_id, viejo, nuevo, fecha_ini=None, fecha_fin=None):
+        with self._cerrojo:
+            cambios, omitidas = self._a_renombrar(user_id, viejo, nuevo, fecha_ini, fecha_fin)
+            for cita, asunto in cambios:
+                cita[4] = asunto
+        self._notificar(user_id)
+        return len(cambios), omitidas
+
+    def contar_renombrar(self, user_id, viejo, nuevo, fecha_ini=None, fecha_fin=None):
+        with self._cerrojo:
+            cambios, omitidas = self._a_renombrar(user_id, viejo, nuevo, fecha_ini, fecha_fin)
+        return len(cambios), omitidas
+
+    # --- Recurrencias ---
+    def crear_recurrencia(self, user_id, fecha, hora, duracion, asunto, frecuencia, intervalo=1, hasta=None, repeticiones=None):
+        with self._cerrojo:
+            id_regla = self._siguiente_regla
+            self._siguiente_regla += 1
+            self._recurrencias.setdefault(user_id, {})[id_regla] = (
+                id_regla, fecha, hora, duracion, asunto, frecuencia, intervalo, hasta, repeticiones, ()
+            )
+        self._notificar(user_id)
+        return id_regla
+
+    def recurrencias(self, user_id):
+        with self._cerrojo:
+            return list(self._recurrencias.get(user_id, {}).values())
+
+    def recurrencias_vigentes(self, fecha):
+        with self._cerrojo:
+            return [
+                (user_id, regla) for user_id, reglas in self._recurrencias.items()
+                for regla in reglas.values() if not regla[7] or regla[7] >= fecha
+            ]
+
+    def agregar_excepcion(self, user_id, id_regla, fecha):
+        with self._cerrojo:
+            reglas = self._recurrencias.get(user_id, {})
+            regla = reglas.get(self._id(id_regla))
+            if not regla:
+                return False
+            # Las reglas son tuplas (claves de la caché de expansiones): se reemplazan, no se modifican
+            reglas[regla[0]] = (*regla[:9], regla[9] + (fecha,))
+        self._notificar(user_id)
+        return True
+
+    def eliminar_recurrencia(self, user_id, id_regla):
+        with self._cerrojo:
+            borrada = self._recurrencias.get(user_id, {}).pop(self._id(id_regla), None)
+        self._notificar(user_id)
+        return borrada is not None
+
+    # --- Resumen diario ---
+    def suscribir_resumen(self, user_id, hora):
+        with self._cerrojo:
+            if hora:
+                self._resumenes[user_id] = hora
+            else:
+                self._resumenes.pop(user_id, None)
+
+    def suscripcion_resumen(self, user_id):
+        with self._cerrojo:
+            return self._resumenes.get(user_id)
+
+    def resumen_del_dia(self, hora, fecha):
+        with self._cerrojo:
+            usuarios = [user_id for user_id, hora_resumen in self._resumenes.items() if hora_resumen == hora]
+            resumen = {user_id: self.rango(user_id, fecha, fecha) for user_id in usuarios}
+            reglas = [(user_id, regla) for user_id in usuarios for regla in self._recurrencias.get(user_id, {}).values()]
+        return self._agregar_ocurrencias(resumen, reglas, fecha)
+
+    # --- Archivo ---
+    def archivar(self, antes_de, lote=500, pausa=0.05):
+        total = 0
+        usuarios = set()
+        with self._cerrojo:
+            for user_id, indice in self._indices.items():
+                # El índice está ordenado por fecha: las pasadas son un prefijo de la lista
+                j = bisect.bisect_left(indice, (antes_de,))
+                if not j:
+                    continue
+                archivo = self._archivo.setdefault(user_id, [])
+                for _, _, id_cita in indice[:j]:
+                    archivo.append(self._fila(id_cita))
+                    del self._citas[id_cita]
+                del indice[:j]
+                archivo.sort(key=lambda fila: (fila[1], fila[2]))
+                total += j
+                usuarios.add(user_id)
+        for user_id in usuarios:
+            self._notificar(user_id)
+        return total
+
+    def historial(self, user_id, fecha_ini, fecha_fin):
+        with self._cerrojo:
+            return [fila for fila in self._archivo.get(user_id, []) if fecha_ini <= fila[1] <= fecha_fin]
+
+    # --- Usuarios ---
+    def registrar_usuario(self, user_id, username):
+        with self._cerrojo:
+            self._usuarios[user_id] = username
+
+    def buscar_usuarios(self, usernames):
+        buscados = set(usernames)
+        with self._cerrojo:
+            return {username: user_id for user_id, username in self._usuarios.items() if username in buscados}
+
+    def permitir_coordinacion(self, user_id, autorizado_id, permitir=True):
+        with self._cerrojo:
+            autorizados = self._permisos.setdefault(user_id, set())
+            if permitir == (autorizado_id in autorizados):
+                return False
+            if permitir:
+                autorizados.add(autorizado_id)
+            else:
+                autorizados.discard(autorizado_id)
+            return True
+
+    def permisos_coordinacion(self, user_id):
+        with self._cerrojo:
+            return sorted(
+                self._usuarios[autorizado] for autorizado in self._permisos.get(user_id, ())
+                if self._usuarios.get(autorizado)
+            )
+
+    def autorizan_coordinacion(self, autorizado_id, user_ids):
+        with self._cerrojo:
+            return {user_id for user_id in user_ids if autorizado_id in self._permisos.get(user_id, ())}
+
+
+class ColaEscritura:
+    # Un único escritor agrupa las escrituras que llegan a la vez y las confirma con un solo
+    # commit (un solo fsync). Cada llamada recibe su propio resultado o excepción.
+
+    def __init__(self, repo, max_lote=64, espera=0.002):
+        self.repo = repo
+        self.max_lote = max_lote
+        self.espera = espera  # segundos que se espera a que lleguen más escrituras antes de confirmar
+        self.operaciones = 0
+        self.lotes = 0
+        self._cola = None
+        self._tarea = None
+        self._bucle = None
+
+    def iniciar(self):
+        # Se ata al bucle de eventos en curso (si cambia de bucle, se vuelve a crear)
+        self._bucle = asyncio.get_running_loop()
+        self._cola = asyncio.Queue()
+        self._tarea = self._bucle.create_task(self._escritor())
+
+    async def detener(self):
+        # Termina las escrituras pendientes y para el escritor
+        if self._tarea and asyncio.get_running_loop() is self._bucle:
+            await self._cola.join()
+            self._tarea.cancel()
+        self._tarea = None
+
+    async def ejecutar(self, funcion, *args):
+        # Encola funcion(*args) (un método de escritura del repositorio) y espera su resultado
+        if self._tarea is None or self._tarea.done() or asyncio.get_running_loop() is not self._bucle:
+            self.iniciar()
+        futuro = self._bucle.create_future()
+        # Con el contexto de quien escribe: la escritura se ejecuta dentro de su traza (si la hay)
+        await self._cola.put((funcion, args, futuro, contextvars.copy_context()))
+        return await futuro
+
+    def _tomar_pendientes(self, pendientes):
+        while len(pendientes) < self.max_lote and not self._cola.empty():
+            pendientes.append(self._cola.get_nowait())
+
+    async def _escritor(self):
+        while True:
+            pendientes = [await self._cola.get()]
+            self._tomar_pendientes(pendientes)
+            if len(pendientes) < self.max_lote and self.espera:
+                await asyncio.sleep(self.espera)
+                self._tomar_pendientes(pendientes)
+
+            # El disco se toca en un hilo: el bucle de eventos sigue atendiendo mientras tanto
+            try:
+                resultados = await asyncio.to_thread(self._aplicar, pendientes)
+            except Exception as e:
+                # Falló el commit: ninguna escritura del lote quedó guardada
+                logger.error(f"Error confirmando un lote de {len(pendientes)} escrituras: {e}")
+                resultados = [e] * len(pendientes)
+
+            self.operaciones += len(pendientes)
+            self.lotes += 1
+            for (_, _, futuro, _), resultado in zip(pendientes, resultados):
+                if not futuro.done():
+                    if isinstance(resultado, Exception):
+                        futuro.set_exception(resultado)
+                    else:
+                        futuro.set_result(resultado)
+                self._cola.task_done()
+
+    def _aplicar(self, pendientes):
+        resultados = []
+        with self.repo.lote():
+            for funcion, args, _, contexto in pendientes:
+                try:
+                    resultados.append(contexto.run(funcion, *args))
+                except Exception as e:
+                    resultados.append(e)
+        return resultados
+
+
+def crear_repositorio(tipo="sqlite", ruta="meetmanager.db"):
+    if tipo == "memoria":
+        return RepositorioMemoria()
+    return RepositorioSQLite(ruta)
@@ -0,0 +1,197 @@
+# --- COMPROBACIÓN Y BENCHMARK DEL ALMACENAMIENTO ---
+# Ejecuta las mismas comprobaciones contra RepositorioSQLite y RepositorioMemoria y después
+# mide las operaciones más usadas por los handlers.
+#   python bench_almacenamiento.py [num_citas]
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from almacenamiento import RepositorioMemoria, RepositorioSQLite
+
+
+def comprobar(repo):
+    cambios = []
+    repo.al_cambiar(cambios.append)
+    repo.inicializar()
+
+    assert repo.crear(1, "2030-01-10", "10:00", "Reunión Acme", 60)
+    assert not repo.crear(1, "2030-01-10", "10:00", "Duplicada"), "no debe duplicar fecha y hora"
+    assert repo.crear(1, "2030-01-10", "12:00", "Comida", 90)
+    assert repo.crear(1, "2030-01-12", "09:00", "Dentista")
+    assert repo.crear(2, "2030-01-10", "10:00", "Otro usuario")
+    assert cambios == [1, 1, 1, 2], cambios
+
+    filas = repo.rango(1)
+    assert [(f[1], f[2]) for f in filas] == [("2030-01-10", "10:00"), ("2030-01-10", "12:00"), ("2030-01-12", "09:00")]
+    assert [f[4] for f in repo.rango(1, "2030-01-10", "2030-01-10")] == ["Reunión Acme", "Comida"]
+    assert list(repo.iterar(1, "2030-01-11", "2030-01-12")) == repo.rango(1, "2030-01-11", "2030-01-12")
+    id_reunion, id_comida = filas[0][0], filas[1][0]
+
+    # Solapamientos: [10:30, 11:00) choca con la reunión; [11:00, 12:00) no choca con nada
+    assert [f[0] for f in repo.solapamientos(1, "2030-01-10", "10:30", 30)] == [id_reunion]
+    assert repo.solapamientos(1, "2030-01-10", "11:00", 60) == []
+    assert repo.solapamientos(1, "2030-01-10", "10:30", 30, excluir_id=id_reunion) == []
+    # Una cita que cruza la medianoche ocupa también el día siguiente
+    assert repo.crear(1, "2030-01-11", "23:00", "Guardia", 120)
+    assert [f[4] for f in repo.solapamientos(1, "2030-01-12", "00:30", 15)] == ["Guardia"]
+
+    assert repo.actualizar_asunto(1, str(id_comida), "Comida con Acme")
+    assert not repo.actualizar_asunto(1, "999999", "Nada")
+    # Las citas de otro usuario no se pueden tocar aunque se conozca su ID
+    assert not repo.actualizar_asunto(2, str(id_comida), "Ajena")
+    assert repo.reprogramar(2, id_comida, "2030-01-13", "15:00") == ("no_encontrado", [])
+    assert repo.reprogramar(1, id_comida, "2030-01-10", "10:30") == ("solapamiento", [repo.rango(1, "2030-01-10", "2030-01-10")[0]])
+    assert repo.reprogramar(1, id_comida, "2030-01-13", "15:00", 30) == ("exito", [])
+    assert repo.rango(1, "2030-01-13", "2030-01-13")[0][3] == 30
+    assert repo.reprogramar(1, 999999, "2030-01-13", "15:00") == ("no_encontrado", [])
+
+    # Búsqueda por prefijo y sin tildes
+    # (SQLite ordena por relevancia: solo comparamos el conjunto)
+    assert sorted(f[4] for f in repo.buscar(1, "acm", 10)) == ["Comida con Acme", "Reunión Acme"]
+    assert [f[4] for f in repo.buscar(1, "reunion acme", 10)] == ["Reunión Acme"]
+    assert repo.buscar(1, "otro", 10) == []
+    assert len(repo.buscar(1, "acme", 1, 1)) == 1
+
+    # Importación masiva: omite las que ya existen, también dentro del mismo lote
+    eventos = (("2030-02-01", f"{h:02d}:00", 30, f"Importada {h}") for h in [8, 9, 9, 10])
+    assert repo.crear_varios(1, eventos) == 3
+    assert repo.crear_varios(1, iter([("2030-02-01", "08:00", 30, "Repetida")])) == 0
+
+    assert repo.eliminar_fecha(1, "2030-02-01") == 3
+    assert repo.eliminar_fecha(1, "2030-02-01") == 0
+
+    # Archivo
+    assert repo.archivar("2030-01-11") == 2  # la reunión del usuario 1 y la del usuario 2
+    assert [f[0] for f in repo.historial(1, "2030-01-01", "2030-01-31")] == [id_reunion]
+    assert [f[4] for f in repo.rango(1)] == ["Guardia", "Dentista", "Comida con Acme"]
+
+    repo.registrar_usuario(1, "ana")
+    repo.registrar_usuario(2, "luis")
+    repo.registrar_usuario(2, "luis_g")
+    assert repo.buscar_usuarios(["ana", "luis", "luis_g", "nadie"]) == {"ana": 1, "luis_g": 2}
+    # Permisos de /coordinar: ana deja a luis ver sus huecos, pero no al revés
+    assert repo.autorizan_coordinacion(2, [1]) == set()
+    assert repo.permitir_coordinacion(1, 2)
+    assert not repo.permitir_coordinacion(1, 2)
+    assert repo.autorizan_coordinacion(2, [1, 3]) == {1}
+    assert repo.autorizan_coordinacion(1, [2]) == set()
+    assert repo.permisos_coordinacion(1) == ["luis_g"]
+    assert repo.permitir_coordinacion(1, 2, False)
+    assert repo.autorizan_coordinacion(2, [1]) == set()
+
+    # Operaciones masivas
+    for dia in range(1, 6):
+        repo.crear(4, f"2030-04-0{dia}", "10:00", f"Viaje Acme día {dia}")
+        repo.crear(4, f"2030-04-0{dia}", "12:00", "Comida")
+    assert repo.contar(4) == 10
+    assert repo.contar(4, "2030-04-02", "2030-04-03") == 4
+    assert repo.contar(4, "2030-04-01", "2030-04-05", "viaje acme") == 5
+    # El día 8 a las 10:30 hay una cita que no se mueve: mover los viajes 7 días choca con ella
+    repo.crear(4, "2030-04-08", "10:30", "Fija")
+    movidas, conflictos = repo.desplazar(4, 7, "2030-04-01", "2030-04-05", "viaje")
+    assert movidas == 0 and [f[4] for f in conflictos] == ["Fija"]
+    assert repo.contar(4, "2030-04-01", "2030-04-05") == 10, "no debe moverse ninguna"
+    movidas, conflictos = repo.desplazar(4, 14, "2030-04-01", "2030-04-05", "viaje")
+    assert (movidas, conflictos) == (5, [])
+    assert [f[4] for f in repo.rango(4, "2030-04-15", "2030-04-19")] == [f"Viaje Acme día {dia}" for dia in range(1, 6)]
+    assert repo.desplazar(4, -14, "2030-04-15", "2030-04-19") == (5, [])
+    assert repo.contar_renombrar(4, "Acme", "Globex", "2030-04-01", "2030-04-02") == (2, 0)
+    assert repo.renombrar(4, "Acme", "Globex", "2030-04-01", "2030-04-02") == (2, 0)
+    # Un asunto que pasaría de 100 caracteres no se toca
+    assert repo.contar_renombrar(4, "Acme", "A" * 95, "2030-04-03", "2030-04-03") == (0, 1)
+    assert repo.renombrar(4, "Acme", "A" * 95, "2030-04-03", "2030-04-03") == (0, 1)
+    assert repo.contar_renombrar(4, "Acme", "A" * 88, "2030-04-03", "2030-04-03") == (1, 0)
+    assert [f[4] for f in repo.rango(4, "2030-04-03", "2030-04-03")] == ["Viaje Acme día 3", "Comida"]
+    assert [f[4] for f in repo.rango(4, "2030-04-01", "2030-04-01")] == ["Viaje Globex día 1", "Comida"]
+    assert repo.eliminar_rango(4, "2030-04-01", "2030-04-05", "comida") == 5
+    assert repo.eliminar_rango(4) == 6
+    assert repo.contar(4) == 0
+
+    # Recurrencias: los lunes a las 10:00, 4 veces, sin el segundo lunes
+    id_regla = repo.crear_recurrencia(5, "2030-05-06", "10:00", 30, "Uno a uno", "semanal", repeticiones=4)
+    assert repo.agregar_excepcion(5, id_regla, "2030-05-13")
+    assert [f[1] for f in repo.ocurrencias(5, "2030-05-01", "2030-06-30")] == ["2030-05-06", "2030-05-20", "2030-05-27"]
+    assert repo.ocurrencias(5, "2030-05-07", "2030-05-19") == []
+    repo.crear(5, "2030-05-20", "09:00", "Antes")
+    assert [f[4] for f in repo.agenda(5, "2030-05-20", "2030-05-20")] == ["Antes", "Uno a uno"]
+    assert [f[0] for f in repo.solapamientos_recurrentes(5, "2030-05-27", "09:45", 30)] == [f"R{id_regla}"]
+    assert repo.solapamientos_recurrentes(5, "2030-05-13", "10:00", 30) == []
+    # Mensual el día 31: los meses sin día 31 se saltan
+    repo.crear_recurrencia(5, "2030-01-31", "08:00", 15, "Cierre", "mensual", hasta="2030-06-30")
+    assert [f[1] for f in repo.ocurrencias(5, "2030-01-01", "2030-12-31") if f[4] == "Cierre"] == \
+        ["2030-01-31", "2030-03-31", "2030-05-31"]
+    assert [fila[0] for fila in repo.recurrencias_vigentes("2030-06-01")] == [5, 5]
+    assert [fila[0] for fila in repo.recurrencias_vigentes("2030-07-01")] == [5]
+    # Citas de todos los usuarios por hora de inicio (lo que usan los recordatorios)
+    assert [fila[0] for fila in repo.citas_que_empiezan(datetime(2030, 5, 20, 9, 0), datetime(2030, 5, 20, 9, 1))] == [5]
+    assert repo.citas_que_empiezan(datetime(2030, 5, 20, 9, 1), datetime(2030, 5, 21)) == []
+    # Resumen diario: todos los suscritos a una hora, con o sin citas ese día
+    repo.suscribir_resumen(5, "08:00")
+    repo.suscribir_resumen(6, "08:00")
+    repo.suscribir_resumen(7, "09:00")
+    assert repo.suscripcion_resumen(5) == "08:00" and repo.suscripcion_resumen(8) is None
+    assert {u: [f[4] for f in filas] for u, filas in repo.resumen_del_dia("08:00", "2030-05-20").items()} == \
+        {5: ["Antes", "Uno a uno"], 6: []}
+    repo.suscribir_resumen(6, None)
+    assert list(repo.resumen_del_dia("08:00", "2030-05-13")) == [5]
+    assert repo.eliminar_recurrencia(5, id_regla) and not repo.eliminar_recurrencia(5, id_regla)
+    repo.eliminar_todo(5)
+    assert repo.recurrencias(5) == []
+
+    repo.eliminar_todo(1)
+    repo.eliminar_todo(2)
+    assert repo.rango(1) == [] and repo.rango(2) == []
+    # Sin citas de nadie, los IDs vuelven a empezar en 1
+    assert repo.crear(3, "2030-03-01", "10:00", "Nueva")
+    assert repo.rango(3)[0][0] == 1
+
+
+def medir(nombre, funcion, repeticiones):
+    inicio = time.perf_counter()
+    for i in range(repeticiones):
+        funcion(i)
+    total = time.perf_counter() - inicio
+    print(f"  {nombre:<28} {total * 1e6 / repeticiones:10.1f} µs/op")
+
+
+def benchmark(repo, num_citas):
+    repo.inicializar()
+    base = datetime(2030, 1, 1, 8, 0)
+    usuarios = 20
+
+    def eventos(user_id):
+        for i in range(num_citas // usuarios):
+            momento = base + timedelta(hours=i * 3)
+            yield momento.strftime("%Y-%m-%d"), momento.strftime("%H:%M"), 60, f"Reunión {user_id}-{i} proyecto Acme"
+
+    inicio = time.perf_counter()
+    for user_id in range(usuarios):
+        repo.crear_varios(user_id, eventos(user_id))
+    print(f"  {'crear_varios (total)':<28} {time.perf_counter() - inicio:10.3f} s")
+
+    dias = num_citas // usuarios * 3 // 24
+    def fecha(i):
+        return (base + timedelta(days=i % dias)).strftime("%Y-%m-%d")
+
+    medir("rango (1 semana)", lambda i: repo.rango(i % usuarios, fecha(i), fecha(i + 6)), 500)
+    medir("solapamientos", lambda i: repo.solapamientos(i % usuarios, fecha(i), "09:30", 60), 500)
+    medir("crear", lambda i: repo.crear(usuarios + i, fecha(i), "10:00", "Nueva"), 200)
+    medir("buscar", lambda i: repo.buscar(i % usuarios, "acme", 10), 50)
+    medir("desplazar (1 semana)", lambda i: repo.desplazar(i % usuarios, 0, fecha(i), fecha(i + 6)), 100)
+
+
+if __name__ == "__main__":
+    num_citas = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    with tempfile.TemporaryDirectory() as carpeta:
+        fabricas = {
+            "SQLite": lambda nombre: RepositorioSQLite(os.path.join(carpeta, nombre)),
+            "Memoria": lambda nombre: RepositorioMemoria(),
+        }
+        for nombre, fabrica in fabricas.items():
+            comprobar(fabrica("comprobacion.db"))
+            print(f"✅ {nombre}: comprobaciones superadas")
+        for nombre, fabrica in fabricas.items():
+            print(f"⏱️ {nombre} ({num_citas} citas):")
+            benchmark(fabrica("benchmark.db"), num_citas)
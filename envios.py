@@ -0,0 +1,263 @@
+# --- COLA DE SALIDA HACIA TELEGRAM ---
+# Telegram admite unos 30 mensajes/s en total y 1 mensaje/s por chat (20/min en grupos); si se superan,
+# responde 429 con un retry_after y deja de aceptar mensajes un rato.
+# ColaSalida es el rate limiter del bot (ApplicationBuilder().rate_limiter): por ella pasan TODAS las
+# peticiones que envían algo a un chat (reply_text, send_message, edit_message_text, send_document...),
+# así que los handlers no tienen que hacer nada especial.
+#   * Cubo de fichas global y uno por chat. Las peticiones esperan su turno en un montículo ordenado
+#     por prioridad: las respuestas interactivas adelantan a los avisos y estos a los envíos de fondo.
+#   * Ante un RetryAfter se para toda la cola el tiempo indicado y la petición se reintenta la primera.
+#   * Se mide cuánto espera cada petición en la cola, por prioridad (y cada petición es un tramo de la traza).
+# EnviosFondo reparte los mensajes masivos (resúmenes diarios) sin crear una tarea por mensaje.
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+
+from telegram.error import RetryAfter, TelegramError
+from telegram.ext import BaseRateLimiter
+
+import metricas
+import trazas
+from mensajes import dividir_mensaje
+
+logger = logging.getLogger(__name__)
+
+# Prioridades (rate_limit_args de los métodos del bot); sin indicar nada, la petición es interactiva
+PRIORIDAD_INTERACTIVA = 0
+PRIORIDAD_AVISO = 1
+PRIORIDAD_FONDO = 2
+NOMBRES_PRIORIDAD = {PRIORIDAD_INTERACTIVA: "interactiva", PRIORIDAD_AVISO: "aviso", PRIORIDAD_FONDO: "fondo"}
+
+# Peticiones con chat_id que no cuentan para los límites de mensajes
+SIN_LIMITE = {"sendChatAction", "getChat", "getChatMember", "answerCallbackQuery"}
+
+ESPERA_SALIDA = metricas.histograma("salida_espera_segundos", "Tiempo en la cola de salida antes de enviar a Telegram", ["prioridad"])
+AVISOS_429 = metricas.contador("salida_429_total", "Respuestas 429 (RetryAfter) de Telegram")
+
+
+class Cubo:
+    # Cubo de fichas: 'ritmo' fichas por segundo, como mucho 'capacidad' acumuladas
+
+    def __init__(self, ritmo, capacidad):
+        self.ritmo = ritmo
+        self.capacidad = capacidad
+        self.fichas = float(capacidad)
+        self.momento = time.monotonic()
+
+    def _reponer(self, ahora):
+        self.fichas = min(self.capacidad, self.fichas + (ahora - self.momento) * self.ritmo)
+        self.momento = ahora
+
+    def espera(self, ahora):
+        # Segundos hasta que haya una ficha (0 si ya la hay)
+        self._reponer(ahora)
+        return 0.0 if self.fichas >= 1 else (1 - self.fichas) / self.ritmo
+
+    def tomar(self):
+        self.fichas -= 1
+
+    def lleno(self, ahora):
+        self._reponer(ahora)
+        return self.fichas >= self.capacidad
+
+
+class ColaSalida(BaseRateLimiter):
+
+    def __init__(self, por_segundo=25, por_chat=1.0, rafaga_chat=3, por_minuto_grupo=20, reintentos=3):
+        self.por_chat = por_chat
+        self.rafaga_chat = rafaga_chat
+        self.por_minuto_grupo = por_minuto_grupo
+        self.reintentos = reintentos
+        self.esperas_429 = 0
+        self.retrasos = {}  # prioridad -> [peticiones, segundos en cola, máximo]
+        # Sin ráfagas globales: Telegram cuenta en ventanas deslizantes y una ráfaga llena duplicaría el ritmo
+        self._global = Cubo(por_segundo, 1)
+        self._chats = {}  # chat_id -> Cubo
+        self._monticulo = []  # (prioridad, secuencia, chat_id, futuro)
+        self._secuencia = itertools.count()
+        self._pausa_hasta = 0.0
+        self._aviso = None
+        self._tarea = None
+
+    # Sin __len__: ExtBot comprueba "if not self.rate_limiter" y una cola vacía se tomaría por ausente
+    @property
+    def pendientes(self):
+        return len(self._monticulo)
+
+    @property
+    def chats_recientes(self):
+        # Chats con el cubo de fichas en uso (se olvidan cuando la cola se vacía y el cubo se llena)
+        return len(self._chats)
+
+    async def initialize(self):
+        # La aplicación y el updater inicializan el bot cada uno: la segunda vez no hay que crear otra tarea
+        if self._tarea is not None:
+            return
+        self._aviso = asyncio.Event()
+        self._tarea = asyncio.create_task(self._repartir())
+
+    async def shutdown(self):
+        if self._tarea:
+            self._tarea.cancel()
+            try:
+                await self._tarea
+            except asyncio.CancelledError:
+                pass
+            self._tarea = None
+        for *_, futuro in self._monticulo:
+            futuro.cancel()
+        self._monticulo = []
+
+    def _cubo(self, chat_id):
+        cubo = self._chats.get(chat_id)
+        if cubo is None:
+            # Los grupos y canales (chat_id negativo o @nombre) tienen un límite por minuto
+            grupo = isinstance(chat_id, str) or chat_id < 0
+            ritmo, capacidad = (self.por_minuto_grupo / 60, 1) if grupo else (self.por_chat, self.rafaga_chat)
+            cubo = self._chats[chat_id] = Cubo(ritmo, capacidad)
+        return cubo
+
+    async def _turno(self, prioridad, secuencia, chat_id):
+        futuro = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._monticulo, (prioridad, secuencia, chat_id, futuro))
+        self._aviso.set()
+        encolado = time.monotonic()
+        await futuro
+        retraso = time.monotonic() - encolado
+        estadistica = self.retrasos.setdefault(prioridad, [0, 0.0, 0.0])
+        estadistica[0] += 1
+        estadistica[1] += retraso
+        estadistica[2] = max(estadistica[2], retraso)
+        ESPERA_SALIDA.observar(retraso, NOMBRES_PRIORIDAD.get(prioridad, str(prioridad)))
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        chat_id = data.get("chat_id")
+        if chat_id is None or endpoint in SIN_LIMITE or self._tarea is None:
+            with trazas.tramo(endpoint, "telegram"):
+                return await callback(*args, **kwargs)
+
+        prioridad = rate_limit_args if isinstance(rate_limit_args, int) else PRIORIDAD_INTERACTIVA
+        # La secuencia se conserva en los reintentos: la petición vuelve a su sitio en la cola
+        secuencia = next(self._secuencia)
+        for intento in range(self.reintentos + 1):
+            with trazas.tramo("cola_salida", "telegram", prioridad=NOMBRES_PRIORIDAD.get(prioridad, prioridad)):
+                await self._turno(prioridad, secuencia, chat_id)
+            try:
+                with trazas.tramo(endpoint, "telegram", intento=intento):
+                    return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                segundos = e.retry_after.total_seconds() if hasattr(e.retry_after, "total_seconds") else e.retry_after
+                self.esperas_429 += 1
+                AVISOS_429.inc()
+                self._pausa_hasta = max(self._pausa_hasta, time.monotonic() + segundos)
+                logger.warning(f"Telegram pide esperar {segundos} s ({endpoint} a {chat_id}); {len(self._monticulo)} peticiones en cola.")
+                if intento == self.reintentos:
+                    raise
+
+    def _siguiente(self, ahora):
+        # Saca la petición más prioritaria cuyo chat tenga ficha; si no hay ninguna, devuelve cuánto esperar
+        saltadas = []
+        elegida, espera = None, None
+        while self._monticulo:
+            entrada = heapq.heappop(self._monticulo)
+            if entrada[3].cancelled():
+                continue
+            espera_chat = self._cubo(entrada[2]).espera(ahora)
+            if not espera_chat:
+                elegida = entrada
+                break
+            saltadas.append(entrada)
+            espera = espera_chat if espera is None else min(espera, espera_chat)
+        for entrada in saltadas:
+            heapq.heappush(self._monticulo, entrada)
+        return elegida, espera
+
+    async def _esperar(self, segundos):
+        # Espera, pero se despierta si llega una petición nueva que podría salir antes
+        self._aviso.clear()
+        try:
+            await asyncio.wait_for(self._aviso.wait(), timeout=segundos)
+        except asyncio.TimeoutError:
+            pass
+
+    async def _repartir(self):
+        while True:
+            if not self._monticulo:
+                # Cola vacía: olvidamos los chats con el cubo lleno, para que el diccionario no crezca sin límite
+                ahora = time.monotonic()
+                self._chats = {chat: cubo for chat, cubo in self._chats.items() if not cubo.lleno(ahora)}
+                await self._esperar(None)
+                continue
+            ahora = time.monotonic()
+            espera = max(self._pausa_hasta - ahora, self._global.espera(ahora))
+            if espera > 0:
+                await self._esperar(espera)
+                continue
+            elegida, espera = self._siguiente(ahora)
+            if elegida is None:
+                if espera is not None:
+                    await self._esperar(espera)
+                continue
+            self._global.tomar()
+            self._cubo(elegida[2]).tomar()
+            elegida[3].set_result(None)
+
+    def describir(self):
+        # "interactiva 12 ms (máx 80 ms), fondo ..." con el retraso medio en cola de cada prioridad
+        partes = []
+        for prioridad, (total, suma, maximo) in sorted(self.retrasos.items()):
+            nombre = NOMBRES_PRIORIDAD.get(prioridad, str(prioridad))
+            partes.append(f"{nombre} {suma / total * 1000:.0f} ms (máx {maximo * 1000:.0f} ms)")
+        return ", ".join(partes)
+
+
+class EnviosFondo:
+    # Mensajes sin prisa (resúmenes diarios). Como mucho 'en_vuelo' esperan a la vez en la ColaSalida,
+    # así los miles de resúmenes de las 08:00 no llenan la cola ni retrasan las respuestas interactivas.
+
+    def __init__(self, en_vuelo=8, prioridad=PRIORIDAD_FONDO):
+        self.en_vuelo = en_vuelo
+        self.prioridad = prioridad
+        self.enviados = 0
+        self.fallidos = 0
+        self._pendientes = None  # se crea en iniciar(), ya dentro del bucle de eventos
+        self._tareas = []
+
+    def __len__(self):
+        return self._pendientes.qsize() if self._pendientes else 0
+
+    def encolar(self, chat_id, texto, **opciones):
+        if self._pendientes is None:
+            raise RuntimeError("EnviosFondo.encolar() antes de iniciar(): no hay trabajadores que envíen el mensaje")
+        self._pendientes.put_nowait((chat_id, texto, opciones))
+
+    def iniciar(self, bot):
+        self._pendientes = asyncio.Queue()
+        self._tareas = [asyncio.create_task(self._enviar(bot)) for _ in range(self.en_vuelo)]
+
+    async def detener(self):
+        for tarea in self._tareas:
+            tarea.cancel()
+        await asyncio.gather(*self._tareas, return_exceptions=True)
+        self._tareas = []
+        if len(self):
+            logger.warning(f"Se descartan {len(self)} envíos pendientes al detener el bot.")
+
+    async def _enviar(self, bot):
+        while True:
+            chat_id, texto, opciones = await self._pendientes.get()
+            try:
+                # Las partes de un mensaje largo salen en orden desde el mismo trabajador
+                for parte in dividir_mensaje(texto, markdown=(opciones.get("parse_mode") or "").lower() == "markdown"):
+                    await bot.send_message(chat_id=chat_id, text=parte, rate_limit_args=self.prioridad, **opciones)
+                self.enviados += 1
+            except TelegramError as e:
+                # Usuario que bloqueó el bot, chat inexistente, 429 tras agotar los reintentos...
+                self.fallidos += 1
+                logger.warning(f"No se pudo enviar el mensaje a {chat_id}: {e}")
+            except Exception:
+                # Un fallo inesperado (texto mal formado, error de red no traducido...) no debe matar al trabajador
+                self.fallidos += 1
+                logger.exception(f"Error inesperado al enviar el mensaje a {chat_id}")
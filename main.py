@@ -1,12 +1,23 @@
 import os
+import asyncio
+import bisect
+import csv
+import glob
+import gzip
+import itertools
+import shutil
+import tempfile
+import time
 import logging
-import requests
-import sqlite3
 import json
 import locale
 import re
+import secrets
 import httpx
-from datetime import datetime
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo
 from dotenv import load_dotenv
 import dateparser
 from dateparser.search import search_dates  
@@ -18,9 +29,28 @@ from telegram import (
     KeyboardButton        
 )
 from telegram.constants import ChatAction
-from telegram.ext import ApplicationBuilder, CommandHandler, ContextTypes, MessageHandler, filters, CallbackQueryHandler
+from telegram.error import TelegramError
+from telegram.helpers import escape_markdown
+from telegram.ext import ApplicationBuilder, CommandHandler, ContextTypes, MessageHandler, filters, CallbackQueryHandler, TypeHandler
+from almacenamiento import (
+    ASUNTO_MAXIMO, DURACION_MAXIMA, DURACION_POR_DEFECTO, PREFIJO_RECURRENCIA, ColaEscritura, RepositorioCitas, construir_consulta_fts,
+    crear_repositorio, expandir_regla, ventana_solapamiento
+)
+import metricas
+import trazas
+from envios import PRIORIDAD_AVISO, ColaSalida, EnviosFondo
+from memoria import MonitorMemoria, formatear_bytes, memoria_trazada
+from mensajes import responder
+from perfilador import PerfiladorMuestreo
+from procesador import ProcesadorPorUsuario
+from recordatorios import PlanificadorRecordatorios
+from vigilancia import VigilanteBucle
 
-HISTORIAL = []
+# Chat libre: cada usuario tiene su propio historial con sus últimas líneas (se descartan las más antiguas)
+# y solo se recuerda el de los HISTORIAL_USUARIOS que han hablado más recientemente (LRU)
+HISTORIAL_LINEAS = 10
+HISTORIAL_USUARIOS = 1000
+HISTORIAL = OrderedDict()  # user_id -> deque de líneas "U: ..." / "A: ...", en orden de uso
 # --- 1. CONFIGURACIÓN E INICIALIZACIÓN ---
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -39,80 +69,146 @@ TOKEN = os.getenv("TELEGRAM_TOKEN")
 MODEL_NAME = os.getenv("MODEL_NAME", "mistral:7b")
 OLLAMA_URL = os.getenv("OLLAMA_URL", "http://127.0.0.1:11434/api/generate")
 
+DIAS_SEMANA = ["lunes", "martes", "miércoles", "jueves", "viernes", "sábado", "domingo"]
+
+# Jornada laboral para la búsqueda de huecos libres (lunes a viernes)
+JORNADA_INICIO = datetime.strptime(os.getenv("JORNADA_INICIO", "09:00"), "%H:%M").time()
+JORNADA_FIN = datetime.strptime(os.getenv("JORNADA_FIN", "18:00"), "%H:%M").time()
+HUECOS_MAXIMOS = 5
+MAX_DIAS_COORDINAR = 90  # cada día de cada participante es un mapa de ocupación en caché
+
+# Búsqueda de texto (/buscar)
+RESULTADOS_POR_PAGINA = 10
+
+# Importación de calendarios: citas por cada escritura que se encola
+IMPORTACION_LOTE = 500
+
+# Archivo de citas pasadas: se sacan de la tabla 'citas' pasados estos días
+ARCHIVO_RETENCION_DIAS = int(os.getenv("ARCHIVO_RETENCION_DIAS", "7"))
+ARCHIVO_INTERVALO_HORAS = float(os.getenv("ARCHIVO_INTERVALO_HORAS", "6"))
+ARCHIVO_LOTE = 500
+
+# Copias de seguridad en caliente (comprimidas y rotadas) de la base de datos
+COPIAS_DIR = os.getenv("COPIAS_DIR", "backups")
+COPIAS_INTERVALO_HORAS = float(os.getenv("COPIAS_INTERVALO_HORAS", "24"))
+COPIAS_CONSERVAR = int(os.getenv("COPIAS_CONSERVAR", "7"))
+COPIAS_PAGINAS_POR_PASO = 256
+COPIAS_PAUSA = 0.01  # segundos entre pasos, para dejar pasar a los escritores
+ULTIMA_COPIA = {}  # "fecha", "duracion", "tamano" y "archivo" de la última copia hecha por este proceso
+
+# Recordatorios: se avisa estos minutos antes de cada cita (0 los desactiva)
+RECORDATORIO_MINUTOS = int(os.getenv("RECORDATORIO_MINUTOS", "15"))
+RECORDATORIO_VENTANA_HORAS = 24  # tramo de citas que se carga de una vez en el montículo
+
+# Cola de salida: mensajes por segundo hacia Telegram en total (admite unos 30; dejamos margen)
+SALIDA_POR_SEGUNDO = float(os.getenv("SALIDA_POR_SEGUNDO", "25"))
+
+# Resumen diario
+RESUMEN_RECUPERAR_MINUTOS = 60  # si el trabajo se retrasa, se envían los resúmenes de los minutos perdidos hasta este límite
+
+# Concurrencia: actualizaciones de usuarios distintos que se atienden a la vez (las de un mismo usuario, en orden)
+# y generaciones simultáneas en Ollama (las demás esperan turno)
+ACTUALIZACIONES_SIMULTANEAS = int(os.getenv("ACTUALIZACIONES_SIMULTANEAS", "16"))
+LLM_SIMULTANEAS = int(os.getenv("LLM_SIMULTANEAS", "4"))
+LLM_SEMAFORO = asyncio.Semaphore(LLM_SIMULTANEAS)
+GENERACIONES = {}  # user_id -> tarea con la respuesta del chat libre que se está generando
+# Un solo cliente HTTP para Ollama: crear uno por consulta carga los certificados cada vez (megas de memoria
+# y milisegundos de bucle bloqueado)
+CLIENTE_OLLAMA = {"cliente": None}
+LLM_EN_COLA = metricas.indicador("llm_en_cola", "Consultas al LLM esperando turno")
+LLM_GENERANDO = metricas.indicador("llm_generando", "Generaciones en curso en Ollama")
+LLM_SEGUNDOS = metricas.histograma("llm_segundos", "Duración de cada generación (sin la espera de turno)")
+LLM_CANCELADAS = metricas.contador("llm_canceladas_total", "Generaciones canceladas por un mensaje más reciente")
+
+# Métricas en formato Prometheus en http://METRICAS_HOST:METRICAS_PUERTO/metrics (0 las desactiva)
+METRICAS_PUERTO = int(os.getenv("METRICAS_PUERTO", "0"))
+METRICAS_HOST = os.getenv("METRICAS_HOST", "127.0.0.1")
+
+# Vigilancia del bucle de eventos: se avisa (con la pila) cuando algo lo bloquea más de estos milisegundos (0 la desactiva)
+BLOQUEO_UMBRAL_MS = int(os.getenv("BLOQUEO_UMBRAL_MS", "250"))
+
+# Trazas: fracción de actualizaciones que se trazan (0 desactiva, 1 todas) y archivo donde se guardan
+TRAZAS_MUESTREO = float(os.getenv("TRAZAS_MUESTREO", "0"))
+TRAZAS_ARCHIVO = os.getenv("TRAZAS_ARCHIVO", "trazas.json")
+
+# Administradores: ids de Telegram separados por comas que pueden usar /perfil
+ADMIN_IDS = {int(i) for i in os.getenv("ADMIN_IDS", "").replace(" ", "").split(",") if i}
+PERFIL_SEGUNDOS_MAX = 600  # duración máxima de una muestra del perfilador
+
+# Memoria: cada cuántos minutos se toma una muestra (RSS, estructuras globales y, si se activa, tracemalloc)
+# y cuántos marcos de pila guarda tracemalloc por reserva (0 lo desactiva: ralentiza todas las reservas)
+MEMORIA_INTERVALO_MINUTOS = float(os.getenv("MEMORIA_INTERVALO_MINUTOS", "5"))
+MEMORIA_TRACEMALLOC = int(os.getenv("MEMORIA_TRACEMALLOC", "0"))
+
+# Modo de servidor: "polling" (por defecto) o "webhook" (Telegram nos empuja las actualizaciones por HTTPS)
+MODO_SERVIDOR = os.getenv("MODO_SERVIDOR", "polling").lower()
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")  # URL pública (https://...) que llega a este servidor
+WEBHOOK_RUTA = os.getenv("WEBHOOK_RUTA", "telegram")
+WEBHOOK_ESCUCHAR = os.getenv("WEBHOOK_ESCUCHAR", "0.0.0.0")
+WEBHOOK_PUERTO = int(os.getenv("WEBHOOK_PUERTO", "8443"))
+WEBHOOK_SECRETO = os.getenv("WEBHOOK_SECRETO", "")  # Telegram lo manda en cada petición; las que no lo traen se rechazan
+WEBHOOK_MAX_CONEXIONES = int(os.getenv("WEBHOOK_MAX_CONEXIONES", "40"))
+WEBHOOK_CERTIFICADO = os.getenv("WEBHOOK_CERTIFICADO")  # solo si el puerto se expone sin proxy con certificado propio
+WEBHOOK_CLAVE = os.getenv("WEBHOOK_CLAVE")
+
 # --- 2. BASE DE DATOS ---
-def init_db():
-    conn = sqlite3.connect('meetmanager.db')
-    c = conn.cursor()
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS citas (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER,
-            fecha TEXT,
-            hora TEXT,
-            asunto TEXT
-        )
-    ''')
-    
-    conn.commit()
-    conn.close()
-
-
-def guardar_cita_db(user_id, fecha, hora, asunto):
-    conn = sqlite3.connect('meetmanager.db')
-    c = conn.cursor()
-    # Verifica si ya existe para no duplicar al crear
-    c.execute("SELECT * FROM citas WHERE user_id=? AND fecha=? AND hora=?", (user_id, fecha, hora))
-    if c.fetchone():
-        conn.close()
-        return False
-    c.execute("INSERT INTO citas (user_id, fecha, hora, asunto) VALUES (?, ?, ?, ?)", (user_id, fecha, hora, asunto))
-    conn.commit()
-    conn.close()
-    return True
-
-def eliminar_cita_db(user_id, fecha):
-    conn = sqlite3.connect('meetmanager.db')
-    c = conn.cursor()
-    # Ejecutamos el borrado real
-    c.execute("DELETE FROM citas WHERE user_id=? AND fecha=?", (user_id, fecha))
-    # rowcount nos dice cuántas filas se borraron
-    borrados = c.rowcount
-    conn.commit()
-    conn.close()
-    return borrados > 0
-
-def obtener_citas_db(user_id):
-    conn = sqlite3.connect('meetmanager.db')
-    c = conn.cursor()
-    c.execute("SELECT fecha, hora, asunto FROM citas WHERE user_id=? ORDER BY fecha, hora", (user_id,))
-    data = c.fetchall()
-    conn.close()
-    return data
-
-
-def limpiar_todo_db(user_id):
-    conn = sqlite3.connect('meetmanager.db')
-    c = conn.cursor()
-    
-    # 1. Borramos las citas del usuario
-    c.execute("DELETE FROM citas WHERE user_id=?", (user_id,))
-    
-    # 2. LÓGICA DE REINICIO DE ID
-    # Verificamos si la tabla 'citas' está completamente vacía (sin datos de nadie)
-    c.execute("SELECT COUNT(*) FROM citas")
-    total_filas = c.fetchone()[0]
-    
-    if total_filas == 0:
-        # Si no queda nada, borramos la memoria del contador para que empiece en 1
-        c.execute("DELETE FROM sqlite_sequence WHERE name='citas'")
-    
-    conn.commit()
-    conn.close()
+# Todo el acceso a datos pasa por el repositorio (almacenamiento.py).
+# ALMACENAMIENTO=memoria arranca sin disco (útil para pruebas); por defecto se usa SQLite.
+REPO = crear_repositorio(os.getenv("ALMACENAMIENTO", "sqlite"), os.getenv("DB_RUTA", "meetmanager.db"))
+# Las escrituras de los handlers pasan por una cola con un único escritor que las confirma en grupo
+# (un commit para todas las que llegan a la vez). Las lecturas van directas al repositorio.
+# Cada operación del repositorio se mide (histograma por nombre de operación) y es un tramo de la traza en curso
+OPERACIONES_REPO = sorted(RepositorioCitas.__abstractmethods__ | {"agenda", "ocurrencias", "solapamientos_recurrentes", "respaldar"})
+DB_SEGUNDOS = metricas.histograma("db_segundos", "Duración de cada operación del repositorio", ["operacion"])
+metricas.instrumentar(REPO, DB_SEGUNDOS, OPERACIONES_REPO)
+trazas.instrumentar(REPO, OPERACIONES_REPO, "db")
+ESCRITURAS = ColaEscritura(
+    REPO,
+    max_lote=int(os.getenv("ESCRITURA_LOTE_MAX", "64")),
+    espera=float(os.getenv("ESCRITURA_ESPERA_MS", "2")) / 1000
+)
 
 # --- 3. FUNCIONES DE FECHA Y IA ---
+# "durante 2 horas", "por 45 min", "30 minutos", "1.5 horas"...
+# Un "10h" suelto no cuenta: en español suele ser una hora del día ("a las 10h")
+PATRON_DURACION = re.compile(
+    r'\b(?:(?:durante|por)\s+(\d+(?:[.,]\d+)?)\s*(h|hrs?|horas?|m|min|mins|minutos?)'
+    r'|(\d+(?:[.,]\d+)?)\s*(min|mins|minutos?|horas?))\b'
+)
+
+def minutos_de_duracion(cantidad, unidad):
+    minutos = float(cantidad.replace(",", "."))
+    if unidad.startswith("h"):
+        minutos *= 60
+    return int(round(minutos))
+
+def parsear_duracion(texto):
+    # Para argumentos sueltos: "30", "30m", "45min", "1h", "1.5h", "2horas" -> minutos
+    match = re.fullmatch(r'(\d+(?:[.,]\d+)?)\s*(h|hrs?|horas?|m|min|mins|minutos?)?', texto.strip().lower())
+    if not match:
+        return None
+    minutos = minutos_de_duracion(match.group(1), match.group(2) or "m")
+    if minutos <= 0 or minutos > DURACION_MAXIMA:
+        return None
+    return minutos
+
+def hora_fin(fecha, hora, duracion):
+    inicio = datetime.strptime(f"{fecha} {hora}", "%Y-%m-%d %H:%M")
+    return (inicio + timedelta(minutes=duracion or DURACION_POR_DEFECTO)).strftime("%H:%M")
+
 def extraer_datos_cita(texto_usuario):
     ahora = datetime.now()
     
+    # 0. Sacamos la duración antes de buscar la fecha ("30 min" no es una fecha)
+    duracion = DURACION_POR_DEFECTO
+    texto_usuario = texto_usuario.lower()
+    match_duracion = PATRON_DURACION.search(texto_usuario)
+    if match_duracion:
+        cantidad = match_duracion.group(1) or match_duracion.group(3)
+        unidad = match_duracion.group(2) or match_duracion.group(4)
+        duracion = minutos_de_duracion(cantidad, unidad)
+        texto_usuario = texto_usuario[:match_duracion.start()] + " " + texto_usuario[match_duracion.end():]
+
     # 1. TRUCO DE MAGIA: Convertir "1 pm" a "13:00" manualmente con Regex
     def convertir_hora(match):
         hora_num = int(match.group(1))
@@ -134,7 +230,9 @@ def extraer_datos_cita(texto_usuario):
         resultados = search_dates(
             texto_procesado, 
             languages=['es'], 
-            settings={'RELATIVE_BASE': ahora, 'PREFER_DATES_FROM': 'future'}
+            # dateparser guarda cachés por cada combinación de ajustes: con la base al minuto (y pocas
+            # entradas) no se crea una nueva en cada llamada, que es lo que pasaba con datetime.now()
+            settings={'RELATIVE_BASE': ahora.replace(second=0, microsecond=0), 'PREFER_DATES_FROM': 'future', 'CACHE_SIZE_LIMIT': 16}
         )
         
         if resultados:
@@ -160,9 +258,91 @@ def extraer_datos_cita(texto_usuario):
     
     asunto = " ".join(asunto.split()).strip().capitalize() or "Reunión"
 
-    return {"fecha": fecha_db, "hora": hora, "asunto": asunto}
+    return {"fecha": fecha_db, "hora": hora, "asunto": asunto, "duracion": duracion}
+
+def calcular_rango(args):
+    # Traduce "hoy", "mañana", "semana", "mes" o "YYYY-MM-DD [YYYY-MM-DD]" a un rango de fechas.
+    # Devuelve (fecha_ini, fecha_fin, argumentos_consumidos) o None si no se reconoce.
+    if not args:
+        return None
+    hoy = datetime.now().date()
+    clave = args[0].lower()
+
+    if clave == "hoy":
+        ini, fin, usados = hoy, hoy, 1
+    elif clave in ("mañana", "manana"):
+        ini = fin = hoy + timedelta(days=1)
+        usados = 1
+    elif clave == "semana":
+        # Los próximos 7 días, empezando hoy
+        ini, fin, usados = hoy, hoy + timedelta(days=6), 1
+    elif clave == "mes":
+        # Los próximos 30 días, empezando hoy
+        ini, fin, usados = hoy, hoy + timedelta(days=29), 1
+    else:
+        try:
+            ini = datetime.strptime(args[0], "%Y-%m-%d").date()
+        except ValueError:
+            return None
+        fin, usados = ini, 1
+        if len(args) > 1:
+            try:
+                fin = datetime.strptime(args[1], "%Y-%m-%d").date()
+                usados = 2
+            except ValueError:
+                pass
+        if fin < ini:
+            ini, fin = fin, ini
+
+    return ini.strftime("%Y-%m-%d"), fin.strftime("%Y-%m-%d"), usados
+
+def formatear_duracion(minutos):
+    horas, resto = divmod(int(minutos), 60)
+    if not horas:
+        return f"{resto} min"
+    return f"{horas}h {resto:02d}min" if resto else f"{horas}h"
 
-def consultar_chat_libre(mensaje, system_extra=""):
+def redondear_cuarto_hora(momento):
+    # Redondea hacia arriba al siguiente múltiplo de 15 minutos (10:37 -> 10:45)
+    momento = momento.replace(second=0, microsecond=0)
+    exceso = momento.minute % 15
+    return momento + timedelta(minutes=15 - exceso) if exceso else momento
+
+def calcular_huecos(ocupados, fecha_ini, fecha_fin, duracion, limite=HUECOS_MAXIMOS, desde=None):
+    # Barrido sobre los intervalos ocupados [(inicio, fin), ...] ordenados por inicio.
+    # Devuelve hasta 'limite' intervalos libres (inicio, fin) de al menos 'duracion' minutos
+    # dentro de la jornada laboral, recorriendo cada cita una sola vez.
+    huecos = []
+    minimo = timedelta(minutes=duracion)
+    i = 0
+    fin_max = datetime.min  # Fin más tardío de las citas ya barridas (las que vienen de días anteriores)
+    dia = fecha_ini
+    while dia <= fecha_fin and len(huecos) < limite:
+        jornada_ini = datetime.combine(dia, JORNADA_INICIO)
+        jornada_fin = datetime.combine(dia, JORNADA_FIN)
+        # Las citas que empezaron antes de la jornada solo importan por su hora de fin
+        while i < len(ocupados) and ocupados[i][0] < jornada_ini:
+            fin_max = max(fin_max, ocupados[i][1])
+            i += 1
+
+        if dia.weekday() < 5:
+            cursor = max(jornada_ini, fin_max)
+            if desde:
+                cursor = max(cursor, desde)
+            j = i
+            while j < len(ocupados) and ocupados[j][0] < jornada_fin and len(huecos) < limite:
+                inicio, fin = ocupados[j]
+                if inicio - cursor >= minimo:
+                    huecos.append((cursor, inicio))
+                cursor = max(cursor, fin)
+                j += 1
+            if jornada_fin - cursor >= minimo and len(huecos) < limite:
+                huecos.append((cursor, jornada_fin))
+
+        dia += timedelta(days=1)
+    return huecos
+
+async def consultar_chat_libre(mensaje, system_extra=""):
     dias_semana = ["lunes", "martes", "miércoles", "jueves", "viernes", "sábado", "domingo"]
     meses_year = ["", "enero", "febrero", "marzo", "abril", "mayo", "junio", "julio", "agosto", "septiembre", "octubre", "noviembre", "diciembre"]
     
@@ -179,91 +359,438 @@ def consultar_chat_libre(mensaje, system_extra=""):
         f"{system_extra}"
     )
    
-    payload = {"model": MODEL_NAME, "prompt": mensaje, "system": system, "stream": False}
+    # En streaming: si la tarea se cancela, al salir del "async with" se cierra la conexión y Ollama deja de generar
+    payload = {"model": MODEL_NAME, "prompt": mensaje, "system": system, "stream": True}
 
     print(f"⏳ Intentando conectar con: {OLLAMA_URL}") 
     print(f"📦 Modelo solicitado: {MODEL_NAME}")
 
     try:
-        r = requests.post(OLLAMA_URL, json=payload, timeout=None)        
-        if r.status_code == 200:
-            return r.json().get("response", "Error: Respuesta vacía de Ollama.")
-        else:
-            print(f"❌ Error HTTP: {r.status_code} - {r.text}") 
-            return f"⚠️ Error interno de Ollama: {r.status_code}"
+        async with trazas.tramo("consultar_chat_libre", "llm"), turno_llm():
+            if CLIENTE_OLLAMA["cliente"] is None:
+                CLIENTE_OLLAMA["cliente"] = httpx.AsyncClient(timeout=httpx.Timeout(None, connect=10))
+            async with CLIENTE_OLLAMA["cliente"].stream("POST", OLLAMA_URL, json=payload) as r:
+                if r.status_code != 200:
+                    cuerpo = (await r.aread()).decode(errors="replace")
+                    print(f"❌ Error HTTP: {r.status_code} - {cuerpo}") 
+                    return f"⚠️ Error interno de Ollama: {r.status_code}"
+                trozos = []
+                async for linea in r.aiter_lines():
+                    if not linea:
+                        continue
+                    datos = json.loads(linea)
+                    trozos.append(datos.get("response", ""))
+                    if datos.get("done"):
+                        break
+        return "".join(trozos) or "Error: Respuesta vacía de Ollama."
 
     except Exception as e:
         print(f"❌ ERROR CRÍTICO DE CONEXIÓN: {e}") 
         return "⚠️ No puedo pensar ahora mismo (Mira la consola para ver el error)."
 
+@asynccontextmanager
+async def turno_llm():
+    # Espera un hueco en LLM_SEMAFORO y mide la cola y la generación
+    LLM_EN_COLA.inc()
+    try:
+        async with trazas.tramo("llm_cola", "llm"):
+            await LLM_SEMAFORO.acquire()
+    finally:
+        LLM_EN_COLA.dec()
+    LLM_GENERANDO.inc()
+    inicio = time.perf_counter()
+    try:
+        async with trazas.tramo("llm_generacion", "llm", modelo=MODEL_NAME):
+            yield
+    finally:
+        LLM_SEGUNDOS.observar(time.perf_counter() - inicio)
+        LLM_GENERANDO.dec()
+        LLM_SEMAFORO.release()
 
-def modificar_cita(id_cita, nueva_descripcion):
-    conn = sqlite3.connect('meetmanager.db')
-    c = conn.cursor()
-    
-    c.execute("UPDATE citas SET asunto=? WHERE id=?", (nueva_descripcion, id_cita))
-    
-    cambios = c.rowcount 
-    conn.commit()
-    conn.close()
-    return cambios > 0
-
-def reprogramar_cita_db(id_cita, fecha_new, hora_new):
-    conn = sqlite3.connect('meetmanager.db')
-    c = conn.cursor()
-    
-    # UPDATE sobrescribe fecha y hora en el registro existente.
-    # La fecha antigua se borra automáticamente.
-    c.execute("UPDATE citas SET fecha=?, hora=? WHERE id=?", (fecha_new, hora_new, id_cita))
-    
-    cambios = c.rowcount
-    conn.commit()
-    conn.close()
-    
-    if cambios > 0:
-        return "exito"
-    else:
-        return "no_encontrado"
-    
-async def reprogramar(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    args = context.args
-    if len(args) < 4:
-        await update.message.reply_text(
-            "⚠️ **Uso:** `/reprogramar [fecha_vieja] [hora_vieja] [fecha_nueva] [hora_nueva]`\n"
-            "Ej: `/reprogramar 2026-01-30 13:00 2026-02-05 16:00`",
-            parse_mode='Markdown'
-        )
+def cancelar_generacion_anterior(update):
+    # Lo llama el procesador de actualizaciones nada más llegar cada una, antes de esperar el turno del usuario:
+    # un mensaje de texto libre nuevo deja obsoleta la respuesta que se le esté generando
+    mensaje = update.message if isinstance(update, Update) else None
+    if not mensaje or not mensaje.text or mensaje.text.startswith("/") or not update.effective_user:
         return
+    if mensaje.text in BOTONES_MENU or "Ayuda" in mensaje.text:
+        return
+    tarea = GENERACIONES.get(update.effective_user.id)
+    if tarea and not tarea.done():
+        tarea.cancel()
+        LLM_CANCELADAS.inc()
+        logger.info(f"Generación cancelada: el usuario {update.effective_user.id} ha enviado un mensaje nuevo.")
 
-    # Extraemos los 4 datos
-    fecha_old, hora_old, fecha_new, hora_new = args[0], args[1], args[2], args[3]
-    user_id = update.effective_user.id
-    
-    resultado = reprogramar_cita_db(user_id, fecha_old, hora_old, fecha_new, hora_new)
-    
-    if resultado == "exito":
-        await update.message.reply_text(
-            f"🔄 **¡Cita movida!**\nLa reunión del `{fecha_old}` a las `{hora_old}` ahora es el `{fecha_new}` a las `{hora_new}`.",
-            parse_mode='Markdown'
-        )
+
+# --- Importación de calendarios (.ics / .csv) ---
+FORMATOS_FECHA_CSV = ["%Y-%m-%d", "%d/%m/%Y", "%m/%d/%Y", "%d-%m-%Y"]
+FORMATOS_HORA_CSV = ["%H:%M", "%H:%M:%S", "%I:%M %p", "%I:%M:%S %p"]
+COLUMNAS_FECHA = ["fecha", "start date", "fecha de inicio", "date"]
+COLUMNAS_HORA = ["hora", "start time", "hora de inicio", "time"]
+COLUMNAS_ASUNTO = ["asunto", "subject", "summary", "título", "titulo", "title"]
+COLUMNAS_DURACION = ["duracion", "duración", "duration"]
+COLUMNAS_HORA_FIN = ["hora fin", "hora de fin", "end time"]
+
+def normalizar_asunto(asunto):
+    asunto = " ".join((asunto or "").split()) or "Reunión"
+    # Mismo límite que /agendar para mantener la agenda ordenada
+    return asunto[:100]
+
+def normalizar_duracion(minutos):
+    if not minutos or minutos <= 0:
+        return DURACION_POR_DEFECTO
+    return min(int(minutos), DURACION_MAXIMA)
+
+def parsear_duracion_ics(valor):
+    # DURATION:PT1H30M, P1D...
+    match = re.fullmatch(r'P(?:(\d+)W)?(?:(\d+)D)?(?:T(?:(\d+)H)?(?:(\d+)M)?(?:(\d+)S)?)?', valor.strip().upper())
+    if not match:
+        return None
+    semanas, dias, horas, minutos, _ = (int(g) if g else 0 for g in match.groups())
+    return ((semanas * 7 + dias) * 24 + horas) * 60 + minutos
+
+def parsear_fecha_ics(valor, parametros):
+    # DTSTART puede venir como fecha (VALUE=DATE), hora local, hora con TZID o en UTC (sufijo Z)
+    valor = valor.strip()
+    if parametros.get("VALUE") == "DATE" or len(valor) == 8:
+        return datetime.strptime(valor[:8], "%Y%m%d")
+
+    momento = datetime.strptime(valor[:15], "%Y%m%dT%H%M%S")
+    if valor.endswith("Z"):
+        momento = momento.replace(tzinfo=timezone.utc)
+    elif "TZID" in parametros:
+        try:
+            momento = momento.replace(tzinfo=ZoneInfo(parametros["TZID"].strip('"')))
+        except Exception:
+            # TZID desconocido (p. ej. nombres de Windows): lo tratamos como hora local
+            return momento
     else:
-        await update.message.reply_text(
-            f"❌ **No se pudo mover:** No encontré ninguna cita exacta el `{fecha_old}` a las `{hora_old}`.\n"
-            "Revise su `/agenda` para copiar la fecha y hora exactamente igual.",
-            parse_mode='Markdown'
-        )
+        return momento
+    # Convertimos a la hora local del servidor, igual que el resto de la agenda
+    return momento.astimezone().replace(tzinfo=None)
+
+def separar_propiedad_ics(linea):
+    # "DTSTART;TZID=Europe/Madrid:20260301T100000" -> ("DTSTART", {"TZID": "Europe/Madrid"}, "20260301T100000")
+    if '"' not in linea:
+        cabecera, separador, valor = linea.partition(":")
+        if not separador:
+            return None, {}, ""
+    else:
+        # Los parámetros entre comillas pueden contener ':'
+        entre_comillas = False
+        for i, caracter in enumerate(linea):
+            if caracter == '"':
+                entre_comillas = not entre_comillas
+            elif caracter == ':' and not entre_comillas:
+                cabecera, valor = linea[:i], linea[i + 1:]
+                break
+        else:
+            return None, {}, ""
+
+    partes = cabecera.split(";")
+    parametros = {}
+    for parte in partes[1:]:
+        if "=" in parte:
+            clave, val = parte.split("=", 1)
+            parametros[clave.upper()] = val
+    return partes[0].upper(), parametros, valor
+
+def lineas_ics_desplegadas(archivo):
+    # En ICS las líneas largas se "pliegan": la continuación empieza por espacio o tabulador
+    pendiente = None
+    for linea in archivo:
+        linea = linea.rstrip("\r\n")
+        if linea[:1] in (" ", "\t") and pendiente is not None:
+            pendiente += linea[1:]
+            continue
+        if pendiente is not None:
+            yield pendiente
+        pendiente = linea
+    if pendiente is not None:
+        yield pendiente
+
+def leer_eventos_ics(ruta, estadisticas):
+    # Generador: lee el archivo línea a línea y devuelve cada VEVENT como (fecha, hora, asunto)
+    with open(ruta, encoding="utf-8-sig", errors="replace", newline="") as archivo:
+        evento = None
+        for linea in lineas_ics_desplegadas(archivo):
+            nombre, parametros, valor = separar_propiedad_ics(linea)
+            if nombre == "BEGIN" and valor.upper() == "VEVENT":
+                evento = {}
+            elif nombre == "END" and valor.upper() == "VEVENT" and evento is not None:
+                estadisticas["leidos"] += 1
+                if "inicio" not in evento or evento.get("cancelado"):
+                    estadisticas["descartados"] += 1
+                else:
+                    inicio = evento["inicio"]
+                    if "fin" in evento:
+                        duracion = (evento["fin"] - inicio).total_seconds() // 60
+                    else:
+                        duracion = evento.get("duracion")
+                    yield (
+                        inicio.strftime("%Y-%m-%d"), inicio.strftime("%H:%M"),
+                        normalizar_duracion(duracion), normalizar_asunto(evento.get("asunto"))
+                    )
+                evento = None
+            elif evento is not None:
+                if nombre == "DTSTART":
+                    try:
+                        evento["inicio"] = parsear_fecha_ics(valor, parametros)
+                    except ValueError:
+                        pass
+                elif nombre == "DTEND":
+                    try:
+                        evento["fin"] = parsear_fecha_ics(valor, parametros)
+                    except ValueError:
+                        pass
+                elif nombre == "DURATION":
+                    evento["duracion"] = parsear_duracion_ics(valor)
+                elif nombre == "SUMMARY":
+                    evento["asunto"] = (
+                        valor.replace("\\n", " ").replace("\\N", " ")
+                        .replace("\\,", ",").replace("\\;", ";").replace("\\\\", "\\")
+                    )
+                elif nombre == "STATUS" and valor.upper() == "CANCELLED":
+                    evento["cancelado"] = True
+
+def parsear_con_formatos(valor, formatos):
+    for formato in formatos:
+        try:
+            return datetime.strptime(valor.strip(), formato)
+        except ValueError:
+            continue
+    return None
+
+def leer_eventos_csv(ruta, estadisticas):
+    # Generador: acepta nuestras columnas (fecha, hora, asunto) y las de Outlook/Google (Subject, Start Date, Start Time)
+    with open(ruta, encoding="utf-8-sig", errors="replace", newline="") as archivo:
+        muestra = archivo.read(4096)
+        archivo.seek(0)
+        try:
+            dialecto = csv.Sniffer().sniff(muestra, delimiters=",;\t")
+        except csv.Error:
+            dialecto = csv.excel
+
+        lector = csv.DictReader(archivo, dialect=dialecto)
+        columnas = {(nombre or "").strip().lower(): nombre for nombre in (lector.fieldnames or [])}
+        col_fecha = next((columnas[c] for c in COLUMNAS_FECHA if c in columnas), None)
+        col_hora = next((columnas[c] for c in COLUMNAS_HORA if c in columnas), None)
+        col_asunto = next((columnas[c] for c in COLUMNAS_ASUNTO if c in columnas), None)
+        col_duracion = next((columnas[c] for c in COLUMNAS_DURACION if c in columnas), None)
+        col_hora_fin = next((columnas[c] for c in COLUMNAS_HORA_FIN if c in columnas), None)
+        if not col_fecha:
+            return
+
+        for fila in lector:
+            estadisticas["leidos"] += 1
+            fecha = parsear_con_formatos(fila.get(col_fecha) or "", FORMATOS_FECHA_CSV)
+            hora = parsear_con_formatos(fila.get(col_hora) or "00:00", FORMATOS_HORA_CSV) if col_hora else datetime.min
+            if not fecha or not hora:
+                estadisticas["descartados"] += 1
+                continue
+            asunto = fila.get(col_asunto) if col_asunto else None
 
-def buscar_citas_por_fecha_db(user_id, fecha):
-    conn = sqlite3.connect('meetmanager.db')
-    c = conn.cursor()
-    # Seleccionamos hora y asunto solo de esa fecha específica
-    c.execute("SELECT hora, asunto FROM citas WHERE user_id=? AND fecha=? ORDER BY hora", (user_id, fecha))
-    data = c.fetchall()
-    conn.close()
-    return data
+            duracion = None
+            if col_duracion and fila.get(col_duracion):
+                duracion = parsear_duracion(fila[col_duracion])
+            elif col_hora_fin and fila.get(col_hora_fin):
+                fin = parsear_con_formatos(fila[col_hora_fin], FORMATOS_HORA_CSV)
+                if fin:
+                    duracion = (fin - hora).total_seconds() // 60
+            yield fecha.strftime("%Y-%m-%d"), hora.strftime("%H:%M"), normalizar_duracion(duracion), normalizar_asunto(asunto)
+
+# --- Exportación de la agenda (.ics / .csv) ---
+def plegar_linea_ics(linea):
+    # RFC 5545: las líneas no deben pasar de 75 octetos; la continuación empieza con un espacio
+    partes = []
+    actual = ""
+    for caracter in linea:
+        if len((actual + caracter).encode("utf-8")) > 75:
+            partes.append(actual)
+            actual = " "
+        actual += caracter
+    partes.append(actual)
+    return "\r\n".join(partes) + "\r\n"
+
+def escapar_texto_ics(texto):
+    return texto.replace("\\", "\\\\").replace(";", "\\;").replace(",", "\\,").replace("\n", "\\n")
+
+def escribir_ics(filas, archivo):
+    sello = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+    archivo.write("BEGIN:VCALENDAR\r\nVERSION:2.0\r\nPRODID:-//MeetManager//ES\r\nCALSCALE:GREGORIAN\r\n")
+    total = 0
+    for cid, fecha, hora, duracion, asunto in filas:
+        inicio = datetime.strptime(f"{fecha} {hora}", "%Y-%m-%d %H:%M")
+        fin = inicio + timedelta(minutes=duracion or DURACION_POR_DEFECTO)
+        archivo.write("BEGIN:VEVENT\r\n")
+        archivo.write(f"UID:cita-{cid}@meetmanager\r\n")
+        archivo.write(f"DTSTAMP:{sello}\r\n")
+        archivo.write(f"DTSTART:{inicio.strftime('%Y%m%dT%H%M%S')}\r\n")
+        archivo.write(f"DTEND:{fin.strftime('%Y%m%dT%H%M%S')}\r\n")
+        archivo.write(plegar_linea_ics(f"SUMMARY:{escapar_texto_ics(asunto)}"))
+        archivo.write("END:VEVENT\r\n")
+        total += 1
+    archivo.write("END:VCALENDAR\r\n")
+    return total
+
+def escribir_csv(filas, archivo):
+    # Mismas columnas que acepta la importación, para poder ir y volver sin pérdidas
+    escritor = csv.writer(archivo)
+    escritor.writerow(["id", "fecha", "hora", "duracion", "asunto"])
+    total = 0
+    for fila in filas:
+        escritor.writerow(fila)
+        total += 1
+    return total
+
+def exportar_agenda(user_id, ruta, formato, fecha_ini=None, fecha_fin=None):
+    escritor = escribir_ics if formato == "ics" else escribir_csv
+    with open(ruta, "w", encoding="utf-8", newline="") as archivo:
+        return escritor(REPO.iterar(user_id, fecha_ini, fecha_fin), archivo)
+
+# --- Mapas de ocupación (coordinación entre usuarios) ---
+# Cada día de cada usuario se guarda como un entero de 96 bits: un bit por franja de 15 minutos
+# (bit 0 = 00:00-00:15). Cruzar 20 agendas durante un mes son unas cuantas operaciones OR por día.
+MINUTOS_FRANJA = 15
+FRANJAS_DIA = 24 * 60 // MINUTOS_FRANJA
+MAX_USUARIOS_EN_CACHE = 512
+MAX_DIAS_EN_CACHE = 120  # por usuario; de sobra para el rango máximo de /coordinar
+CACHE_OCUPACION = OrderedDict()  # user_id -> {fecha: bitmap}, en orden de uso (LRU)
+# Sube con cada invalidación: si cambia mientras se lee la DB en un hilo, lo leído puede estar ya viejo
+INVALIDACIONES_OCUPACION = 0
+CACHE_CONSULTAS = metricas.contador("cache_consultas_total", "Consultas a cachés por resultado", ["cache", "resultado"])
+
+def invalidar_ocupacion(user_id):
+    # Solo desde el bucle de eventos, como el resto de accesos a CACHE_OCUPACION (ver al_iniciar)
+    global INVALIDACIONES_OCUPACION
+    INVALIDACIONES_OCUPACION += 1
+    CACHE_OCUPACION.pop(user_id, None)
+
+def marcar_ocupado(mapas, inicio, fin):
+    # Marca las franjas que toca el intervalo [inicio, fin) en los días que ya estén en 'mapas'
+    dia = inicio.date()
+    while datetime.combine(dia, datetime.min.time()) < fin:
+        fecha = dia.strftime("%Y-%m-%d")
+        if fecha in mapas:
+            base = datetime.combine(dia, datetime.min.time())
+            primera = max(0, int((inicio - base).total_seconds() // 60) // MINUTOS_FRANJA)
+            # La última franja se redondea hacia arriba: una cita hasta las 10:20 ocupa la de 10:15
+            ultima = min(FRANJAS_DIA, -(-int((fin - base).total_seconds() // 60) // MINUTOS_FRANJA))
+            if ultima > primera:
+                mapas[fecha] |= ((1 << (ultima - primera)) - 1) << primera
+        dia += timedelta(days=1)
+
+async def mapas_ocupacion(user_id, fechas):
+    # Devuelve {fecha: bitmap} para las fechas pedidas, construyendo solo las que faltan en la caché.
+    # La caché solo se toca desde el bucle; la consulta a la DB va en un hilo
+    mapas = CACHE_OCUPACION.get(user_id, {})
+    faltan = sorted(f for f in fechas if f not in mapas)
+    CACHE_CONSULTAS.inc("ocupacion", "acierto", valor=len(fechas) - len(faltan))
+    CACHE_CONSULTAS.inc("ocupacion", "fallo", valor=len(faltan))
+    nuevos = {fecha: 0 for fecha in faltan}
+    if faltan:
+        # Una sola consulta por rango (incluido el día anterior, por las citas que cruzan la medianoche)
+        desde = (datetime.strptime(faltan[0], "%Y-%m-%d") - timedelta(days=1)).strftime("%Y-%m-%d")
+        invalidaciones = INVALIDACIONES_OCUPACION
+        filas = await asyncio.to_thread(REPO.agenda, user_id, desde, faltan[-1])
+        for _, fecha, hora, duracion, _ in filas:
+            inicio = datetime.strptime(f"{fecha} {hora}", "%Y-%m-%d %H:%M")
+            marcar_ocupado(nuevos, inicio, inicio + timedelta(minutes=duracion or DURACION_POR_DEFECTO))
+        if invalidaciones != INVALIDACIONES_OCUPACION:
+            # Alguien ha escrito durante la consulta: se responde con lo leído, pero no se guarda
+            return {fecha: nuevos[fecha] if fecha in nuevos else mapas[fecha] for fecha in fechas}
+    # Tras el await se vuelve a buscar: la entrada del usuario puede haberse invalidado o expulsado
+    mapas = CACHE_OCUPACION.setdefault(user_id, mapas)
+    CACHE_OCUPACION.move_to_end(user_id)
+    mapas.update(nuevos)
+    if len(mapas) > MAX_DIAS_EN_CACHE:
+        # Se olvidan primero los días calculados hace más tiempo, nunca los que se acaban de pedir
+        pedidas = set(fechas)
+        sobran = len(mapas) - MAX_DIAS_EN_CACHE
+        for fecha in [f for f in mapas if f not in pedidas][:sobran]:
+            del mapas[fecha]
+
+    while len(CACHE_OCUPACION) > MAX_USUARIOS_EN_CACHE:
+        CACHE_OCUPACION.popitem(last=False)
+    return {fecha: mapas[fecha] for fecha in fechas}
+
+def mascara_jornada(dia, desde=None):
+    # Bits a 1 en las franjas completas de la jornada laboral de ese día (y posteriores a 'desde')
+    if dia.weekday() >= 5:
+        return 0
+    primera = -(-(JORNADA_INICIO.hour * 60 + JORNADA_INICIO.minute) // MINUTOS_FRANJA)
+    ultima = (JORNADA_FIN.hour * 60 + JORNADA_FIN.minute) // MINUTOS_FRANJA
+    if desde and desde.date() == dia:
+        primera = max(primera, -(-(desde.hour * 60 + desde.minute) // MINUTOS_FRANJA))
+    elif desde and desde.date() > dia:
+        return 0
+    if ultima <= primera:
+        return 0
+    return ((1 << (ultima - primera)) - 1) << primera
+
+def tramos_libres(bits):
+    # Recorre los bloques de bits consecutivos a 1: devuelve (primera_franja, num_franjas)
+    posicion = 0
+    while bits:
+        ceros = (bits & -bits).bit_length() - 1
+        bits >>= ceros
+        posicion += ceros
+        invertidos = ~bits
+        unos = (invertidos & -invertidos).bit_length() - 1
+        yield posicion, unos
+        bits >>= unos
+        posicion += unos
+
+async def huecos_comunes(user_ids, fecha_ini, fecha_fin, duracion, limite=HUECOS_MAXIMOS, desde=None):
+    fechas = []
+    dia = fecha_ini
+    while dia <= fecha_fin:
+        fechas.append(dia.strftime("%Y-%m-%d"))
+        dia += timedelta(days=1)
+
+    ocupado = dict.fromkeys(fechas, 0)
+    for user_id in user_ids:
+        for fecha, bits in (await mapas_ocupacion(user_id, fechas)).items():
+            ocupado[fecha] |= bits
+
+    franjas_necesarias = -(-duracion // MINUTOS_FRANJA)
+    huecos = []
+    for fecha in fechas:
+        dia = datetime.strptime(fecha, "%Y-%m-%d")
+        libres = mascara_jornada(dia.date(), desde) & ~ocupado[fecha]
+        for primera, num in tramos_libres(libres):
+            if num >= franjas_necesarias:
+                huecos.append((
+                    dia + timedelta(minutes=primera * MINUTOS_FRANJA),
+                    dia + timedelta(minutes=(primera + num) * MINUTOS_FRANJA)
+                ))
+                if len(huecos) >= limite:
+                    return huecos
+    return huecos
 
 # --- 4. COMANDOS TELEGRAM ---
 
+# user_id -> username ya guardado, para no escribir en la DB en cada mensaje. Es una caché LRU: un usuario
+# olvidado solo cuesta volver a guardarlo la próxima vez que escriba
+USUARIOS_REGISTRADOS = OrderedDict()
+MAX_USUARIOS_REGISTRADOS = 10000
+
+async def registrar_usuario(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Se ejecuta antes que el resto de handlers (grupo -1) y no corta el procesamiento
+    usuario = update.effective_user
+    if not usuario or usuario.is_bot:
+        return
+    username = (usuario.username or "").lower() or None
+    if USUARIOS_REGISTRADOS.get(usuario.id, "") != username:
+        await ESCRITURAS.ejecutar(REPO.registrar_usuario, usuario.id, username)
+        USUARIOS_REGISTRADOS[usuario.id] = username
+    USUARIOS_REGISTRADOS.move_to_end(usuario.id)
+    while len(USUARIOS_REGISTRADOS) > MAX_USUARIOS_REGISTRADOS:
+        olvidado, _ = USUARIOS_REGISTRADOS.popitem(last=False)
+        # Sin persistencia, PTB guarda el user_data de cada usuario para siempre; aquí solo hay estado
+        # pasajero (la última búsqueda, una operación masiva sin confirmar) y se olvida con él
+        context.application.drop_user_data(olvidado)
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     keyboard = [
         [KeyboardButton("ℹ️ Ayuda")]
@@ -280,14 +807,18 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         reply_markup=reply_markup
     )
 
+# Botones del menú (texto que envía cada uno); no cuentan como mensajes para el LLM
+FILAS_MENU = [
+    ["📋 Ver Agenda", "🟢 Estado del Bot"],
+    ["📅 Agendar Cita", "📧 Redactar Email"],
+    ["✏️ Editar Cita", "🔄 Reprogramar"],
+    ["🔍 Buscar Cita", "❌ Cancelar/Limpiar"]
+]
+BOTONES_MENU = {boton for fila in FILAS_MENU for boton in fila}
+
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # 1. Definimos los botones
-    keyboard = [
-        [KeyboardButton("📋 Ver Agenda"), KeyboardButton("🟢 Estado del Bot")],
-        [KeyboardButton("📅 Agendar Cita"), KeyboardButton("📧 Redactar Email")],
-        [KeyboardButton("✏️ Editar Cita"), KeyboardButton("🔄 Reprogramar")],
-        [KeyboardButton("🔍 Buscar Cita"), KeyboardButton("❌ Cancelar/Limpiar")]
-    ]
+    keyboard = [[KeyboardButton(boton) for boton in fila] for fila in FILAS_MENU]
     reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True, one_time_keyboard=False)
     await update.message.reply_text("Menú desplegado. Seleccione una opción:", reply_markup=reply_markup)
 
@@ -312,15 +843,32 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "Seleccione una opción o escriba directamente (ej: `/agendar Reunión mañana 10am`)\n\n"
         
         "💡 *Comandos Útiles:*\n"
-        "📅 /agendar [texto] - Agendar una reunión.\n"
+        "📅 /agendar [texto] [duración] - Agendar una reunión (ej: `durante 30 min`; 1 hora por defecto).\n"
         "📋 /agenda - Ver su agenda.\n"
+        "🗓️ /agenda [hoy|semana|mes] o [desde] [hasta] - Ver su agenda por días.\n"
         "✏️ /editar [fecha] [descripción] - Modificar asunto de una cita.\n"
         "📧 /email [tema] - Redactar un email.\n"
         "🟢 /estado - Verificar el estado del sistema.\n"
         "❌ /cancelar [fecha] - Cancelar una cita.\n"
-        "🔄 /reprogramar [fecha antigua] [nueva fecha] [nueva hora] - Reprogramar una cita.\n"
+        "🗑️ /cancelar [rango] [texto] - Cancelar varias citas a la vez (pide confirmación).\n"
+        "🔄 /reprogramar [ID] [nueva fecha] [nueva hora] [duración] - Reprogramar una cita.\n"
+        "⏩ /desplazar [rango] [±días] [texto] - Mover varias citas unos días.\n"
+        "🏷️ /renombrar [rango] [viejo] -> [nuevo] - Cambiar un texto en el asunto de varias citas.\n"
+        "🔁 /recurrente [diaria|semanal|quincenal|mensual] [fecha] [hora] [asunto] - Crear una cita que se repite "
+        "(opcional: `cada 2`, `30 min`, `hasta 2026-06-30`, `10 veces`). Sin argumentos, las lista.\n"
+        "🚫 /excepcion [R#] [fecha] - Saltar una repetición concreta.\n"
         "🧹 /limpiar - Eliminar todas las citas.\n"
-        "🔍 /Buscar cita [fecha] - Obtener información sobre una cita específica."
+        "🔍 /cita [fecha] - Obtener información sobre una cita específica.\n"
+        "🔎 /buscar [texto] - Buscar citas por su asunto.\n"
+        "🕳️ /hueco [duración] [rango] - Buscar sus próximos huecos libres.\n"
+        "🤝 /coordinar @usuario ... [duración] [rango] - Buscar huecos comunes con otras personas.\n"
+        "🔓 /compartir @usuario ... - Permitir que esas personas crucen su agenda con la suya en /coordinar "
+        "(`/compartir quitar @usuario` lo retira; sin argumentos, lista los permisos).\n"
+        "📤 /exportar [ics|csv] [rango] - Descargar su agenda como archivo.\n"
+        "🗄️ /historial [desde] [hasta] - Consultar sus citas pasadas archivadas.\n"
+        "📥 Envíeme un archivo .ics o .csv para importar su calendario de Outlook o Google.\n"
+        "☀️ /resumen [HH:MM|off] - Recibir cada día su agenda a la hora elegida.\n"
+        f"⏰ Le enviaré un recordatorio {RECORDATORIO_MINUTOS} minutos antes de cada cita."
     )
 
     await update.message.reply_text(
@@ -330,6 +878,21 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
      
 async def estado(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Datos del propio bot, se muestran aunque Ollama no responda
+    detalles = ""
+    if ESCRITURAS.lotes:
+        detalles += f"\n✔ Escrituras: {ESCRITURAS.operaciones} en {ESCRITURAS.lotes} commits"
+    if REPO.admite_copias:
+        detalles += "\n" + describir_ultima_copia()
+    if COLA_SALIDA.retrasos:
+        detalles += f"\n✔ Espera en la cola de salida: {COLA_SALIDA.describir()}"
+        if COLA_SALIDA.esperas_429:
+            detalles += f" ({COLA_SALIDA.esperas_429} avisos 429)"
+    if ENVIOS.enviados or len(ENVIOS):
+        detalles += f"\n✔ Resúmenes: {ENVIOS.enviados} enviados, {len(ENVIOS)} en cola"
+    if VIGILANTE.bloqueos:
+        detalles += f"\n⚠️ Bucle de eventos: {VIGILANTE.describir()}"
+
     try:
         async with httpx.AsyncClient(timeout=5) as client:
             r = await client.get("http://localhost:11434/api/tags")
@@ -338,31 +901,32 @@ async def estado(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text(
                 "🟢 *Estado del sistema*\n\n"
                 "✔ Ollama conectado\n"
-                "✔ Servicio activo",
+                "✔ Servicio activo" + detalles,
                 parse_mode="Markdown"
             )
         else:
             await update.message.reply_text(
                 "🔴 *Estado del sistema*\n\n"
-                "✖ Ollama respondió con error",
+                "✖ Ollama respondió con error" + detalles,
                 parse_mode="Markdown"
             )
     except Exception:
         await update.message.reply_text(
             "🔴 *Estado del sistema*\n\n"
-            "✖ No se pudo conectar con Ollama",
+            "✖ No se pudo conectar con Ollama" + detalles,
             parse_mode="Markdown"
         )
 async def agendar(update: Update, context: ContextTypes.DEFAULT_TYPE):
     texto = " ".join(context.args)
     if not texto:
-        await update.message.reply_text("⚠️ Ej: `/agendar Reunión mañana 10am`")
+        await update.message.reply_text("⚠️ Ej: `/agendar Reunión mañana 10am` o `/agendar Reunión mañana 10am durante 30 min`")
         return
 
     await context.bot.send_chat_action(chat_id=update.effective_chat.id, action=ChatAction.TYPING)
     
     # 1. Extraemos los datos
-    datos = extraer_datos_cita(texto)
+    with trazas.tramo("extraer_datos_cita"):
+        datos = await asyncio.to_thread(extraer_datos_cita, texto)
     
     if not datos.get('fecha') or not datos.get('hora'):
         await update.message.reply_text("⚠️ No entendí la fecha. Intenta ser más claro (ej: 'mañana 10am').")
@@ -393,17 +957,36 @@ async def agendar(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
             return # Detenemos si es fecha pasada
 
-        # --- 3. GUARDADO Y FORMATO SOLICITADO ---
+        if not 0 < datos['duracion'] <= DURACION_MAXIMA:
+            await update.message.reply_text("⛔ La duración debe estar entre 1 minuto y 24 horas.")
+            return
+
+        # --- 3. SOLAPAMIENTOS ---
         user_id = update.effective_user.id
-        exito = guardar_cita_db(user_id, datos['fecha'], datos['hora'], datos['asunto'])
+        conflictos = await asyncio.to_thread(REPO.solapamientos, user_id, datos['fecha'], datos['hora'], datos['duracion'])
+        conflictos += await asyncio.to_thread(
+            REPO.solapamientos_recurrentes, user_id, datos['fecha'], datos['hora'], datos['duracion']
+        )
+        if conflictos:
+            await update.message.reply_text(
+                f"⛔ **Horario ocupado:** el `{datos['fecha']}` de `{datos['hora']}` a "
+                f"`{hora_fin(datos['fecha'], datos['hora'], datos['duracion'])}` se solapa con:\n\n"
+                f"{formatear_lista_citas(conflictos)}\n"
+                "Elija otro horario o reprograme la cita existente.",
+                parse_mode='Markdown'
+            )
+            return
+
+        # --- 4. GUARDADO Y FORMATO SOLICITADO ---
+        exito = await ESCRITURAS.ejecutar(REPO.crear, user_id, datos['fecha'], datos['hora'], datos['asunto'], datos['duracion'])
         
         if exito:
             # AQUÍ ESTÁ EL FORMATO EXACTO QUE PEDISTE
             await update.message.reply_text(
                 f"✅ **¡Cita agendada con éxito!**\n\n"
-                f"📌 **Asunto:** {datos['asunto']}\n"
+                f"📌 **Asunto:** {escape_markdown(datos['asunto'])}\n"
                 f"📅 **Fecha:** {datos['fecha']}\n"
-                f"⏰ **Hora:** {datos['hora']}\n\n"
+                f"⏰ **Hora:** {datos['hora']} - {hora_fin(datos['fecha'], datos['hora'], datos['duracion'])}\n\n"
                 "Se ha registrado correctamente en su agenda profesional.",
                 parse_mode='Markdown'
             )
@@ -417,41 +1000,257 @@ async def email(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not tema:
         return
     await context.bot.send_chat_action(chat_id=update.effective_chat.id, action=ChatAction.TYPING)
-    res = consultar_chat_libre(f"Redacta un email profesional sobre: {tema}")
-    await update.message.reply_text(res)
+    res = await consultar_chat_libre(f"Redacta un email profesional sobre: {tema}")
+    await responder(update, res)
 
 async def cancelar(update: Update, context: ContextTypes.DEFAULT_TYPE):
     args = context.args
-    if len(args) != 1:
-        await update.message.reply_text("⚠️ Uso correcto: /cancelar [fecha YYYY-MM-DD]")
+    if not args:
+        await update.message.reply_text(
+            "⚠️ Uso correcto: /cancelar [fecha YYYY-MM-DD]\n"
+            "o, para varias citas: /cancelar [hoy|semana|mes|desde hasta] [texto]"
+        )
+        return
+    if len(args) > 1 or not PATRON_FECHA.match(args[0]):
+        # Rango y/o texto: cancelación masiva con confirmación
+        await cancelar_masivo(update, context)
         return
     
     fecha = args[0]
     user_id = update.effective_user.id
     
     # Llamamos a la función de la base de datos
-    eliminado = eliminar_cita_db(user_id, fecha)
+    eliminado = await ESCRITURAS.ejecutar(REPO.eliminar_fecha, user_id, fecha) > 0
     
     if eliminado:
         await update.message.reply_text(f"✅ Se han eliminado las citas del día **{fecha}** correctamente.", parse_mode='Markdown')
     else:
         await update.message.reply_text(f"⚠️ No encontré ninguna cita en la fecha **{fecha}** para borrar.", parse_mode='Markdown')
 
+# --- Operaciones masivas (/cancelar con rango, /desplazar, /renombrar) ---
+# Primero se muestra cuántas citas se verán afectadas; la operación (una sola sentencia en una
+# transacción) se ejecuta al pulsar "Confirmar". La operación pendiente se guarda en user_data junto a un
+# código que va en los botones: al pulsar los de una vista previa antigua o ya sustituida, caduca.
+PATRON_FECHA = re.compile(r"^\d{4}-\d{2}-\d{2}$")
+PATRON_DIAS = re.compile(r"^[+-]?\d+$")
+
+def interpretar_filtro(args):
+    # Devuelve (fecha_ini, fecha_fin, resto_de_argumentos); sin rango reconocido, toda la agenda
+    rango = calcular_rango(args)
+    if not rango:
+        return None, None, list(args)
+    fecha_ini, fecha_fin, usados = rango
+    return fecha_ini, fecha_fin, list(args[usados:])
+
+def describir_filtro(fecha_ini, fecha_fin, texto=None):
+    if not fecha_ini:
+        descripcion = "de toda su agenda"
+    elif fecha_ini == fecha_fin:
+        descripcion = f"del {fecha_ini}"
+    else:
+        descripcion = f"del {fecha_ini} al {fecha_fin}"
+    if texto:
+        descripcion += f" que contienen «{escape_markdown(texto)}»"
+    return descripcion
+
+async def pedir_confirmacion(update, context, operacion, total, pregunta):
+    if not total:
+        await update.message.reply_text("📂 No hay citas que cumplan esas condiciones.")
+        return
+    # Solo la última vista previa queda pendiente: una nueva sustituye a la anterior
+    codigo = secrets.token_hex(4)
+    context.user_data["masiva"] = {codigo: operacion}
+    teclado = InlineKeyboardMarkup([[
+        InlineKeyboardButton("✅ Confirmar", callback_data=f"masiva:si:{codigo}"),
+        InlineKeyboardButton("❌ Cancelar", callback_data=f"masiva:no:{codigo}")
+    ]])
+    await update.message.reply_text(pregunta, parse_mode='Markdown', reply_markup=teclado)
+
+async def cancelar_masivo(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    fecha_ini, fecha_fin, resto = interpretar_filtro(context.args)
+    texto = " ".join(resto)
+    if not fecha_ini and not construir_consulta_fts(texto):
+        await update.message.reply_text("⚠️ Indique un rango de fechas o un texto. Ej: `/cancelar semana acme`", parse_mode='Markdown')
+        return
+
+    total = await asyncio.to_thread(REPO.contar, update.effective_user.id, fecha_ini, fecha_fin, texto or None)
+    descripcion = describir_filtro(fecha_ini, fecha_fin, texto)
+    await pedir_confirmacion(
+        update, context,
+        {"tipo": "cancelar", "fecha_ini": fecha_ini, "fecha_fin": fecha_fin, "texto": texto or None, "descripcion": descripcion},
+        total, f"🗑️ Se cancelarán **{total}** citas {descripcion}. ¿Confirma?"
+    )
+
+async def desplazar(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    fecha_ini, fecha_fin, resto = interpretar_filtro(context.args)
+    if not fecha_ini or not resto or not PATRON_DIAS.match(resto[0]) or int(resto[0]) == 0:
+        await update.message.reply_text(
+            "⚠️ **Uso:** `/desplazar [rango] [±días] [texto]`\n"
+            "Ej: `/desplazar 2026-03-01 2026-03-15 +7` o `/desplazar semana -1 viaje`",
+            parse_mode='Markdown'
+        )
+        return
+
+    dias = int(resto[0])
+    texto = " ".join(resto[1:])
+    total = await asyncio.to_thread(REPO.contar, update.effective_user.id, fecha_ini, fecha_fin, texto or None)
+    descripcion = describir_filtro(fecha_ini, fecha_fin, texto)
+    sentido = "adelante" if dias > 0 else "atrás"
+    await pedir_confirmacion(
+        update, context,
+        {"tipo": "desplazar", "dias": dias, "fecha_ini": fecha_ini, "fecha_fin": fecha_fin, "texto": texto or None, "descripcion": descripcion},
+        total, f"⏩ Se moverán **{total}** citas {descripcion} {abs(dias)} días hacia {sentido}. ¿Confirma?"
+    )
+
+async def renombrar(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    fecha_ini, fecha_fin, resto = interpretar_filtro(context.args)
+    viejo, separador, nuevo = " ".join(resto).partition("->")
+    viejo, nuevo = viejo.strip(), nuevo.strip()
+    if not separador or not viejo or len(nuevo) > ASUNTO_MAXIMO:
+        await update.message.reply_text(
+            "⚠️ **Uso:** `/renombrar [rango] [texto viejo] -> [texto nuevo]`\n"
+            "Ej: `/renombrar mes Acme -> Globex` (distingue mayúsculas)",
+            parse_mode='Markdown'
+        )
+        return
+
+    # El recuento usa el mismo filtro que la sustitución al confirmar
+    total, omitidas = await asyncio.to_thread(REPO.contar_renombrar, update.effective_user.id, viejo, nuevo, fecha_ini, fecha_fin)
+    descripcion = describir_filtro(fecha_ini, fecha_fin)
+    if omitidas and not total:
+        await update.message.reply_text(
+            f"⚠️ En las {omitidas} citas con ese texto el asunto pasaría de {ASUNTO_MAXIMO} caracteres: no se cambia ninguna."
+        )
+        return
+    aviso = f" ({omitidas} se dejarán igual: su asunto pasaría de {ASUNTO_MAXIMO} caracteres)" if omitidas else ""
+    await pedir_confirmacion(
+        update, context,
+        {"tipo": "renombrar", "viejo": viejo, "nuevo": nuevo, "fecha_ini": fecha_ini, "fecha_fin": fecha_fin, "descripcion": descripcion},
+        total, f"🏷️ Se cambiará «{escape_markdown(viejo)}» por «{escape_markdown(nuevo)}» en **{total}** citas {descripcion}{aviso}. ¿Confirma?"
+    )
+
+async def confirmar_masiva(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    _, respuesta, codigo = query.data.split(":")
+    pendientes = context.user_data.get("masiva") or {}
+    if codigo not in pendientes:
+        await query.edit_message_text("⌛ Esta confirmación ha caducado. Vuelva a lanzar el comando.")
+        return
+    operacion = pendientes.pop(codigo)
+    if respuesta == "no":
+        await query.edit_message_text("👌 Operación descartada, no se ha cambiado nada.")
+        return
+
+    user_id = update.effective_user.id
+    fecha_ini, fecha_fin = operacion["fecha_ini"], operacion["fecha_fin"]
+    if operacion["tipo"] == "cancelar":
+        borradas = await ESCRITURAS.ejecutar(REPO.eliminar_rango, user_id, fecha_ini, fecha_fin, operacion["texto"])
+        await query.edit_message_text(f"✅ Se han cancelado {borradas} citas {operacion['descripcion']}.", parse_mode='Markdown')
+    elif operacion["tipo"] == "desplazar":
+        movidas, conflictos = await ESCRITURAS.ejecutar(
+            REPO.desplazar, user_id, operacion["dias"], fecha_ini, fecha_fin, operacion["texto"]
+        )
+        if conflictos:
+            await query.edit_message_text(
+                "⛔ **No se ha movido ninguna cita:** al desplazarlas chocarían con:\n" + formatear_conflictos(conflictos),
+                parse_mode='Markdown'
+            )
+        else:
+            await query.edit_message_text(
+                f"✅ Se han movido {movidas} citas {operacion['descripcion']} {operacion['dias']:+d} días.", parse_mode='Markdown'
+            )
+    elif operacion["tipo"] == "renombrar":
+        cambiadas, omitidas = await ESCRITURAS.ejecutar(
+            REPO.renombrar, user_id, operacion["viejo"], operacion["nuevo"], fecha_ini, fecha_fin
+        )
+        msg = f"✅ Se ha actualizado el asunto de {cambiadas} citas."
+        if omitidas:
+            msg += f" {omitidas} se han dejado igual porque su asunto pasaría de {ASUNTO_MAXIMO} caracteres."
+        await query.edit_message_text(msg)
+
+def formatear_agenda_por_dia(citas, titulo, subtitulo="(Use el número ID para editar o reprogramar)"):
+    # Agrupa las filas (id, fecha, hora, duracion, asunto), ya ordenadas por fecha y hora, bajo un encabezado por día
+    msg = f"{titulo}\n{subtitulo}\n"
+    dia_actual = None
+    for cid, fecha, hora, duracion, asunto in citas:
+        if fecha != dia_actual:
+            dia_actual = fecha
+            dia_dt = datetime.strptime(fecha, "%Y-%m-%d")
+            msg += f"\n📅 *{DIAS_SEMANA[dia_dt.weekday()].capitalize()} {dia_dt.strftime('%d/%m/%Y')}*\n"
+
+        asunto_visual = asunto[:40] + "..." if len(asunto) > 40 else asunto
+        msg += f"🆔 `{cid}` | ⏰ `{hora}-{hora_fin(fecha, hora, duracion)}` | {escape_markdown(asunto_visual)}\n"
+    return msg
+
+def formatear_huecos(huecos, titulo):
+    msg = f"{titulo}\n"
+    dia_actual = None
+    for inicio, fin in huecos:
+        if inicio.date() != dia_actual:
+            dia_actual = inicio.date()
+            msg += f"\n📅 *{DIAS_SEMANA[inicio.weekday()].capitalize()} {inicio.strftime('%d/%m/%Y')}*\n"
+        msg += f"🟢 `{inicio.strftime('%H:%M')}-{fin.strftime('%H:%M')}` ({formatear_duracion((fin - inicio).total_seconds() // 60)})\n"
+    return msg
+
+def formatear_lista_citas(citas):
+    # El asunto lo escribe el usuario: se escapa para que un "_" o un "*" no rompa el Markdown
+    return "".join(
+        f"🆔 `{cid}` | 🔹 {fecha} `{hora}-{hora_fin(fecha, hora, duracion)}` | {escape_markdown(asunto)}\n"
+        for cid, fecha, hora, duracion, asunto in citas
+    )
+
+def formatear_conflictos(conflictos, maximo=5):
+    # Los primeros 'maximo' choques y cuántos quedan: la lista entera puede no caber en un mensaje
+    msg = formatear_lista_citas(conflictos[:maximo])
+    if len(conflictos) > maximo:
+        msg += f"… y {len(conflictos) - maximo} más\n"
+    return msg
+
+async def ver_agenda_rango(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    args = context.args
+    rango = calcular_rango(args)
+    if not rango or rango[2] != len(args):
+        await update.message.reply_text(
+            "⚠️ **Uso:** `/agenda [hoy|mañana|semana|mes]` o `/agenda [desde] [hasta]`\n"
+            "Ej: `/agenda semana` o `/agenda 2026-03-01 2026-03-15`",
+            parse_mode='Markdown'
+        )
+        return
+
+    fecha_ini, fecha_fin, _ = rango
+    user_id = update.effective_user.id
+    citas = await asyncio.to_thread(REPO.agenda, user_id, fecha_ini, fecha_fin)
+
+    if fecha_ini == fecha_fin:
+        periodo = f"para el {fecha_ini}"
+    else:
+        periodo = f"del {fecha_ini} al {fecha_fin}"
+
+    if not citas:
+        await update.message.reply_text(f"📂 No tiene nada programado {periodo}.")
+        return
+
+    msg = formatear_agenda_por_dia(citas, f"📋 **Su Agenda {periodo}:**")
+    await responder(update, msg, parse_mode='Markdown')
+
 async def ver_agenda(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Con argumentos mostramos solo un rango: /agenda hoy, /agenda semana, /agenda 2026-03-01 2026-03-15
+    if context.args:
+        await ver_agenda_rango(update, context)
+        return
+
     user_id = update.effective_user.id
-    conn = sqlite3.connect('meetmanager.db')
-    c = conn.cursor()
     # Traemos el ID explícitamente
-    c.execute("SELECT id, fecha, hora, asunto FROM citas WHERE user_id=? ORDER BY fecha, hora", (user_id,))
-    citas = c.fetchall()
-    conn.close()
+    citas = await asyncio.to_thread(REPO.rango, user_id)
+    reglas = await asyncio.to_thread(REPO.recurrencias, user_id)
 
-    if not citas:
+    if not citas and not reglas:
         await update.message.reply_text("📂 Su agenda está vacía.")
         return
 
     msg = "📋 **Su Agenda:**\n(Use el número ID para editar o reprogramar)\n\n"
-    for cid, fecha, hora, asunto in citas:
+    for cid, fecha, hora, _, asunto in citas:
         # --- TRUCO VISUAL ---
         # Si el asunto tiene más de 40 letras, lo cortamos y ponemos "..."
         # Si es corto, lo dejamos igual.
@@ -460,16 +1259,16 @@ async def ver_agenda(update: Update, context: ContextTypes.DEFAULT_TYPE):
         else:
             asunto_visual = asunto
             
-        msg += f"🆔 `{cid}` | 🔹 {fecha} {hora} | {asunto_visual}\n"
+        msg += f"🆔 `{cid}` | 🔹 {fecha} {hora} | {escape_markdown(asunto_visual)}\n"
+
+    if reglas:
+        msg += "\n🔁 **Recurrentes:**\n" + formatear_reglas(reglas)
     
     msg += "\n_(Use /cita [fecha] para leer los textos completos)_"
     
-    # Telegram tiene un límite de 4096 caracteres por mensaje. 
-    # Si la agenda es gigante, cortamos el mensaje para que no de error.
-    if len(msg) > 4000:
-        msg = msg[:4000] + "\n\n⚠️ (Agenda cortada por exceso de longitud)"
-    
-    await update.message.reply_text(msg, parse_mode='Markdown')
+    # Telegram tiene un límite de 4096 caracteres por mensaje: 
+    # si la agenda es gigante, llega en varios mensajes.
+    await responder(update, msg, parse_mode='Markdown')
 
 async def editar_descripcion(update: Update, context: ContextTypes.DEFAULT_TYPE):
     args = context.args
@@ -488,7 +1287,7 @@ async def editar_descripcion(update: Update, context: ContextTypes.DEFAULT_TYPE)
         nueva_descripcion = " ".join(args[1:]) # El resto es el texto
         
         # Llamamos a la DB pasando el ID
-        exito = modificar_cita(cita_id, nueva_descripcion)
+        exito = await ESCRITURAS.ejecutar(REPO.actualizar_asunto, update.effective_user.id, cita_id, nueva_descripcion)
         
         if exito:
             await update.message.reply_text(f"✅ Cita **#{cita_id}** actualizada correctamente.", parse_mode='Markdown')
@@ -500,22 +1299,41 @@ async def editar_descripcion(update: Update, context: ContextTypes.DEFAULT_TYPE)
 
 async def reprogramar(update: Update, context: ContextTypes.DEFAULT_TYPE):
     args = context.args
-    # Ahora esperamos 3 argumentos: [ID] [Fecha] [Hora]
-    if len(args) != 3:
+    # Ahora esperamos 3 argumentos: [ID] [Fecha] [Hora], y opcionalmente la nueva duración
+    if len(args) not in (3, 4):
         await update.message.reply_text(
-            "⚠️ **Modo correcto:**\n`/reprogramar [ID] [Nueva_Fecha] [Nueva_Hora]`\n\n"
-            "Ej: `/reprogramar 5 2026-02-20 16:00`\n"
+            "⚠️ **Modo correcto:**\n`/reprogramar [ID] [Nueva_Fecha] [Nueva_Hora] [Duración]`\n\n"
+            "Ej: `/reprogramar 5 2026-02-20 16:00` o `/reprogramar 5 2026-02-20 16:00 30min`\n"
             "(Mire el número ID escribiendo /agenda)",
             parse_mode='Markdown'
         )
         return
 
-    cita_id = args[0]
+    try:
+        cita_id = int(args[0])
+    except ValueError:
+        await update.message.reply_text("⚠️ El ID debe ser un número. Mírelo en /agenda.")
+        return
     fecha_new = args[1]
     hora_new = args[2]
+    duracion_new = None
+
+    try:
+        nuevo_inicio = datetime.strptime(f"{fecha_new} {hora_new}", "%Y-%m-%d %H:%M")
+    except ValueError:
+        await update.message.reply_text("⚠️ Use el formato `YYYY-MM-DD HH:MM` para la nueva fecha y hora.", parse_mode='Markdown')
+        return
+    # strptime acepta "2030-1-6 7:00": se guarda siempre con ceros, como el resto de la agenda
+    fecha_new, hora_new = nuevo_inicio.strftime("%Y-%m-%d"), nuevo_inicio.strftime("%H:%M")
+
+    if len(args) == 4:
+        duracion_new = parsear_duracion(args[3])
+        if not duracion_new:
+            await update.message.reply_text("⚠️ Duración no válida. Ej: `30min`, `1h`, `90`.", parse_mode='Markdown')
+            return
     
-    # Llamamos a la función DB que actualiza (UPDATE) sin duplicar
-    resultado = reprogramar_cita_db(cita_id, fecha_new, hora_new)
+    # Llamamos a la función DB que actualiza (UPDATE) sin duplicar ni solapar
+    resultado, conflictos = await ESCRITURAS.ejecutar(REPO.reprogramar, update.effective_user.id, cita_id, fecha_new, hora_new, duracion_new)
     
     if resultado == "exito":
         await update.message.reply_text(
@@ -523,36 +1341,875 @@ async def reprogramar(update: Update, context: ContextTypes.DEFAULT_TYPE):
             f"La cita **#{cita_id}** se ha movido al `{fecha_new}` a las `{hora_new}`.",
             parse_mode='Markdown'
         )
+    elif resultado == "solapamiento":
+        await responder(
+            update,
+            f"⛔ **No se pudo mover la cita #{cita_id}:** el nuevo horario se solapa con:\n\n"
+            f"{formatear_conflictos(conflictos)}",
+            parse_mode='Markdown'
+        )
     else:
         await update.message.reply_text("❌ No encontré ese número de ID en su agenda.")
 
+# --- Citas recurrentes ---
+FRECUENCIAS_COMANDO = {
+    "diaria": ("diaria", 1), "diario": ("diaria", 1),
+    "semanal": ("semanal", 1), "quincenal": ("semanal", 2),
+    "mensual": ("mensual", 1),
+}
+PATRON_HASTA = re.compile(r"\bhasta\s+(\d{4}-\d{2}-\d{2})\b", re.IGNORECASE)
+PATRON_VECES = re.compile(r"\b(\d+)\s+veces\b", re.IGNORECASE)
+DIAS_COMPROBAR_RECURRENCIA = 90  # al crear una regla avisamos de choques en este horizonte
+
+def id_de_regla(texto):
+    # "R3", "r3" o "3" -> 3
+    texto = texto.upper()
+    if texto.startswith(PREFIJO_RECURRENCIA):
+        texto = texto[len(PREFIJO_RECURRENCIA):]
+    return int(texto) if texto.isdigit() else None
+
+def describir_regla(regla):
+    _, fecha, hora, duracion, _, frecuencia, intervalo, hasta, repeticiones, excepciones = regla
+    inicio = datetime.strptime(fecha, "%Y-%m-%d")
+    if frecuencia == "diaria":
+        texto = "cada día" if intervalo == 1 else f"cada {intervalo} días"
+    elif frecuencia == "semanal":
+        dia = DIAS_SEMANA[inicio.weekday()]
+        texto = f"cada {dia}" if intervalo == 1 else f"cada {intervalo} semanas ({dia})"
+    else:
+        texto = f"el día {inicio.day} de cada mes" if intervalo == 1 else f"el día {inicio.day} cada {intervalo} meses"
+    texto += f", `{hora}-{hora_fin(fecha, hora, duracion)}`, desde {fecha}"
+    if hasta:
+        texto += f" hasta {hasta}"
+    if repeticiones:
+        texto += f" ({repeticiones} veces)"
+    if excepciones:
+        texto += f", {len(excepciones)} excepción" if len(excepciones) == 1 else f", {len(excepciones)} excepciones"
+    return texto
+
+def formatear_reglas(reglas):
+    return "".join(
+        f"🆔 `{PREFIJO_RECURRENCIA}{regla[0]}` | {describir_regla(regla)} | {escape_markdown(regla[4])}\n" for regla in reglas
+    )
+
+async def recurrente(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    args = context.args
+    user_id = update.effective_user.id
+    if not args:
+        reglas = await asyncio.to_thread(REPO.recurrencias, user_id)
+        if not reglas:
+            await update.message.reply_text("🔁 No tiene citas recurrentes. Use /help para ver cómo crearlas.")
+            return
+        await responder(
+            update,
+            "🔁 **Sus citas recurrentes:**\n\n" + formatear_reglas(reglas) +
+            "\n_(/excepcion R# fecha salta un día; /recurrente borrar R# elimina la regla)_",
+            parse_mode='Markdown'
+        )
+        return
+
+    if args[0].lower() == "borrar" and len(args) == 2:
+        id_regla = id_de_regla(args[1])
+        if id_regla and await ESCRITURAS.ejecutar(REPO.eliminar_recurrencia, user_id, id_regla):
+            await update.message.reply_text(f"🗑️ Cita recurrente **{PREFIJO_RECURRENCIA}{id_regla}** eliminada.", parse_mode='Markdown')
+        else:
+            await update.message.reply_text("❌ No encontré esa cita recurrente. Revise /recurrente.")
+        return
+
+    uso = (
+        "⚠️ **Uso:** `/recurrente [diaria|semanal|quincenal|mensual] [cada N] [fecha] [hora] [asunto]`\n"
+        "Ej: `/recurrente semanal 2026-03-02 10:00 30 min Uno a uno con Ana hasta 2026-06-30`"
+    )
+    if args[0].lower() not in FRECUENCIAS_COMANDO:
+        await update.message.reply_text(uso, parse_mode='Markdown')
+        return
+    frecuencia, intervalo = FRECUENCIAS_COMANDO[args[0].lower()]
+    resto = args[1:]
+    if len(resto) >= 2 and resto[0].lower() == "cada" and resto[1].isdigit() and int(resto[1]) > 0:
+        intervalo *= int(resto[1])
+        resto = resto[2:]
+    if len(resto) < 3:
+        await update.message.reply_text(uso, parse_mode='Markdown')
+        return
+    try:
+        primera = datetime.strptime(f"{resto[0]} {resto[1]}", "%Y-%m-%d %H:%M")
+    except ValueError:
+        await update.message.reply_text("⚠️ Use el formato `YYYY-MM-DD HH:MM` para la primera fecha y hora.", parse_mode='Markdown')
+        return
+    fecha, hora = primera.strftime("%Y-%m-%d"), primera.strftime("%H:%M")
+
+    texto = " ".join(resto[2:])
+    hasta = repeticiones = None
+    match_hasta = PATRON_HASTA.search(texto)
+    if match_hasta:
+        hasta = match_hasta.group(1)
+        texto = texto[:match_hasta.start()] + texto[match_hasta.end():]
+    match_veces = PATRON_VECES.search(texto)
+    if match_veces:
+        repeticiones = int(match_veces.group(1))
+        texto = texto[:match_veces.start()] + texto[match_veces.end():]
+    duracion = DURACION_POR_DEFECTO
+    match_duracion = PATRON_DURACION.search(texto)
+    if match_duracion:
+        duracion = minutos_de_duracion(match_duracion.group(1) or match_duracion.group(3), match_duracion.group(2) or match_duracion.group(4))
+        texto = texto[:match_duracion.start()] + texto[match_duracion.end():]
+    asunto = " ".join(texto.split())
+
+    if not asunto or len(asunto) > 100:
+        await update.message.reply_text("⚠️ El asunto es obligatorio y no puede pasar de 100 caracteres.")
+        return
+    if not 0 < duracion <= DURACION_MAXIMA or repeticiones == 0 or (hasta and hasta < fecha):
+        await update.message.reply_text("⚠️ Revise la duración (máx. 24 h), el número de veces o la fecha final.")
+        return
+
+    id_regla = await ESCRITURAS.ejecutar(
+        REPO.crear_recurrencia, user_id, fecha, hora, duracion, asunto, frecuencia, intervalo, hasta, repeticiones
+    )
+    regla = next(r for r in await asyncio.to_thread(REPO.recurrencias, user_id) if r[0] == id_regla)
+    msg = f"🔁 **Cita recurrente creada** (`{PREFIJO_RECURRENCIA}{id_regla}`)\n{describir_regla(regla)} | {escape_markdown(asunto)}"
+
+    # No rechazamos la regla por un choque puntual: avisamos para que use /excepcion.
+    # La agenda del horizonte (más un día por cada lado para las citas que cruzan la medianoche) se lee
+    # una sola vez y los choques se buscan en memoria, no con dos consultas por ocurrencia.
+    desde = max(datetime.now().date(), datetime.strptime(fecha, "%Y-%m-%d").date())
+    horizonte = (desde + timedelta(days=DIAS_COMPROBAR_RECURRENCIA)).strftime("%Y-%m-%d")
+    filas = await asyncio.to_thread(
+        REPO.agenda, user_id, (desde - timedelta(days=1)).strftime("%Y-%m-%d"),
+        (desde + timedelta(days=DIAS_COMPROBAR_RECURRENCIA + 1)).strftime("%Y-%m-%d")
+    )
+    otras = [fila for fila in filas if fila[0] != f"{PREFIJO_RECURRENCIA}{id_regla}"]
+    inicios = [datetime.strptime(f"{fila[1]} {fila[2]}", "%Y-%m-%d %H:%M") for fila in otras]
+    conflictos = {}
+    for _, dia, hora_o, duracion_o, _ in expandir_regla(regla, desde.strftime("%Y-%m-%d"), horizonte):
+        inicio, fin, antes = ventana_solapamiento(dia, hora_o, duracion_o)
+        for i in range(bisect.bisect_left(inicios, antes), bisect.bisect_left(inicios, fin)):
+            if inicios[i] + timedelta(minutes=otras[i][3]) > inicio:
+                conflictos[otras[i][:2]] = otras[i]
+    if conflictos:
+        choques = sorted(conflictos.values(), key=lambda fila: (fila[1], fila[2]))
+        msg += (
+            f"\n\n⚠️ En los próximos {DIAS_COMPROBAR_RECURRENCIA} días se solapa con:\n{formatear_conflictos(choques)}"
+            f"Use `/excepcion {PREFIJO_RECURRENCIA}{id_regla} [fecha]` para saltar esos días."
+        )
+    await update.message.reply_text(msg, parse_mode='Markdown')
+
+async def excepcion(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    args = context.args
+    if len(args) != 2 or not id_de_regla(args[0]) or not PATRON_FECHA.match(args[1]):
+        await update.message.reply_text("⚠️ **Uso:** `/excepcion [R#] [fecha YYYY-MM-DD]`\nEj: `/excepcion R3 2026-03-09`", parse_mode='Markdown')
+        return
+
+    user_id = update.effective_user.id
+    id_regla, fecha = id_de_regla(args[0]), args[1]
+    regla = next((r for r in await asyncio.to_thread(REPO.recurrencias, user_id) if r[0] == id_regla), None)
+    if not regla:
+        await update.message.reply_text("❌ No encontré esa cita recurrente. Revise /recurrente.")
+        return
+    if not expandir_regla(regla, fecha, fecha):
+        await update.message.reply_text(f"📂 La cita {PREFIJO_RECURRENCIA}{id_regla} no se repite el {fecha}.")
+        return
+
+    await ESCRITURAS.ejecutar(REPO.agregar_excepcion, user_id, id_regla, fecha)
+    await update.message.reply_text(f"🚫 La cita **{PREFIJO_RECURRENCIA}{id_regla}** no se celebrará el `{fecha}`.", parse_mode='Markdown')
+
 async def limpiar(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    limpiar_todo_db(user_id)
+    await ESCRITURAS.ejecutar(REPO.eliminar_todo, user_id)
     await update.message.reply_text("🗑️ **Agenda reseteada:** Todas sus citas han sido eliminadas.", parse_mode='Markdown')
 
 async def cita(update: Update, context: ContextTypes.DEFAULT_TYPE):
     args = context.args
     if len(args) != 1:
-        await update.message.reply_text("🔎 Uso: `/Buscar cita [fecha YYYY-MM-DD]`\nEjemplo: `/cita 2026-01-30`", parse_mode='Markdown')
+        await update.message.reply_text("🔎 Uso: `/cita [fecha YYYY-MM-DD]`\nEjemplo: `/cita 2026-01-30`", parse_mode='Markdown')
         return
 
     fecha = args[0]
     user_id = update.effective_user.id
     
     # Buscamos en la DB
-    resultados = buscar_citas_por_fecha_db(user_id, fecha)
+    resultados = await asyncio.to_thread(REPO.agenda, user_id, fecha, fecha)
     
     if resultados:
         # Construimos el mensaje con todas las reuniones encontradas
         mensaje = f"📅 **Citas para el {fecha}:**\n\n"
-        for hora, asunto in resultados:
-            mensaje += f"🔹 `{hora}` - {asunto}\n"
+        for _, _, hora, _, asunto in resultados:
+            mensaje += f"🔹 `{hora}` - {escape_markdown(asunto)}\n"
         
-        await update.message.reply_text(mensaje, parse_mode='Markdown')
+        await responder(update, mensaje, parse_mode='Markdown')
     else:
         await update.message.reply_text(f"📂 No tiene nada programado para el día `{fecha}`.", parse_mode='Markdown')
 
+async def hueco(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    args = list(context.args)
+    duracion = DURACION_POR_DEFECTO
+    if args and parsear_duracion(args[0]):
+        duracion = parsear_duracion(args.pop(0))
+
+    rango = calcular_rango(args or ["semana"])
+    if not rango or rango[2] != len(args or ["semana"]):
+        await update.message.reply_text(
+            "⚠️ **Uso:** `/hueco [duración] [rango]`\n"
+            "Ej: `/hueco 30min`, `/hueco 2h mes` o `/hueco 1h 2026-03-01 2026-03-15`",
+            parse_mode='Markdown'
+        )
+        return
+
+    fecha_ini, fecha_fin, _ = rango
+    user_id = update.effective_user.id
+    ini = datetime.strptime(fecha_ini, "%Y-%m-%d")
+    fin = datetime.strptime(fecha_fin, "%Y-%m-%d")
+
+    # Pedimos también el día anterior: una cita de la noche puede invadir la mañana siguiente
+    filas = await asyncio.to_thread(REPO.agenda, user_id, (ini - timedelta(days=1)).strftime("%Y-%m-%d"), fecha_fin)
+    ocupados = []
+    for _, fecha, hora, duracion_cita, _ in filas:
+        inicio = datetime.strptime(f"{fecha} {hora}", "%Y-%m-%d %H:%M")
+        ocupados.append((inicio, inicio + timedelta(minutes=duracion_cita or DURACION_POR_DEFECTO)))
+
+    huecos = calcular_huecos(
+        ocupados, ini.date(), fin.date(), duracion,
+        desde=redondear_cuarto_hora(datetime.now())
+    )
+
+    if not huecos:
+        await update.message.reply_text(
+            f"📂 No encontré huecos de {formatear_duracion(duracion)} entre el {fecha_ini} y el {fecha_fin} "
+            f"dentro de la jornada ({JORNADA_INICIO.strftime('%H:%M')}-{JORNADA_FIN.strftime('%H:%M')})."
+        )
+        return
+
+    msg = formatear_huecos(huecos, f"🕳️ **Primeros huecos libres de al menos {formatear_duracion(duracion)}:**")
+    await update.message.reply_text(msg, parse_mode='Markdown')
+
+async def coordinar(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    args = list(context.args)
+    usernames = []
+    while args and args[0].startswith("@"):
+        usernames.append(args.pop(0)[1:].lower())
+
+    duracion = DURACION_POR_DEFECTO
+    if args and parsear_duracion(args[0]):
+        duracion = parsear_duracion(args.pop(0))
+
+    rango = calcular_rango(args or ["semana"])
+    if not usernames or not rango or rango[2] != len(args or ["semana"]):
+        await update.message.reply_text(
+            "⚠️ **Uso:** `/coordinar @usuario1 @usuario2 ... [duración] [rango]`\n"
+            "Ej: `/coordinar @ana @luis 30min semana`",
+            parse_mode='Markdown'
+        )
+        return
+
+    fecha_ini, fecha_fin, _ = rango
+    dias = (datetime.strptime(fecha_fin, "%Y-%m-%d") - datetime.strptime(fecha_ini, "%Y-%m-%d")).days + 1
+    if dias > MAX_DIAS_COORDINAR:
+        await update.message.reply_text(f"⚠️ El rango no puede pasar de {MAX_DIAS_COORDINAR} días.")
+        return
+
+    user_id = update.effective_user.id
+    encontrados = await asyncio.to_thread(REPO.buscar_usuarios, usernames)
+    desconocidos = [f"@{u}" for u in usernames if u not in encontrados]
+    if desconocidos:
+        await update.message.reply_text(
+            f"❌ No conozco a: {', '.join(desconocidos)}\n"
+            "Cada participante debe haber escrito al bot al menos una vez."
+        )
+        return
+
+    # Solo se cruzan las agendas de quienes le han dado permiso con /compartir
+    autorizan = await asyncio.to_thread(REPO.autorizan_coordinacion, user_id, set(encontrados.values()) - {user_id})
+    sin_permiso = [f"@{u}" for u, otro_id in encontrados.items() if otro_id != user_id and otro_id not in autorizan]
+    if sin_permiso:
+        username = update.effective_user.username
+        como = f"`/compartir @{username}`" if username else "`/compartir` (antes configure su @usuario en Telegram)"
+        await update.message.reply_text(
+            f"🔒 No puede ver los huecos de: {escape_markdown(', '.join(sin_permiso))}\n"
+            f"Cada uno debe permitírselo antes con {como}.",
+            parse_mode='Markdown'
+        )
+        return
+
+    # El propio usuario siempre participa en la reunión
+    participantes = {user_id, *encontrados.values()}
+    huecos = await huecos_comunes(
+        participantes,
+        datetime.strptime(fecha_ini, "%Y-%m-%d").date(),
+        datetime.strptime(fecha_fin, "%Y-%m-%d").date(),
+        duracion,
+        desde=datetime.now()
+    )
+
+    if not huecos:
+        await update.message.reply_text(
+            f"📂 No hay ningún hueco común de {formatear_duracion(duracion)} entre el {fecha_ini} y el {fecha_fin}."
+        )
+        return
+
+    msg = formatear_huecos(
+        huecos,
+        f"🤝 **Huecos comunes de al menos {formatear_duracion(duracion)}** ({len(participantes)} participantes):"
+    )
+    await update.message.reply_text(msg, parse_mode='Markdown')
+
+async def compartir(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    args = list(context.args)
+    if not args:
+        permitidos = await asyncio.to_thread(REPO.permisos_coordinacion, user_id)
+        if permitidos:
+            await update.message.reply_text(
+                "🔓 Pueden cruzar su agenda con la suya en /coordinar: " + ", ".join(f"@{u}" for u in permitidos)
+            )
+        else:
+            await update.message.reply_text(
+                "🔒 Nadie puede ver sus huecos en /coordinar. Use `/compartir @usuario` para permitírselo.",
+                parse_mode='Markdown'
+            )
+        return
+
+    permitir = args[0].lower() not in ("quitar", "no", "off")
+    if not permitir:
+        args.pop(0)
+    usernames = [arg[1:].lower() for arg in args if arg.startswith("@") and len(arg) > 1]
+    if not usernames or len(usernames) != len(args):
+        await update.message.reply_text(
+            "⚠️ **Uso:** `/compartir @usuario1 @usuario2 ...` o `/compartir quitar @usuario`", parse_mode='Markdown'
+        )
+        return
+
+    encontrados = await asyncio.to_thread(REPO.buscar_usuarios, usernames)
+    desconocidos = [f"@{u}" for u in usernames if u not in encontrados]
+    if desconocidos:
+        await update.message.reply_text(
+            f"❌ No conozco a: {', '.join(desconocidos)}\n"
+            "Cada persona debe haber escrito al bot al menos una vez."
+        )
+        return
+
+    for otro_id in set(encontrados.values()) - {user_id}:
+        await ESCRITURAS.ejecutar(REPO.permitir_coordinacion, user_id, otro_id, permitir)
+    nombres = ", ".join(f"@{u}" for u in usernames)
+    pueden = "pueden" if len(usernames) > 1 else "puede"
+    if permitir:
+        await update.message.reply_text(f"🔓 {nombres} ya {pueden} buscar huecos comunes con usted en /coordinar.")
+    else:
+        await update.message.reply_text(f"🔒 {nombres} ya no {pueden} ver sus huecos en /coordinar.")
+
+def pagina_de_busqueda(user_id, texto, pagina):
+    # Se llama con asyncio.to_thread: consulta la DB. Pedimos un resultado de más para saber si hay página siguiente
+    filas = REPO.buscar(user_id, texto, RESULTADOS_POR_PAGINA + 1, pagina * RESULTADOS_POR_PAGINA)
+    hay_siguiente = len(filas) > RESULTADOS_POR_PAGINA
+    filas = filas[:RESULTADOS_POR_PAGINA]
+    if not filas:
+        return None, None
+
+    msg = f"🔍 **Resultados para** «{escape_markdown(texto)}» (página {pagina + 1}):\n\n{formatear_lista_citas(filas)}"
+    botones = []
+    if pagina > 0:
+        botones.append(InlineKeyboardButton("⬅️ Anterior", callback_data=f"buscar:{pagina - 1}"))
+    if hay_siguiente:
+        botones.append(InlineKeyboardButton("Siguiente ➡️", callback_data=f"buscar:{pagina + 1}"))
+    return msg, InlineKeyboardMarkup([botones]) if botones else None
+
+async def buscar(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    texto = " ".join(context.args)
+    if not construir_consulta_fts(texto):
+        await update.message.reply_text("🔍 Uso: `/buscar [texto]`\nEjemplo: `/buscar acme`", parse_mode='Markdown')
+        return
+
+    # Guardamos el texto para que los botones de página sepan qué buscar
+    context.user_data["busqueda"] = texto
+    msg, teclado = await asyncio.to_thread(pagina_de_busqueda, update.effective_user.id, texto, 0)
+    if not msg:
+        await update.message.reply_text(f"📂 No encontré citas que contengan «{texto}».")
+        return
+    await update.message.reply_text(msg, parse_mode='Markdown', reply_markup=teclado)
+
+async def buscar_pagina(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    texto = context.user_data.get("busqueda")
+    if not texto:
+        await query.edit_message_text("⌛ La búsqueda ha caducado. Vuelva a usar /buscar.")
+        return
+
+    pagina = int(query.data.split(":")[1])
+    msg, teclado = await asyncio.to_thread(pagina_de_busqueda, update.effective_user.id, texto, pagina)
+    if msg:
+        await query.edit_message_text(msg, parse_mode='Markdown', reply_markup=teclado)
+
+async def historial(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    args = context.args
+    if args:
+        rango = calcular_rango(args)
+        if not rango or rango[2] != len(args):
+            await update.message.reply_text(
+                "⚠️ **Uso:** `/historial` (últimos 30 días) o `/historial [desde] [hasta]`\n"
+                "Ej: `/historial 2026-01-01 2026-01-31`",
+                parse_mode='Markdown'
+            )
+            return
+        fecha_ini, fecha_fin, _ = rango
+    else:
+        hoy = datetime.now().date()
+        fecha_ini = (hoy - timedelta(days=30)).strftime("%Y-%m-%d")
+        fecha_fin = hoy.strftime("%Y-%m-%d")
+
+    citas = await asyncio.to_thread(REPO.historial, update.effective_user.id, fecha_ini, fecha_fin)
+    if not citas:
+        await update.message.reply_text(f"📂 No hay citas archivadas del {fecha_ini} al {fecha_fin}.")
+        return
+
+    msg = formatear_agenda_por_dia(
+        citas, f"🗄️ **Historial del {fecha_ini} al {fecha_fin}:**", "(Citas pasadas, solo lectura)"
+    )
+    await responder(update, msg, parse_mode='Markdown')
+
+async def tarea_archivar(context: ContextTypes.DEFAULT_TYPE):
+    limite = (datetime.now().date() - timedelta(days=ARCHIVO_RETENCION_DIAS)).strftime("%Y-%m-%d")
+    # En un hilo aparte: el archivado no debe frenar a los handlers
+    movidas = await asyncio.to_thread(REPO.archivar, limite, ARCHIVO_LOTE)
+    logger.info(f"Archivado: {movidas} citas anteriores a {limite} movidas a citas_archivo.")
+
+def hacer_copia_seguridad():
+    os.makedirs(COPIAS_DIR, exist_ok=True)
+    inicio = time.monotonic()
+    marca = datetime.now().strftime("%Y%m%d-%H%M%S")
+    temporal = os.path.join(COPIAS_DIR, f".meetmanager-{marca}.db")
+    destino = os.path.join(COPIAS_DIR, f"meetmanager-{marca}.db.gz")
+    try:
+        paginas = REPO.respaldar(temporal, COPIAS_PAGINAS_POR_PASO, COPIAS_PAUSA)
+        # Comprimimos por bloques, sin cargar la copia entera en memoria
+        with open(temporal, "rb") as origen, gzip.open(destino + ".tmp", "wb") as comprimido:
+            shutil.copyfileobj(origen, comprimido)
+        os.replace(destino + ".tmp", destino)
+    finally:
+        for sobrante in (temporal, destino + ".tmp"):
+            if os.path.exists(sobrante):
+                os.remove(sobrante)
+
+    # Rotación: nos quedamos con las COPIAS_CONSERVAR más recientes (el nombre lleva la fecha)
+    copias = sorted(glob.glob(os.path.join(COPIAS_DIR, "meetmanager-*.db.gz")))
+    for antigua in copias[:-COPIAS_CONSERVAR]:
+        os.remove(antigua)
+
+    ULTIMA_COPIA.update(
+        fecha=datetime.now(), duracion=time.monotonic() - inicio,
+        tamano=os.path.getsize(destino), archivo=destino
+    )
+    logger.info(f"Copia de seguridad {destino}: {paginas} páginas en {ULTIMA_COPIA['duracion']:.1f} s.")
+
+async def tarea_copia_seguridad(context: ContextTypes.DEFAULT_TYPE):
+    # En un hilo aparte; la copia avanza por pasos y no retiene la base de datos
+    try:
+        await asyncio.to_thread(hacer_copia_seguridad)
+    except Exception as e:
+        logger.error(f"Falló la copia de seguridad: {e}")
+
+# --- Recordatorios ---
+RECORDATORIOS = PlanificadorRecordatorios(REPO, RECORDATORIO_MINUTOS, timedelta(hours=RECORDATORIO_VENTANA_HORAS))
+REVISION_RECORDATORIOS = {"job_queue": None, "trabajo": None, "momento": None}
+
+def programar_recordatorios():
+    # Un único trabajo pendiente en la JobQueue: el del próximo aviso (o el del final de la ventana)
+    job_queue = REVISION_RECORDATORIOS["job_queue"]
+    if REVISION_RECORDATORIOS["trabajo"]:
+        REVISION_RECORDATORIOS["trabajo"].schedule_removal()
+    momento = RECORDATORIOS.siguiente()
+    espera = max(0, (momento - datetime.now()).total_seconds())
+    REVISION_RECORDATORIOS["trabajo"] = job_queue.run_once(revisar_recordatorios, when=espera, name="recordatorios")
+    REVISION_RECORDATORIOS["momento"] = momento
+
+async def revisar_recordatorios(context: ContextTypes.DEFAULT_TYPE):
+    REVISION_RECORDATORIOS["trabajo"] = None
+    ahora = datetime.now()
+    for user_id, (_, fecha, hora, duracion, asunto) in RECORDATORIOS.vencidos(ahora):
+        try:
+            # Texto plano: el asunto lo escribe el usuario y podría romper el Markdown
+            await context.bot.send_message(
+                chat_id=user_id,
+                text=f"⏰ Recordatorio: {asunto}\n📅 {fecha} de {hora} a {hora_fin(fecha, hora, duracion)} (empieza en {RECORDATORIO_MINUTOS} min)",
+                rate_limit_args=PRIORIDAD_AVISO
+            )
+        except TelegramError as e:
+            logger.warning(f"No se pudo enviar el recordatorio a {user_id}: {e}")
+    if ahora >= RECORDATORIOS.horizonte:
+        RECORDATORIOS.cargar_ventana(ahora)
+    programar_recordatorios()
+
+def usuario_cambiado_recordatorios(user_id):
+    RECORDATORIOS.usuario_cambiado(user_id, datetime.now())
+    # Solo hace falta mover el trabajo si ahora hay un aviso antes del que estaba programado
+    if REVISION_RECORDATORIOS["momento"] is None or RECORDATORIOS.siguiente() < REVISION_RECORDATORIOS["momento"]:
+        programar_recordatorios()
+
+async def iniciar_recordatorios(application):
+    if not RECORDATORIO_MINUTOS or not application.job_queue:
+        return
+    bucle = asyncio.get_running_loop()
+    REVISION_RECORDATORIOS["job_queue"] = application.job_queue
+    RECORDATORIOS.cargar_ventana(datetime.now())
+    # Los cambios se notifican desde el hilo del escritor: pasamos el trabajo al bucle de eventos
+    REPO.al_cambiar(lambda user_id: bucle.call_soon_threadsafe(usuario_cambiado_recordatorios, user_id))
+    programar_recordatorios()
+    logger.info(f"Recordatorios: {len(RECORDATORIOS)} avisos pendientes en las próximas {RECORDATORIO_VENTANA_HORAS} h.")
+
+# --- Resumen diario ---
+# Todo lo que se envía a Telegram pasa por COLA_SALIDA; los resúmenes entran con prioridad de fondo
+COLA_SALIDA = ColaSalida(SALIDA_POR_SEGUNDO)
+ENVIOS = EnviosFondo()
+RESUMEN_DIARIO = {"ultimo": None}  # último minuto cuyos resúmenes ya se encolaron
+
+def formatear_resumen(filas, fecha):
+    dia = DIAS_SEMANA[datetime.strptime(fecha, "%Y-%m-%d").weekday()]
+    if not filas:
+        return f"☀️ Su agenda de hoy ({dia} {fecha}): no tiene citas. ¡Buen día!"
+    # Texto plano: los asuntos los escribe el usuario y podrían romper el Markdown
+    lineas = [f"☀️ Su agenda de hoy ({dia} {fecha}):", ""]
+    for _, _, hora, duracion, asunto in filas:
+        lineas.append(f"🕒 {hora}-{hora_fin(fecha, hora, duracion)} {asunto}")
+    return "\n".join(lineas)
+
+async def tarea_resumen(context: ContextTypes.DEFAULT_TYPE):
+    # Cada minuto: una consulta por cada minuto pendiente con todos los suscritos a esa hora
+    ahora = datetime.now().replace(second=0, microsecond=0)
+    ultimo = RESUMEN_DIARIO["ultimo"] or ahora - timedelta(minutes=1)
+    momento = max(ultimo + timedelta(minutes=1), ahora - timedelta(minutes=RESUMEN_RECUPERAR_MINUTOS))
+    while momento <= ahora:
+        fecha = momento.strftime("%Y-%m-%d")
+        resumenes = await asyncio.to_thread(REPO.resumen_del_dia, momento.strftime("%H:%M"), fecha)
+        for user_id, filas in resumenes.items():
+            ENVIOS.encolar(user_id, formatear_resumen(filas, fecha))
+        if resumenes:
+            logger.info(f"Resumen de las {momento:%H:%M}: {len(resumenes)} envíos encolados.")
+        momento += timedelta(minutes=1)
+    RESUMEN_DIARIO["ultimo"] = ahora
+
+async def resumen(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    if not context.args:
+        hora = await asyncio.to_thread(REPO.suscripcion_resumen, user_id)
+        if hora:
+            await update.message.reply_text(f"☀️ Recibe su agenda del día a las *{hora}*. Use `/resumen off` para darse de baja.", parse_mode='Markdown')
+        else:
+            await update.message.reply_text("☀️ No está suscrito al resumen diario. Use `/resumen HH:MM` para recibirlo.", parse_mode='Markdown')
+        return
+
+    opcion = context.args[0].lower()
+    if opcion in ("off", "no", "baja"):
+        await ESCRITURAS.ejecutar(REPO.suscribir_resumen, user_id, None)
+        await update.message.reply_text("🔕 Ya no recibirá el resumen diario.")
+        return
+    try:
+        hora = datetime.strptime(opcion, "%H:%M").strftime("%H:%M")
+    except ValueError:
+        await update.message.reply_text("⚠️ Uso: `/resumen HH:MM` o `/resumen off`", parse_mode='Markdown')
+        return
+    await ESCRITURAS.ejecutar(REPO.suscribir_resumen, user_id, hora)
+    await update.message.reply_text(f"✅ Cada día a las *{hora}* le enviaré su agenda del día.", parse_mode='Markdown')
+
+# --- Métricas ---
+COMANDOS = set()  # comandos registrados; el resto se agrupa como "otro_comando" para no crear etiquetas sin fin
+ERRORES = metricas.contador("errores_total", "Excepciones no capturadas en los handlers", ["tipo"])
+SERVIDOR_METRICAS = {"servidor": None}
+VIGILANTE = VigilanteBucle(BLOQUEO_UMBRAL_MS / 1000)
+
+def tipo_de_actualizacion(update):
+    if not isinstance(update, Update):
+        return "otro"
+    if update.callback_query:
+        return "boton_" + (update.callback_query.data or "").split(":")[0]
+    mensaje = update.message
+    if not mensaje:
+        return "otro"
+    if mensaje.document:
+        return "documento"
+    texto = mensaje.text or ""
+    if texto.startswith("/"):
+        comando = texto.split()[0][1:].split("@")[0].lower()
+        return comando if comando in COMANDOS else "otro_comando"
+    return "mensaje"
+
+PROCESADOR = ProcesadorPorUsuario(
+    ACTUALIZACIONES_SIMULTANEAS, al_recibir=cancelar_generacion_anterior, clasificar=tipo_de_actualizacion
+)
+
+def aciertos_expansiones():
+    info = expandir_regla.cache_info()
+    return {("expansiones", "acierto"): info.hits, ("expansiones", "fallo"): info.misses}
+
+metricas.calculada("cache_expansiones_total", "Consultas a la caché de expansiones de reglas recurrentes",
+                   aciertos_expansiones, tipo="counter", etiquetas=["cache", "resultado"])
+metricas.calculada("actualizaciones_en_curso", "Actualizaciones en proceso o esperando turno", lambda: PROCESADOR.current_concurrent_updates)
+metricas.calculada("salida_pendientes", "Peticiones esperando en la cola de salida", lambda: COLA_SALIDA.pendientes)
+metricas.calculada("envios_fondo_pendientes", "Resúmenes pendientes de entrar en la cola de salida", lambda: len(ENVIOS))
+metricas.calculada("recordatorios_pendientes", "Avisos cargados en el montículo de recordatorios", lambda: len(RECORDATORIOS))
+metricas.calculada("escrituras_total", "Escrituras confirmadas por la cola de escritura", lambda: ESCRITURAS.operaciones, tipo="counter")
+metricas.calculada("commits_total", "Commits hechos por la cola de escritura", lambda: ESCRITURAS.lotes, tipo="counter")
+
+# Estructuras globales que viven lo que el proceso: su tamaño se vigila para detectar fugas
+MEMORIA = MonitorMemoria(MEMORIA_TRACEMALLOC)
+MEMORIA.vigilar("historial_usuarios", lambda: len(HISTORIAL))
+MEMORIA.vigilar("historial_lineas", lambda: sum(len(lineas) for lineas in list(HISTORIAL.values())))
+MEMORIA.vigilar("generaciones", lambda: len(GENERACIONES))
+MEMORIA.vigilar("usuarios_registrados", lambda: len(USUARIOS_REGISTRADOS))
+MEMORIA.vigilar("cache_ocupacion", lambda: len(CACHE_OCUPACION))
+MEMORIA.vigilar("cache_expansiones", lambda: expandir_regla.cache_info().currsize)
+MEMORIA.vigilar("cerrojos_usuario", lambda: PROCESADOR.usuarios_activos)
+MEMORIA.vigilar("chats_cola_salida", lambda: COLA_SALIDA.chats_recientes)
+MEMORIA.vigilar("recordatorios", lambda: len(RECORDATORIOS))
+MEMORIA.vigilar("envios_fondo", lambda: len(ENVIOS))
+metricas.calculada("estructura_elementos", "Elementos de cada estructura global vigilada",
+                   lambda: {(nombre,): tamano for nombre, tamano in MEMORIA.tamanos().items()}, etiquetas=["estructura"])
+
+async def registrar_error(update: object, context: ContextTypes.DEFAULT_TYPE):
+    ERRORES.inc(tipo_de_actualizacion(update))
+    logger.error("Excepción en un handler", exc_info=context.error)
+
+# --- Administración ---
+PERFILADOR = PerfiladorMuestreo()
+
+def es_admin(update):
+    return bool(update.effective_user) and update.effective_user.id in ADMIN_IDS
+
+async def perfil(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # /perfil on [segundos] | off | dump: perfilado por muestreo del bot en marcha
+    if not es_admin(update):
+        await update.message.reply_text("⛔ Este comando es solo para administradores.")
+        return
+    accion = context.args[0].lower() if context.args else ""
+
+    if accion == "on":
+        try:
+            segundos = int(context.args[1]) if len(context.args) > 1 else 60
+        except ValueError:
+            segundos = 0
+        if not 1 <= segundos <= PERFIL_SEGUNDOS_MAX:
+            await update.message.reply_text(f"⚠️ Indique entre 1 y {PERFIL_SEGUNDOS_MAX} segundos. Ej: `/perfil on 120`", parse_mode='Markdown')
+            return
+        # El hilo de este handler es el del bucle de eventos
+        await asyncio.to_thread(PERFILADOR.detener)
+        PERFILADOR.iniciar(segundos)
+        await update.message.reply_text(
+            f"🔬 Perfilador encendido durante *{segundos} s*. Use `/perfil dump` para ver el resultado.", parse_mode='Markdown'
+        )
+        return
+
+    if accion == "off":
+        await asyncio.to_thread(PERFILADOR.detener)
+        await update.message.reply_text(f"⏹ Perfilador apagado ({PERFILADOR.muestras} muestras).")
+        return
+
+    if accion == "dump":
+        if not PERFILADOR.muestras:
+            await update.message.reply_text("📭 No hay muestras. Encienda el perfilador con `/perfil on [segundos]`.", parse_mode='Markdown')
+            return
+        total = PERFILADOR.muestras
+        lineas = [f"`{acumulado / total:6.1%}` `{propio / total:6.1%}` {escape_markdown(funcion)}"
+                  for funcion, acumulado, propio in PERFILADOR.funciones_principales()]
+        estado_muestra = "en curso" if PERFILADOR.activo else "terminada"
+        ocupacion = total / (total + PERFILADOR.ociosas)
+        await responder(
+            update,
+            f"🔬 *Perfil* ({estado_muestra}, {total} muestras, ocupado el {ocupacion:.0%} del tiempo)\n"
+            "_acumulado · propio · función_\n\n" + "\n".join(lineas),
+            parse_mode='Markdown'
+        )
+        nombre = f"perfil-{datetime.fromtimestamp(PERFILADOR.inicio).strftime('%Y%m%d-%H%M%S')}.txt"
+        await update.message.reply_document(
+            document=PERFILADOR.pilas_colapsadas().encode(),
+            filename=nombre,
+            caption="🔥 Pilas colapsadas para flamegraph.pl o https://www.speedscope.app"
+        )
+        return
+
+    estado_perfil = "🟢 encendido" if PERFILADOR.activo else "⚪ apagado"
+    await update.message.reply_text(
+        f"🔬 Perfilador {estado_perfil}.\n\n"
+        "**Uso:** `/perfil on [segundos]`, `/perfil off` o `/perfil dump`",
+        parse_mode='Markdown'
+    )
+
+async def memoria(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # /memoria: uso de memoria del bot y qué lo hace crecer
+    if not es_admin(update):
+        await update.message.reply_text("⛔ Este comando es solo para administradores.")
+        return
+    await asyncio.to_thread(MEMORIA.tomar_muestra)
+
+    texto = f"🧠 *Memoria*\n\nRSS: *{formatear_bytes(MEMORIA.muestras[-1][1])}*"
+    tendencia = MEMORIA.tendencia()
+    if tendencia is not None:
+        desde = datetime.fromtimestamp(MEMORIA.muestras[0][0]).strftime("%d/%m %H:%M")
+        texto += f" ({'+' if tendencia >= 0 else ''}{formatear_bytes(tendencia)}/h desde el {desde})"
+    texto += "\n\n*Estructuras globales:*\n" + "\n".join(
+        f"• {escape_markdown(nombre)}: {tamano}" for nombre, tamano in MEMORIA.tamanos().items()
+    )
+
+    trazada = memoria_trazada()
+    if trazada is None:
+        texto += "\n\n_tracemalloc desactivado (active MEMORIA\\_TRACEMALLOC para ver qué reserva memoria)_"
+    else:
+        texto += f"\n\n*tracemalloc:* {formatear_bytes(trazada)} reservados"
+        for titulo, diferencias in (("desde el arranque", MEMORIA.desde_arranque), ("desde la muestra anterior", MEMORIA.desde_anterior)):
+            if diferencias:
+                texto += f"\n\n*Mayores cambios {titulo}:*\n" + "\n".join(
+                    f"`{'+' if tamano > 0 else ''}{formatear_bytes(tamano)}` {escape_markdown(sitio)} ({bloques:+d} bloques)"
+                    for sitio, tamano, bloques in diferencias
+                )
+    await responder(update, texto, parse_mode='Markdown')
+
+async def tarea_memoria(context: ContextTypes.DEFAULT_TYPE):
+    await asyncio.to_thread(MEMORIA.tomar_muestra)
+    tendencia = MEMORIA.tendencia()
+    logger.info(
+        f"Memoria: RSS {formatear_bytes(MEMORIA.muestras[-1][1])}"
+        + (f", {formatear_bytes(tendencia)}/h" if tendencia is not None else "")
+    )
+
+async def al_iniciar(application):
+    # Los cambios se notifican desde el hilo del escritor y del archivado: la caché se toca en el bucle
+    bucle = asyncio.get_running_loop()
+    REPO.al_cambiar(lambda user_id: bucle.call_soon_threadsafe(invalidar_ocupacion, user_id))
+    ENVIOS.iniciar(application.bot)
+    await iniciar_recordatorios(application)
+    if METRICAS_PUERTO:
+        SERVIDOR_METRICAS["servidor"] = await metricas.servir(METRICAS_PUERTO, METRICAS_HOST)
+        logger.info(f"Métricas en http://{METRICAS_HOST}:{METRICAS_PUERTO}/metrics")
+    if BLOQUEO_UMBRAL_MS:
+        VIGILANTE.iniciar()
+    MEMORIA.iniciar()
+    if TRAZAS_MUESTREO:
+        trazas.configurar(TRAZAS_MUESTREO, TRAZAS_ARCHIVO)
+        logger.info(f"Trazando el {TRAZAS_MUESTREO:.0%} de las actualizaciones en {TRAZAS_ARCHIVO}")
+
+def describir_ultima_copia():
+    if ULTIMA_COPIA:
+        fecha, duracion = ULTIMA_COPIA["fecha"], f" (duró {ULTIMA_COPIA['duracion']:.1f} s)"
+    else:
+        # Recién arrancados: miramos la copia más reciente que haya en disco
+        copias = sorted(glob.glob(os.path.join(COPIAS_DIR, "meetmanager-*.db.gz")))
+        if not copias:
+            return "💾 Sin copias de seguridad todavía"
+        fecha, duracion = datetime.fromtimestamp(os.path.getmtime(copias[-1])), ""
+
+    minutos = int((datetime.now() - fecha).total_seconds() // 60)
+    if minutos < 60:
+        antiguedad = f"{minutos} min"
+    elif minutos < 48 * 60:
+        antiguedad = f"{minutos // 60} h"
+    else:
+        antiguedad = f"{minutos // (24 * 60)} días"
+    return f"💾 Última copia: hace {antiguedad}{duracion}"
+
+async def importar_documento(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    documento = update.message.document
+    extension = os.path.splitext(documento.file_name or "")[1].lower()
+    if extension not in (".ics", ".csv"):
+        await update.message.reply_text("⚠️ Solo puedo importar calendarios en formato `.ics` o `.csv`.", parse_mode='Markdown')
+        return
+
+    # La API de bots de Telegram no permite descargar archivos de más de 20 MB
+    if documento.file_size and documento.file_size > 20 * 1024 * 1024:
+        await update.message.reply_text("⛔ El archivo supera el límite de 20 MB que permite Telegram.")
+        return
+
+    await context.bot.send_chat_action(chat_id=update.effective_chat.id, action=ChatAction.TYPING)
+    user_id = update.effective_user.id
+    estadisticas = {"leidos": 0, "descartados": 0}
+    lector = leer_eventos_ics if extension == ".ics" else leer_eventos_csv
+
+    descriptor, ruta = tempfile.mkstemp(suffix=extension)
+    os.close(descriptor)
+    eventos = None
+    insertadas = 0
+    try:
+        archivo = await documento.get_file()
+        await archivo.download_to_drive(ruta)
+        # El archivo se lee en un hilo de asyncio.to_thread, no en el escritor compartido: a la cola de
+        # escritura solo llegan lotes ya leídos de IMPORTACION_LOTE citas, que se confirman cada uno en
+        # su commit, así un calendario enorme no retiene las escrituras del resto de usuarios.
+        eventos = lector(ruta, estadisticas)
+        while lote := await asyncio.to_thread(list, itertools.islice(eventos, IMPORTACION_LOTE)):
+            insertadas += await ESCRITURAS.ejecutar(REPO.crear_varios, user_id, lote)
+    except Exception as e:
+        logger.error(f"Error importando {documento.file_name}: {e}")
+        if insertadas:
+            # Los lotes anteriores ya están confirmados: se dice exactamente cuántas citas se quedaron
+            await update.message.reply_text(
+                f"⚠️ La importación se interrumpió a medias: se guardaron {insertadas} citas y el resto del archivo "
+                "no se importó. Puede volver a enviarlo; las citas ya guardadas se contarán como duplicadas."
+            )
+        else:
+            await update.message.reply_text(
+                "❌ No pude leer el archivo. Compruebe que es un calendario válido. No se ha importado ninguna cita."
+            )
+        return
+    finally:
+        if eventos is not None:
+            eventos.close()
+        os.remove(ruta)
+
+    validos = estadisticas["leidos"] - estadisticas["descartados"]
+    await update.message.reply_text(
+        f"📥 **Importación completada** (`{documento.file_name}`)\n\n"
+        f"✅ Citas nuevas: `{insertadas}`\n"
+        f"♻️ Duplicadas (ya estaban en su agenda): `{validos - insertadas}`\n"
+        f"⚠️ Descartadas (sin fecha válida o canceladas): `{estadisticas['descartados']}`\n\n"
+        "ℹ️ Al importar no se comprueban solapamientos con su agenda: revísela con /agenda.",
+        parse_mode='Markdown'
+    )
+
+async def exportar(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    args = list(context.args)
+    formato = "ics"
+    if args and args[0].lower() in ("ics", "csv"):
+        formato = args.pop(0).lower()
+
+    fecha_ini = fecha_fin = None
+    if args:
+        rango = calcular_rango(args)
+        if not rango or rango[2] != len(args):
+            await update.message.reply_text(
+                "⚠️ **Uso:** `/exportar [ics|csv] [rango]`\n"
+                "Ej: `/exportar csv mes` o `/exportar ics 2026-03-01 2026-03-31`",
+                parse_mode='Markdown'
+            )
+            return
+        fecha_ini, fecha_fin, _ = rango
+
+    await context.bot.send_chat_action(chat_id=update.effective_chat.id, action=ChatAction.UPLOAD_DOCUMENT)
+    user_id = update.effective_user.id
+
+    descriptor, ruta = tempfile.mkstemp(suffix=f".{formato}")
+    os.close(descriptor)
+    try:
+        # Escribimos el archivo en un hilo aparte, fila a fila desde el cursor
+        total = await asyncio.to_thread(exportar_agenda, user_id, ruta, formato, fecha_ini, fecha_fin)
+        if total == 0:
+            await update.message.reply_text("📂 No hay citas que exportar.")
+            return
+
+        nombre = f"agenda-{datetime.now().strftime('%Y%m%d')}.{formato}"
+        with open(ruta, "rb") as archivo:
+            await update.message.reply_document(
+                document=archivo,
+                filename=nombre,
+                caption=f"📤 {total} citas exportadas."
+            )
+    finally:
+        os.remove(ruta)
+
+def historial_de(user_id):
+    # Historial del chat libre del usuario; al pasar de HISTORIAL_USUARIOS se olvida el menos reciente
+    historial = HISTORIAL.get(user_id)
+    if historial is None:
+        historial = HISTORIAL[user_id] = deque(maxlen=HISTORIAL_LINEAS)
+    HISTORIAL.move_to_end(user_id)
+    while len(HISTORIAL) > HISTORIAL_USUARIOS:
+        HISTORIAL.popitem(last=False)
+    return historial
+
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.is_bot: return
     
@@ -600,7 +2257,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     elif msg == "🔍 Buscar Cita":
-        await update.message.reply_text("🔍 Use: `/cita [fecha]`")
+        await update.message.reply_text("🔍 Use: `/cita [fecha]` o `/buscar [texto]`")
         return
 
     elif msg == "❌ Cancelar/Limpiar":
@@ -611,22 +2268,55 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # --- LÓGICA IA ---
     await context.bot.send_chat_action(chat_id=update.effective_chat.id, action=ChatAction.TYPING)
-    contexto_str = "\n".join(HISTORIAL[-4:])
-    res = consultar_chat_libre(msg, system_extra=f"\nHistorial previo:\n{contexto_str}")   
-    HISTORIAL.append(f"U: {msg}")
-    HISTORIAL.append(f"A: {res}")
-    if len(HISTORIAL) > 10: HISTORIAL.pop(0)
-    await update.message.reply_text(res)
+    user_id = update.effective_user.id
+    historial = historial_de(user_id)
+    contexto_str = "\n".join(list(historial)[-4:])
+    tarea = asyncio.create_task(consultar_chat_libre(msg, system_extra=f"\nHistorial previo:\n{contexto_str}"))
+    GENERACIONES[user_id] = tarea
+    try:
+        await asyncio.wait([tarea])
+    finally:
+        if GENERACIONES.get(user_id) is tarea:
+            del GENERACIONES[user_id]
+    if tarea.cancelled():
+        # El usuario ya ha escrito otra cosa: la respuesta a esta pregunta no le interesa
+        return
+    res = tarea.result()
+    historial.append(f"U: {msg}")
+    historial.append(f"A: {res}")
+    await responder(update, res)
 
+async def cerrar_escrituras(application):
+    # Al parar el bot, confirmamos las escrituras que queden en la cola
+    await VIGILANTE.detener()
+    await asyncio.to_thread(PERFILADOR.detener)
+    await ENVIOS.detener()
+    await ESCRITURAS.detener()
+    trazas.detener()
+    if CLIENTE_OLLAMA["cliente"]:
+        await CLIENTE_OLLAMA["cliente"].aclose()
+        CLIENTE_OLLAMA["cliente"] = None
+    if SERVIDOR_METRICAS["servidor"]:
+        SERVIDOR_METRICAS["servidor"].close()
 
 
 # --- 5. EJECUCIÓN PRINCIPAL ---
-if __name__ == '__main__':
-    init_db()
-    if not TOKEN:
-        print("❌ Falta TELEGRAM_TOKEN en .env")
-        exit()
-    application = ApplicationBuilder().token(TOKEN).build()
+def crear_aplicacion(token, peticiones=None):
+    # La aplicación con todos sus handlers y trabajos periódicos. 'peticiones' sustituye al cliente HTTP
+    # hacia Telegram (prueba_memoria.py usa uno falso para mover el bot sin red)
+    constructor = (
+        ApplicationBuilder()
+        .token(token)
+        .concurrent_updates(PROCESADOR)
+        .rate_limiter(COLA_SALIDA)
+        .post_init(al_iniciar)
+        .post_shutdown(cerrar_escrituras)
+    )
+    if peticiones is not None:
+        constructor = constructor.request(peticiones)
+    application = constructor.build()
+    MEMORIA.vigilar("datos_usuario", lambda: len(application.user_data))
+    application.add_handler(TypeHandler(Update, registrar_usuario), group=-1)
     application.add_handler(CommandHandler('start', start))
     application.add_handler(CommandHandler('agendar', agendar))
     application.add_handler(CommandHandler('agenda', ver_agenda))
@@ -636,8 +2326,63 @@ if __name__ == '__main__':
     application.add_handler(CommandHandler("help", help_command))
     application.add_handler(CommandHandler('cancelar', cancelar))
     application.add_handler(CommandHandler('reprogramar', reprogramar))
+    application.add_handler(CommandHandler('desplazar', desplazar))
+    application.add_handler(CommandHandler('renombrar', renombrar))
     application.add_handler(CommandHandler('limpiar', limpiar))
+    application.add_handler(CommandHandler('recurrente', recurrente))
+    application.add_handler(CommandHandler('excepcion', excepcion))
     application.add_handler(CommandHandler('cita', cita))
+    application.add_handler(CommandHandler('exportar', exportar))
+    application.add_handler(CommandHandler('hueco', hueco))
+    application.add_handler(CommandHandler('coordinar', coordinar))
+    application.add_handler(CommandHandler('compartir', compartir))
+    application.add_handler(CommandHandler('buscar', buscar))
+    application.add_handler(CommandHandler('historial', historial))
+    application.add_handler(CommandHandler('resumen', resumen))
+    application.add_handler(CommandHandler('perfil', perfil))
+    application.add_handler(CommandHandler('memoria', memoria))
+    application.add_handler(CallbackQueryHandler(buscar_pagina, pattern=r"^buscar:\d+$"))
+    application.add_handler(CallbackQueryHandler(confirmar_masiva, pattern=r"^masiva:(si|no):[0-9a-f]+$"))
+    application.add_handler(MessageHandler(filters.Document.ALL, importar_documento))
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
+    application.add_error_handler(registrar_error)
+    COMANDOS.update(c for h in application.handlers[0] if isinstance(h, CommandHandler) for c in h.commands)
+    if application.job_queue:
+        application.job_queue.run_repeating(tarea_archivar, interval=ARCHIVO_INTERVALO_HORAS * 3600, first=60)
+        if REPO.admite_copias:
+            application.job_queue.run_repeating(tarea_copia_seguridad, interval=COPIAS_INTERVALO_HORAS * 3600, first=300)
+        # Alineado al comienzo de cada minuto (con un segundo de margen)
+        application.job_queue.run_repeating(tarea_resumen, interval=60, first=61 - datetime.now().second)
+        if MEMORIA_INTERVALO_MINUTOS:
+            application.job_queue.run_repeating(tarea_memoria, interval=MEMORIA_INTERVALO_MINUTOS * 60, first=60)
+    else:
+        logger.warning("JobQueue no disponible (instale python-telegram-bot[job-queue]): no se archivarán citas pasadas, ni se harán copias de seguridad, ni se enviarán recordatorios ni resúmenes, ni se vigilará la memoria.")
+    return application
+
+
+if __name__ == '__main__':
+    REPO.inicializar()
+    if not TOKEN:
+        print("❌ Falta TELEGRAM_TOKEN en .env")
+        exit()
+    application = crear_aplicacion(TOKEN)
     print("🤖 MeetManager activo. DB conectada.")
-    application.run_polling()
+    if MODO_SERVIDOR == "webhook":
+        if not WEBHOOK_URL or not WEBHOOK_SECRETO:
+            print("❌ El modo webhook necesita WEBHOOK_URL y WEBHOOK_SECRETO en .env")
+            exit()
+        # Servidor HTTP embebido (tornado): registra el webhook en Telegram y atiende las peticiones
+        # con la cabecera X-Telegram-Bot-Api-Secret-Token correcta; el resto recibe un 403
+        print(f"🌐 Webhook escuchando en {WEBHOOK_ESCUCHAR}:{WEBHOOK_PUERTO}/{WEBHOOK_RUTA}")
+        application.run_webhook(
+            listen=WEBHOOK_ESCUCHAR,
+            port=WEBHOOK_PUERTO,
+            url_path=WEBHOOK_RUTA,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_RUTA}",
+            secret_token=WEBHOOK_SECRETO,
+            max_connections=WEBHOOK_MAX_CONEXIONES,
+            cert=WEBHOOK_CERTIFICADO,
+            key=WEBHOOK_CLAVE
+        )
+    else:
+        application.run_polling()
@@ -0,0 +1,122 @@
+# --- MEMORIA ---
+# El bot pasa semanas arrancado: cualquier estructura global que crezca sin límite acaba en un OOM.
+# MonitorMemoria toma muestras periódicas de:
+#   * la memoria residente (RSS) del proceso, para ver la tendencia;
+#   * el tamaño de las estructuras globales que se le registran con vigilar() (historial, cachés...);
+#   * con tracemalloc activo (marcos > 0), una foto de las reservas de memoria: se compara con la del
+#     arranque y con la anterior para ver qué líneas del código no paran de reservar.
+# tracemalloc ralentiza todas las reservas de memoria, así que solo se activa si se pide.
+# tomar_muestra() recorre toda la memoria reservada: llámese desde un hilo (asyncio.to_thread).
+import logging
+import os
+import threading
+import time
+import tracemalloc
+from collections import deque
+
+import metricas
+
+logger = logging.getLogger(__name__)
+
+# Reservas que son del propio tracemalloc o de importar módulos, no del bot
+FILTROS = (
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+    tracemalloc.Filter(False, "<unknown>"),
+)
+
+
+def rss_actual():
+    # Memoria residente en bytes; fuera de Linux, el máximo alcanzado (es lo que da getrusage)
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        import resource
+        maximo = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return maximo if os.uname().sysname == "Darwin" else maximo * 1024
+
+
+def memoria_trazada():
+    # Bytes reservados que sigue tracemalloc, o None si está desactivado
+    return tracemalloc.get_traced_memory()[0] if tracemalloc.is_tracing() else None
+
+
+def formatear_bytes(cantidad):
+    signo = "-" if cantidad < 0 else ""
+    cantidad = abs(cantidad)
+    for unidad in ("B", "KB", "MB"):
+        if cantidad < 1024:
+            return f"{signo}{cantidad:.0f} {unidad}" if unidad == "B" else f"{signo}{cantidad:.1f} {unidad}"
+        cantidad /= 1024
+    return f"{signo}{cantidad:.2f} GB"
+
+
+class MonitorMemoria:
+
+    def __init__(self, marcos=0, muestras=288, principales=10):
+        self.marcos = marcos  # profundidad de pila que guarda tracemalloc (0 lo desactiva)
+        self.principales = principales
+        self.muestras = deque(maxlen=muestras)  # (time.time(), rss)
+        self.estructuras = {}  # nombre -> función que da su tamaño
+        self.desde_arranque = []  # [(sitio, bytes de diferencia, bloques de diferencia)]
+        self.desde_anterior = []
+        self._base = None
+        self._anterior = None
+        self._cerrojo = threading.Lock()
+
+    def vigilar(self, nombre, tamano):
+        self.estructuras[nombre] = tamano
+
+    def iniciar(self):
+        if self.marcos and not tracemalloc.is_tracing():
+            tracemalloc.start(self.marcos)
+            logger.info(f"tracemalloc activo ({self.marcos} marcos por reserva)")
+
+    def tamanos(self):
+        resultado = {}
+        for nombre, tamano in self.estructuras.items():
+            try:
+                resultado[nombre] = tamano()
+            except Exception as e:
+                logger.warning(f"No se pudo medir {nombre}: {e}")
+        return resultado
+
+    @staticmethod
+    def _diferencias(foto, referencia, cuantas):
+        diferencias = foto.compare_to(referencia, "lineno")
+        return [
+            (f"{os.path.basename(d.traceback[0].filename)}:{d.traceback[0].lineno}", d.size_diff, d.count_diff)
+            for d in diferencias[:cuantas] if d.size_diff
+        ]
+
+    def tomar_muestra(self):
+        with self._cerrojo:
+            self.muestras.append((time.time(), rss_actual()))
+            if not tracemalloc.is_tracing():
+                return
+            foto = tracemalloc.take_snapshot().filter_traces(FILTROS)
+            if self._base is None:
+                self._base = foto
+            else:
+                self.desde_arranque = self._diferencias(foto, self._base, self.principales)
+                # Con solo dos fotos la anterior es la del arranque: no se repite la lista
+                self.desde_anterior = [] if self._anterior is self._base else self._diferencias(foto, self._anterior, self.principales)
+            self._anterior = foto
+
+    def tendencia(self, minimo=600):
+        # Bytes por hora entre la primera y la última muestra (None si no las separan 'minimo' segundos)
+        if len(self.muestras) < 2:
+            return None
+        (inicio, rss_inicio), (fin, rss_fin) = self.muestras[0], self.muestras[-1]
+        if fin - inicio < minimo:
+            return None
+        return (rss_fin - rss_inicio) / (fin - inicio) * 3600
+
+
+metricas.calculada("memoria_rss_bytes", "Memoria residente del proceso", rss_actual)
+metricas.calculada(
+    "memoria_tracemalloc_bytes", "Memoria reservada que sigue tracemalloc (0 si está desactivado)",
+    lambda: memoria_trazada() or 0
+)
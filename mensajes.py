@@ -0,0 +1,105 @@
+# --- MENSAJES LARGOS ---
+# Telegram rechaza los mensajes de más de 4096 caracteres (contados en unidades UTF-16: un emoji cuenta 2).
+# dividir_mensaje parte el texto por el mejor sitio disponible: entre párrafos, entre líneas, entre
+# palabras y, solo si no queda otra, en mitad de una palabra. Con markdown=True (el Markdown clásico
+# que usan los handlers) no deja una entidad abierta: si el corte cae dentro de `código`, *negrita*,
+# _cursiva_ o de un bloque ```, la cierra al final de la parte y la vuelve a abrir al principio de la siguiente.
+LIMITE_MENSAJE = 4096
+MARGEN_ENTIDADES = 8  # sitio para cerrar y reabrir una entidad en los cortes
+
+
+def longitud_telegram(texto):
+    return len(texto.encode("utf-16-le")) // 2
+
+
+def _prefijo_que_cabe(texto, limite):
+    # Número de caracteres del principio de 'texto' que caben en 'limite' unidades UTF-16
+    unidades = 0
+    for i, caracter in enumerate(texto):
+        unidades += 2 if ord(caracter) > 0xFFFF else 1
+        if unidades > limite:
+            return i
+    return len(texto)
+
+
+def _punto_de_corte(texto, limite, desde=0):
+    # (fin de esta parte, comienzo de la siguiente): los separadores del corte no se envían.
+    # Solo se corta después de 'desde' (la entidad reabierta de la parte anterior): cada parte avanza.
+    cabe = max(_prefijo_que_cabe(texto, limite), desde + 1)
+    parrafo = texto.rfind("\n\n", desde + 1, cabe)
+    if parrafo >= cabe // 2:
+        return parrafo, parrafo + 2
+    for separador in ("\n", " "):
+        posicion = texto.rfind(separador, desde + 1, cabe)
+        if posicion > 0:
+            return posicion, posicion + 1
+    return cabe, cabe
+
+
+def entidad_abierta(texto):
+    # Entidad de Markdown clásico que queda sin cerrar al final de 'texto' ("*", "_", "`", "```" o None)
+    abierta = None
+    i = 0
+    while i < len(texto):
+        if abierta in ("`", "```"):
+            # Dentro de código no hay más entidades
+            if texto.startswith(abierta, i):
+                i += len(abierta)
+                abierta = None
+            else:
+                i += 1
+            continue
+        caracter = texto[i]
+        if caracter == "\\" and abierta is None:
+            i += 2
+            continue
+        if abierta is None and texto.startswith("```", i):
+            abierta = "```"
+            i += 3
+            continue
+        if caracter in "*_`":
+            if abierta is None:
+                abierta = caracter
+            elif abierta == caracter:
+                abierta = None
+        i += 1
+    return abierta
+
+
+def dividir_mensaje(texto, limite=LIMITE_MENSAJE, markdown=False):
+    partes = []
+    reabrir = ""
+    resto = texto
+    while longitud_telegram(reabrir + resto) > limite:
+        resto = reabrir + resto
+        fin, siguiente = _punto_de_corte(resto, limite - (MARGEN_ENTIDADES if markdown else 0), len(reabrir))
+        parte, resto = resto[:fin], resto[siguiente:]
+        reabrir = ""
+        # Una parte con solo la marca de apertura (p. ej. "```" antes de una línea larga) no se envía
+        vacia = not parte.strip()
+        if markdown:
+            abierta = entidad_abierta(parte)
+            vacia = vacia or parte.strip() == abierta
+            if abierta == "```":
+                parte, reabrir = parte + "\n```", "```\n"
+            elif abierta:
+                parte, reabrir = parte + abierta, abierta
+        if not vacia:
+            partes.append(parte)
+    resto = reabrir + resto
+    if resto.strip() or not partes:
+        partes.append(resto)
+    return partes
+
+
+async def responder(update, texto, **opciones):
+    # Envía 'texto' en tantos mensajes como haga falta, en orden. El teclado (reply_markup) va en el último.
+    markdown = (opciones.get("parse_mode") or "").lower() == "markdown"
+    partes = dividir_mensaje(texto, markdown=markdown)
+    teclado = opciones.pop("reply_markup", None)
+    mensaje = None
+    for i, parte in enumerate(partes):
+        if i == len(partes) - 1 and teclado is not None:
+            opciones["reply_markup"] = teclado
+        mensaje = await update.effective_message.reply_text(parte, **opciones)
+    return mensaje
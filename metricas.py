@@ -0,0 +1,236 @@
+# --- MÉTRICAS ---
+# Contadores, indicadores e histogramas en memoria, expuestos en el formato de texto de Prometheus
+# (https://prometheus.io/docs/instrumenting/exposition_formats/) por un pequeño servidor HTTP local.
+# Sin dependencias: cada métrica guarda sus valores por combinación de etiquetas y se puede actualizar
+# desde cualquier hilo (la base de datos trabaja en hilos aparte).
+#   LATENCIA = histograma("handler_segundos", "Duración de cada handler", ["tipo"])
+#   LATENCIA.observar(0.12, "agendar")
+import asyncio
+import bisect
+import functools
+import inspect
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+PREFIJO = "meetmanager_"
+CUBETAS_SEGUNDOS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+REGISTRO = []
+
+
+def _etiquetas(nombres, valores):
+    if not nombres:
+        return ""
+    pares = []
+    for nombre, valor in zip(nombres, valores):
+        valor = str(valor).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        pares.append(f'{nombre}="{valor}"')
+    return "{" + ",".join(pares) + "}"
+
+
+def _numero(valor):
+    if valor == float("inf"):
+        return "+Inf"
+    return repr(float(valor)) if isinstance(valor, float) else str(valor)
+
+
+class Metrica:
+    tipo = "untyped"
+
+    def __init__(self, nombre, ayuda, etiquetas=()):
+        self.nombre = PREFIJO + nombre
+        self.ayuda = ayuda
+        self.etiquetas = tuple(etiquetas)
+        self._valores = {}
+        self._cerrojo = threading.Lock()
+        if not self.etiquetas and self.tipo in ("counter", "gauge"):
+            # Sin etiquetas la serie existe desde el principio (con 0), aunque nadie la haya tocado
+            self._valores[()] = 0
+        REGISTRO.append(self)
+
+    def _cabecera(self):
+        return [f"# HELP {self.nombre} {self.ayuda}", f"# TYPE {self.nombre} {self.tipo}"]
+
+    def exponer(self):
+        with self._cerrojo:
+            valores = list(self._valores.items())
+        return self._cabecera() + [
+            f"{self.nombre}{_etiquetas(self.etiquetas, clave)} {_numero(valor)}" for clave, valor in sorted(valores)
+        ]
+
+
+class Contador(Metrica):
+    tipo = "counter"
+
+    def inc(self, *etiquetas, valor=1):
+        with self._cerrojo:
+            self._valores[etiquetas] = self._valores.get(etiquetas, 0) + valor
+
+
+class Indicador(Metrica):
+    tipo = "gauge"
+
+    def fijar(self, valor, *etiquetas):
+        with self._cerrojo:
+            self._valores[etiquetas] = valor
+
+    def inc(self, *etiquetas, valor=1):
+        with self._cerrojo:
+            self._valores[etiquetas] = self._valores.get(etiquetas, 0) + valor
+
+    def dec(self, *etiquetas, valor=1):
+        self.inc(*etiquetas, valor=-valor)
+
+
+class Calculada(Metrica):
+    # Se calcula al exponerla: funcion() devuelve un número o {tupla de etiquetas: número}
+
+    def __init__(self, nombre, ayuda, funcion, tipo="gauge", etiquetas=()):
+        super().__init__(nombre, ayuda, etiquetas)
+        self.tipo = tipo
+        self.funcion = funcion
+
+    def exponer(self):
+        try:
+            valores = self.funcion()
+        except Exception as e:
+            logger.warning(f"No se pudo calcular la métrica {self.nombre}: {e}")
+            return []
+        if not isinstance(valores, dict):
+            valores = {(): valores}
+        return self._cabecera() + [
+            f"{self.nombre}{_etiquetas(self.etiquetas, clave)} {_numero(valor)}" for clave, valor in sorted(valores.items())
+        ]
+
+
+class Histograma(Metrica):
+    tipo = "histogram"
+
+    def __init__(self, nombre, ayuda, etiquetas=(), cubetas=CUBETAS_SEGUNDOS):
+        super().__init__(nombre, ayuda, etiquetas)
+        self.cubetas = tuple(cubetas)
+
+    def observar(self, valor, *etiquetas):
+        with self._cerrojo:
+            datos = self._valores.get(etiquetas)
+            if datos is None:
+                # [cuenta por cubeta (sin acumular; la última es +Inf), suma, total]
+                datos = self._valores[etiquetas] = [[0] * (len(self.cubetas) + 1), 0.0, 0]
+            datos[0][bisect.bisect_left(self.cubetas, valor)] += 1
+            datos[1] += valor
+            datos[2] += 1
+
+    def medir(self, *etiquetas):
+        return _Cronometro(self, etiquetas)
+
+    def exponer(self):
+        with self._cerrojo:
+            valores = [(clave, list(datos[0]), datos[1], datos[2]) for clave, datos in self._valores.items()]
+        lineas = self._cabecera()
+        for clave, cuentas, suma, total in sorted(valores):
+            acumulado = 0
+            for limite, cuenta in zip(self.cubetas + (float("inf"),), cuentas):
+                acumulado += cuenta
+                etiquetas = _etiquetas(self.etiquetas + ("le",), clave + (_numero(limite),))
+                lineas.append(f"{self.nombre}_bucket{etiquetas} {acumulado}")
+            lineas.append(f"{self.nombre}_sum{_etiquetas(self.etiquetas, clave)} {_numero(suma)}")
+            lineas.append(f"{self.nombre}_count{_etiquetas(self.etiquetas, clave)} {total}")
+        return lineas
+
+
+class _Cronometro:
+    # with HISTOGRAMA.medir("etiqueta"): ...  (sirve también con async with)
+
+    def __init__(self, histograma, etiquetas):
+        self.histograma = histograma
+        self.etiquetas = etiquetas
+
+    def __enter__(self):
+        self.inicio = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histograma.observar(time.perf_counter() - self.inicio, *self.etiquetas)
+
+    async def __aenter__(self):
+        return self.__enter__()
+
+    async def __aexit__(self, *exc):
+        self.__exit__(*exc)
+
+
+def contador(nombre, ayuda, etiquetas=()):
+    return Contador(nombre, ayuda, etiquetas)
+
+
+def indicador(nombre, ayuda, etiquetas=()):
+    return Indicador(nombre, ayuda, etiquetas)
+
+
+def histograma(nombre, ayuda, etiquetas=(), cubetas=CUBETAS_SEGUNDOS):
+    return Histograma(nombre, ayuda, etiquetas, cubetas)
+
+
+def calculada(nombre, ayuda, funcion, tipo="gauge", etiquetas=()):
+    return Calculada(nombre, ayuda, funcion, tipo, etiquetas)
+
+
+def instrumentar(objeto, histograma_destino, nombres):
+    # Sustituye en 'objeto' (en la instancia, no en la clase) cada método de 'nombres' por uno que mide
+    # su duración con la etiqueta del nombre del método. Los generadores no se miden: devuelven al momento.
+    # Solo se mide la llamada de fuera: si un método medido llama a otro (agenda -> rango), el interno no
+    # se observa, para no contar dos veces el mismo tiempo. Las llamadas anidadas van siempre en el mismo hilo.
+    en_curso = threading.local()
+    for nombre in nombres:
+        metodo = getattr(objeto, nombre)
+        if inspect.isgeneratorfunction(metodo):
+            continue
+
+        @functools.wraps(metodo)
+        def medido(*args, _metodo=metodo, _nombre=nombre, **kwargs):
+            if getattr(en_curso, "activo", False):
+                return _metodo(*args, **kwargs)
+            en_curso.activo = True
+            inicio = time.perf_counter()
+            try:
+                return _metodo(*args, **kwargs)
+            finally:
+                histograma_destino.observar(time.perf_counter() - inicio, _nombre)
+                en_curso.activo = False
+
+        setattr(objeto, nombre, medido)
+
+
+def exponer():
+    lineas = []
+    for metrica in REGISTRO:
+        lineas.extend(metrica.exponer())
+    return "\n".join(lineas) + "\n"
+
+
+async def _atender(lector, escritor):
+    try:
+        peticion = await asyncio.wait_for(lector.readuntil(b"\r\n\r\n"), timeout=5)
+        ruta = peticion.split(b" ", 2)[1] if peticion.count(b" ") >= 2 else b""
+        if ruta.split(b"?")[0] == b"/metrics":
+            # Se genera fuera del bucle: con muchas etiquetas puede tardar unos milisegundos
+            cuerpo = (await asyncio.to_thread(exponer)).encode()
+            estado, tipo = "200 OK", "text/plain; version=0.0.4; charset=utf-8"
+        else:
+            cuerpo, estado, tipo = b"Use /metrics\n", "404 Not Found", "text/plain; charset=utf-8"
+        escritor.write(
+            f"HTTP/1.1 {estado}\r\nContent-Type: {tipo}\r\nContent-Length: {len(cuerpo)}\r\nConnection: close\r\n\r\n".encode()
+            + cuerpo
+        )
+        await escritor.drain()
+    except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+        pass
+    finally:
+        escritor.close()
+
+
+async def servir(puerto, host="127.0.0.1"):
+    # Servidor HTTP mínimo en el bucle del bot: GET /metrics
+    return await asyncio.start_server(_atender, host, puerto)
@@ -0,0 +1,112 @@
+# --- PERFILADOR POR MUESTREO ---
+# Para ver en qué gasta el tiempo el bot con el tráfico real, sin reiniciarlo: mientras está encendido,
+# un hilo toma cada 'intervalo' segundos la pila del hilo del bucle de eventos y de los hilos de
+# asyncio.to_thread (sys._current_frames()) y cuenta cuántas veces aparece cada pila.
+# Apagado no hay hilo ni gancho alguno: no cuesta nada.
+#   * Las muestras en las que el hilo solo espera (el bucle en select(), un hilo de to_thread sin trabajo)
+#     se cuentan como ociosas y no entran en las pilas.
+#   * pilas_colapsadas() da el formato "marco;marco;marco cuenta" de flamegraph.pl / speedscope / inferno.
+#   * funciones_principales() ordena las funciones por tiempo acumulado (muestras en las que están en la
+#     pila, en cualquier nivel) y da también el tiempo propio (muestras en las que son la más interna).
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+# (archivo, función) más internos de un hilo que está esperando trabajo
+OCIOSOS = {("selectors.py", "select"), ("thread.py", "_worker"), ("threading.py", "wait")}
+
+
+def _marco(codigo):
+    return f"{os.path.basename(codigo.co_filename)}:{codigo.co_name}"
+
+
+class PerfiladorMuestreo:
+
+    def __init__(self, intervalo=0.01):
+        self.intervalo = intervalo
+        self.pilas = Counter()  # "hilo;marco;...;marco" -> muestras
+        self.muestras = 0
+        self.ociosas = 0
+        self.inicio = None
+        self.fin = None
+        self._hilo_bucle = None
+        self._hilo = None
+        self._parar = threading.Event()
+
+    @property
+    def activo(self):
+        return self._hilo is not None and self._hilo.is_alive()
+
+    def iniciar(self, duracion, hilo_bucle=None):
+        # Empieza una muestra nueva que se apaga sola a los 'duracion' segundos
+        self.detener()
+        self.pilas = Counter()
+        self.muestras = self.ociosas = 0
+        self.inicio, self.fin = time.time(), None
+        self._hilo_bucle = hilo_bucle if hilo_bucle is not None else threading.get_ident()
+        self._parar.clear()
+        self._hilo = threading.Thread(target=self._muestrear, args=(time.monotonic() + duracion,), name="perfilador", daemon=True)
+        self._hilo.start()
+
+    def detener(self):
+        if self._hilo is not None:
+            self._parar.set()
+            self._hilo.join()
+            self._hilo = None
+
+    def _hilos_vigilados(self):
+        # El bucle de eventos y los trabajadores de asyncio.to_thread (se llaman "asyncio_N")
+        nombres = {hilo.ident: hilo.name for hilo in threading.enumerate()}
+        vigilados = {self._hilo_bucle: "bucle"}
+        for ident, nombre in nombres.items():
+            if nombre.startswith("asyncio_"):
+                vigilados[ident] = "to_thread"
+        return vigilados
+
+    def _muestrear(self, limite):
+        vigilados = self._hilos_vigilados()
+        ultima_revision = time.monotonic()
+        while not self._parar.wait(self.intervalo):
+            ahora = time.monotonic()
+            if ahora >= limite:
+                break
+            if ahora - ultima_revision > 1:
+                # Los trabajadores de to_thread se crean según hacen falta
+                vigilados, ultima_revision = self._hilos_vigilados(), ahora
+            marcos = sys._current_frames()
+            for ident, nombre in vigilados.items():
+                marco = marcos.get(ident)
+                if marco is None:
+                    continue
+                codigo = marco.f_code
+                if (os.path.basename(codigo.co_filename), codigo.co_name) in OCIOSOS:
+                    self.ociosas += 1
+                    continue
+                pila = []
+                while marco is not None:
+                    pila.append(_marco(marco.f_code))
+                    marco = marco.f_back
+                pila.append(nombre)
+                self.pilas[";".join(reversed(pila))] += 1
+                self.muestras += 1
+            del marcos
+        self.fin = time.time()
+
+    def _copia(self):
+        # dict.copy es atómico: se puede consultar mientras el hilo sigue muestreando
+        return Counter(dict.copy(self.pilas))
+
+    def pilas_colapsadas(self):
+        return "".join(f"{pila} {cuenta}\n" for pila, cuenta in self._copia().most_common())
+
+    def funciones_principales(self, cuantas=15):
+        # [(función, muestras acumuladas, muestras propias)] de más a menos tiempo acumulado
+        acumulado, propio = Counter(), Counter()
+        for pila, cuenta in self._copia().items():
+            marcos = pila.split(";")[1:]
+            for marco in set(marcos):
+                acumulado[marco] += cuenta
+            propio[marcos[-1]] += cuenta
+        return [(marco, cuenta, propio[marco]) for marco, cuenta in acumulado.most_common(cuantas)]
@@ -0,0 +1,91 @@
+# --- PROCESAMIENTO CONCURRENTE DE ACTUALIZACIONES ---
+# Por defecto python-telegram-bot procesa las actualizaciones de una en una: la llamada lenta al LLM
+# de un usuario retrasa a todos. Este procesador atiende a varios usuarios a la vez, pero mantiene
+# en orden las actualizaciones de un mismo usuario (su /agendar termina antes de que empiece su /agenda).
+#   * Un cerrojo por usuario (o por chat si no hay usuario), creado al vuelo y borrado cuando nadie lo espera.
+#   * Un semáforo propio con el número de trabajadores, que se toma DESPUÉS del cerrojo: las actualizaciones
+#     que esperan turno detrás de otra del mismo usuario no ocupan un trabajador.
+# El semáforo de BaseUpdateProcessor (max_pendientes) solo limita cuántas actualizaciones hay en vuelo en total.
+# al_recibir(update) se llama nada más llegar cada actualización, antes de esperar el turno de su usuario
+# (por ejemplo, para cancelar lo que se le esté generando y que el mensaje nuevo deja obsoleto).
+# clasificar(update) da la etiqueta "tipo" de las métricas (el comando, "mensaje", "boton"...).
+# Cada actualización abre su traza (si sale en el muestreo), con la espera de turno y el handler como tramos.
+import asyncio
+import time
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+import metricas
+import trazas
+
+DURACION = metricas.histograma("actualizacion_segundos", "Tiempo de proceso de cada actualización (handlers)", ["tipo"])
+ESPERA = metricas.histograma("actualizacion_espera_segundos", "Tiempo que cada actualización espera su turno", ["tipo"])
+
+
+class ProcesadorPorUsuario(BaseUpdateProcessor):
+
+    def __init__(self, trabajadores=8, max_pendientes=1024, al_recibir=None, clasificar=None):
+        super().__init__(max_pendientes)
+        self.trabajadores = trabajadores
+        self.al_recibir = al_recibir
+        self.clasificar = clasificar or (lambda update: "actualizacion")
+        self._trabajadores = asyncio.Semaphore(trabajadores)
+        self._cerrojos = {}  # clave -> [cerrojo, actualizaciones que lo usan o esperan]
+
+    @staticmethod
+    def _clave(update):
+        if isinstance(update, Update):
+            if update.effective_user:
+                return ("usuario", update.effective_user.id)
+            if update.effective_chat:
+                return ("chat", update.effective_chat.id)
+        return None
+
+    async def _procesar(self, tipo, llegada, coroutine):
+        # Ya con trabajador: lo esperado hasta aquí es cola; lo que sigue, el handler
+        inicio = time.perf_counter()
+        ESPERA.observar(inicio - llegada, tipo)
+        trazas.tramo_desde(llegada, "espera_turno", "dispatch")
+        try:
+            with trazas.tramo("handler", "dispatch"):
+                await coroutine
+        finally:
+            DURACION.observar(time.perf_counter() - inicio, tipo)
+
+    async def do_process_update(self, update, coroutine):
+        llegada = time.perf_counter()
+        if self.al_recibir:
+            self.al_recibir(update)
+        tipo = self.clasificar(update)
+        clave = self._clave(update)
+        with trazas.traza(tipo, desde=llegada, usuario=clave[1] if clave else ""):
+            await self._en_turno(clave, tipo, llegada, coroutine)
+
+    async def _en_turno(self, clave, tipo, llegada, coroutine):
+        if clave is None:
+            async with self._trabajadores:
+                await self._procesar(tipo, llegada, coroutine)
+            return
+
+        entrada = self._cerrojos.setdefault(clave, [asyncio.Lock(), 0])
+        entrada[1] += 1
+        try:
+            # asyncio.Lock atiende por orden de llegada: se respeta el orden de las actualizaciones
+            async with entrada[0]:
+                async with self._trabajadores:
+                    await self._procesar(tipo, llegada, coroutine)
+        finally:
+            entrada[1] -= 1
+            if not entrada[1]:
+                del self._cerrojos[clave]
+
+    @property
+    def usuarios_activos(self):
+        return len(self._cerrojos)
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
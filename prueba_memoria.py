@@ -0,0 +1,248 @@
+# --- PRUEBA DE RESISTENCIA DE MEMORIA ---
+# Mueve el bot entero (handlers, procesador de actualizaciones, cola de salida, cola de escritura,
+# recordatorios...) en este mismo proceso con tráfico sintético durante horas y sin red: a las peticiones
+# a Telegram contesta un cliente falso y a las de Ollama, un servidor falso local.
+# Mide la memoria residente (RSS) y falla si, pasado el calentamiento, sigue subiendo. Con tracemalloc
+# activo se mide la memoria que reserva el bot (sin la del propio tracemalloc, que sí crece).
+#   python prueba_memoria.py [minutos] [mensajes_por_segundo] [crecimiento_max_mb] [usuarios]
+# Por defecto 120 minutos, 10 mensajes/s, 5 MB y 200 usuarios a la vez. Con MEMORIA_TRACEMALLOC=25 muestra
+# además las líneas de código cuya memoria más ha crecido desde el final del calentamiento.
+# Cada usuario recorre el guion una vez (agendar, consultar, buscar, chat libre... y /limpiar, así que
+# sus citas no se quedan) y deja su sitio a un usuario nuevo: las estructuras que guardan algo por usuario
+# y no lo olvidan nunca crecen durante toda la prueba. Siempre hay 'usuarios' a la vez.
+import asyncio
+import contextlib
+import itertools
+import json
+import logging
+import os
+import statistics
+import sys
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+
+# Antes de importar main: sin disco, sin Ollama real y sin límites de envío (Telegram no interviene)
+PUERTO_OLLAMA = 18734
+os.environ["ALMACENAMIENTO"] = "memoria"
+os.environ["OLLAMA_URL"] = f"http://127.0.0.1:{PUERTO_OLLAMA}/api/generate"
+os.environ["SALIDA_POR_SEGUNDO"] = "1000"
+os.environ["METRICAS_PUERTO"] = "0"
+os.environ["TRAZAS_MUESTREO"] = "0"
+os.environ["MEMORIA_INTERVALO_MINUTOS"] = "0"
+
+from telegram import Update
+from telegram.request import BaseRequest
+
+import main
+from memoria import formatear_bytes, memoria_trazada, rss_actual
+
+MINUTOS = float(sys.argv[1]) if len(sys.argv) > 1 else 120
+POR_SEGUNDO = float(sys.argv[2]) if len(sys.argv) > 2 else 10
+CRECIMIENTO_MAX = float(sys.argv[3]) if len(sys.argv) > 3 else 5
+USUARIOS = int(sys.argv[4]) if len(sys.argv) > 4 else 200
+MUESTRAS = 60
+
+MANANA = (datetime.now() + timedelta(days=1)).strftime("%Y-%m-%d")
+GUION = [
+    "/agendar Reunión de seguimiento {n} mañana 10am durante 30 min",
+    "/agendar Llamada con proveedor {n} mañana 16:00",
+    "/agenda semana",
+    "/buscar reunión",
+    "¿Cómo puedo organizar mejor mi semana?",
+    "/hueco 30 min",
+    "/cita " + MANANA,
+    "/historial",
+    "/limpiar",
+]
+
+
+# Lo que no cuenta al principio (cachés llenándose, hilos creándose, primeras conexiones...): el 20 % de la
+# prueba y, como poco, lo que tardan todos los usuarios en recorrer el guion una vez
+CALENTAMIENTO = max(0.2 * MINUTOS * 60, USUARIOS * len(GUION) / POR_SEGUNDO)
+
+
+class TelegramFalso(BaseRequest):
+    # Contesta a la API de Telegram como si todo hubiera ido bien
+
+    def __init__(self):
+        self.peticiones = Counter()
+        self._mensajes = itertools.count(1)
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None):
+        metodo = url.rsplit("/", 1)[-1]
+        self.peticiones[metodo] += 1
+        parametros = request_data.parameters if request_data else {}
+        if metodo == "getMe":
+            resultado = {"id": 1, "is_bot": True, "first_name": "MeetManager", "username": "meetmanager_prueba_bot"}
+        elif "chat_id" in parametros and metodo.startswith(("send", "edit")):
+            resultado = {
+                "message_id": next(self._mensajes),
+                "date": int(time.time()),
+                "chat": {"id": int(parametros["chat_id"]), "type": "private"},
+                "text": str(parametros.get("text", "")),
+            }
+        else:
+            resultado = True
+        return 200, json.dumps({"ok": True, "result": resultado}).encode()
+
+
+async def ollama_falso(lector, escritor):
+    # Respuesta en streaming (NDJSON por trozos), como /api/generate
+    try:
+        cabecera = await lector.readuntil(b"\r\n\r\n")
+        longitud = next(int(linea.split(b":")[1]) for linea in cabecera.split(b"\r\n") if linea.lower().startswith(b"content-length"))
+        await lector.readexactly(longitud)
+        escritor.write(b"HTTP/1.1 200 OK\r\nContent-Type: application/x-ndjson\r\nTransfer-Encoding: chunked\r\n\r\n")
+        for i in range(5):
+            linea = (json.dumps({"response": f"Respuesta {i}. ", "done": i == 4}) + "\n").encode()
+            escritor.write(b"%x\r\n%s\r\n" % (len(linea), linea))
+            await escritor.drain()
+            await asyncio.sleep(0.02)
+        escritor.write(b"0\r\n\r\n")
+        await escritor.drain()
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        escritor.close()
+
+
+def actualizacion(update_id, user_id, texto):
+    entidades = [{"type": "bot_command", "offset": 0, "length": len(texto.split()[0])}] if texto.startswith("/") else []
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private", "first_name": "Prueba"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "Prueba", "username": f"prueba{user_id}"},
+            "text": texto,
+            "entities": entidades,
+        },
+    }
+
+
+def informar(texto):
+    # Por stderr: la salida estándar (los print de main.py en cada consulta al LLM) se descarta
+    print(texto, file=sys.stderr, flush=True)
+
+
+def medir():
+    trazada = memoria_trazada()
+    return rss_actual() if trazada is None else trazada
+
+
+async def pendientes(application):
+    return application.update_queue.qsize() + main.PROCESADOR.current_concurrent_updates
+
+
+async def generar_trafico(application, fin, muestras):
+    nuevos = itertools.count(100001)
+    activos = [next(nuevos) for _ in range(USUARIOS)]
+    pasos = {}  # user_id -> posición en el guion, solo de los usuarios activos
+    enviados = 0
+    usuarios_totales = USUARIOS
+    ids = itertools.count(1)
+    intervalo_muestra = (fin - time.monotonic()) / MUESTRAS
+    siguiente_muestra = time.monotonic()
+    siguiente = time.monotonic()
+    turnos = itertools.cycle(range(USUARIOS))
+    nombre_medida = "RSS" if memoria_trazada() is None else "tracemalloc"
+    calentando = True
+    inicio = time.monotonic()
+    while time.monotonic() < fin:
+        ahora = time.monotonic()
+        if ahora >= siguiente_muestra:
+            medida = medir()
+            muestras.append((ahora - inicio, medida))
+            informar(
+                f"{(ahora - inicio) / 60:7.1f} min  {nombre_medida} {formatear_bytes(medida):>9}  "
+                f"{enviados} mensajes  {usuarios_totales} usuarios  {await pendientes(application)} pendientes"
+            )
+            if calentando and ahora - inicio >= CALENTAMIENTO:
+                # Fin del calentamiento: la foto de tracemalloc (si está activo) de referencia
+                calentando = False
+                await asyncio.to_thread(main.MEMORIA.tomar_muestra)
+            siguiente_muestra += intervalo_muestra
+        turno = next(turnos)
+        user_id = activos[turno]
+        paso = pasos.pop(user_id, 0)
+        if paso + 1 < len(GUION):
+            pasos[user_id] = paso + 1
+        else:
+            activos[turno] = next(nuevos)
+            usuarios_totales += 1
+        texto = GUION[paso].format(n=paso)
+        enviados += 1
+        await application.update_queue.put(Update.de_json(actualizacion(next(ids), user_id, texto), application.bot))
+        siguiente += 1 / POR_SEGUNDO
+        await asyncio.sleep(max(0.0, siguiente - time.monotonic()))
+    return enviados
+
+
+async def probar():
+    servidor = await asyncio.start_server(ollama_falso, "127.0.0.1", PUERTO_OLLAMA)
+    telegram = TelegramFalso()
+    main.REPO.inicializar()
+    application = main.crear_aplicacion("123456:PRUEBA", peticiones=telegram)
+    await application.initialize()
+    await application.start()
+    await main.al_iniciar(application)
+
+    muestras = []
+    informar(f"Prueba de memoria: {MINUTOS:g} min, {POR_SEGUNDO:g} mensajes/s, {USUARIOS} usuarios")
+    enviados = await generar_trafico(application, time.monotonic() + MINUTOS * 60, muestras)
+    while await pendientes(application):
+        await asyncio.sleep(0.1)
+
+    estructuras = main.MEMORIA.tamanos()
+    await asyncio.to_thread(main.MEMORIA.tomar_muestra)
+    await application.stop()
+    await main.cerrar_escrituras(application)
+    await application.shutdown()
+    servidor.close()
+    return enviados, telegram.peticiones, muestras, estructuras
+
+
+def comprobar(enviados, peticiones, muestras, estructuras):
+    informar(f"\n{enviados} mensajes procesados; peticiones a Telegram: {dict(peticiones.most_common())}")
+    informar("Estructuras globales: " + ", ".join(f"{nombre} {tamano}" for nombre, tamano in estructuras.items()))
+    errores = main.ERRORES.exponer()[2:]
+    if errores:
+        informar("Excepciones en handlers: " + "; ".join(errores))
+    for sitio, tamano, bloques in main.MEMORIA.desde_arranque:
+        informar(f"  {formatear_bytes(tamano):>10}  {sitio} ({bloques:+d} bloques)")
+
+    # Mediana del primer y del último cuarto tras el calentamiento: el ruido de una muestra no cuenta
+    medidas = [(momento, medida) for momento, medida in muestras if momento >= CALENTAMIENTO]
+    if len(medidas) < 8:
+        informar(f"❌ Muy pocas muestras tras el calentamiento ({CALENTAMIENTO / 60:.1f} min): alargue la prueba.")
+        return False
+    cuarto = len(medidas) // 4
+    crecimiento = statistics.median(m for _, m in medidas[-cuarto:]) - statistics.median(m for _, m in medidas[:cuarto])
+    minutos = (medidas[-1][0] - medidas[0][0]) / 60
+    informar(f"Crecimiento tras el calentamiento: {formatear_bytes(crecimiento)} en {minutos:.0f} min "
+             f"(máximo permitido {CRECIMIENTO_MAX:g} MB)")
+    if crecimiento > CRECIMIENTO_MAX * 1024 * 1024:
+        informar("❌ La memoria no se mantiene estable.")
+        return False
+    informar("✅ Memoria estable.")
+    return True
+
+
+if __name__ == "__main__":
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    with open(os.devnull, "w") as nulo, contextlib.redirect_stdout(nulo):
+        resultado = asyncio.run(probar())
+    sys.exit(0 if comprobar(*resultado) else 1)
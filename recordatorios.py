@@ -0,0 +1,102 @@
+# --- RECORDATORIOS ---
+# Montículo (heapq) con los avisos de las citas que empiezan en la ventana cargada [ahora, horizonte).
+# Solo se consulta la base de datos por rangos de fecha (índice por fecha y hora):
+#   * al avanzar el horizonte se carga el siguiente tramo de citas;
+#   * cuando cambia la agenda de un usuario se recargan solo sus citas de la ventana.
+# Las entradas antiguas no se buscan ni se borran del montículo: cada usuario tiene un número de
+# versión y al sacar una entrada con versión vieja simplemente se descarta (invalidación perezosa).
+import heapq
+import itertools
+import logging
+from datetime import datetime, timedelta
+
+from almacenamiento import expandir_regla
+
+logger = logging.getLogger(__name__)
+
+
+class PlanificadorRecordatorios:
+
+    def __init__(self, repo, minutos=15, ventana=timedelta(hours=24)):
+        self.repo = repo
+        self.antelacion = timedelta(minutes=minutos)
+        self.ventana = ventana
+        self.horizonte = None   # avisos anteriores a este momento ya están en el montículo
+        self._monticulo = []    # (aviso, secuencia, user_id, version, fila)
+        self._secuencia = itertools.count()
+        self._versiones = {}    # user_id -> versión vigente de sus entradas
+        self._vivas = {}        # user_id -> entradas vigentes en el montículo
+        self._descartables = 0  # entradas con versión vieja que siguen en el montículo
+
+    def __len__(self):
+        return len(self._monticulo) - self._descartables
+
+    def _agregar(self, user_id, fila, ahora):
+        inicio = datetime.strptime(f"{fila[1]} {fila[2]}", "%Y-%m-%d %H:%M")
+        aviso = inicio - self.antelacion
+        # Los avisos que ya pasaron no se envían (por ejemplo, tras un reinicio)
+        if ahora < aviso < self.horizonte:
+            version = self._versiones.get(user_id, 0)
+            heapq.heappush(self._monticulo, (aviso, next(self._secuencia), user_id, version, fila))
+            self._vivas[user_id] = self._vivas.get(user_id, 0) + 1
+
+    def cargar_ventana(self, ahora):
+        # Carga los avisos de [horizonte, ahora + ventana): las citas que empiezan antelación minutos después
+        desde = max(self.horizonte or ahora, ahora)
+        self.horizonte = ahora + self.ventana
+        if desde >= self.horizonte:
+            return
+        for user_id, *fila in self.repo.citas_que_empiezan(desde + self.antelacion, self.horizonte + self.antelacion):
+            self._agregar(user_id, tuple(fila), ahora)
+
+        # Ocurrencias de citas recurrentes del mismo tramo
+        fecha_ini = (desde + self.antelacion).strftime("%Y-%m-%d")
+        fecha_fin = (self.horizonte + self.antelacion).strftime("%Y-%m-%d")
+        for user_id, regla in self.repo.recurrencias_vigentes(fecha_ini):
+            for fila in expandir_regla(regla, fecha_ini, fecha_fin):
+                inicio = datetime.strptime(f"{fila[1]} {fila[2]}", "%Y-%m-%d %H:%M")
+                if desde <= inicio - self.antelacion:
+                    self._agregar(user_id, fila, ahora)
+
+    def usuario_cambiado(self, user_id, ahora):
+        # Invalida todas las entradas del usuario y vuelve a cargar solo sus citas de la ventana
+        if self.horizonte is None:
+            return
+        self._versiones[user_id] = self._versiones.get(user_id, 0) + 1
+        self._descartables += self._vivas.pop(user_id, 0)
+        fecha_ini = (ahora + self.antelacion).strftime("%Y-%m-%d")
+        fecha_fin = (self.horizonte + self.antelacion).strftime("%Y-%m-%d")
+        for fila in self.repo.agenda(user_id, fecha_ini, fecha_fin):
+            self._agregar(user_id, fila, ahora)
+
+        # Si la mayoría de entradas están caducadas, reconstruimos el montículo (coste amortizado)
+        if self._descartables > 1000 and self._descartables * 2 > len(self._monticulo):
+            self._monticulo = [e for e in self._monticulo if e[3] == self._versiones.get(e[2], 0)]
+            heapq.heapify(self._monticulo)
+            self._descartables = 0
+
+    def _limpiar_cima(self):
+        while self._monticulo:
+            _, _, user_id, version, _ = self._monticulo[0]
+            if version == self._versiones.get(user_id, 0):
+                return
+            heapq.heappop(self._monticulo)
+            self._descartables -= 1
+
+    def vencidos(self, ahora):
+        # Saca del montículo los avisos con hora <= ahora: lista de (user_id, fila)
+        avisos = []
+        self._limpiar_cima()
+        while self._monticulo and self._monticulo[0][0] <= ahora:
+            _, _, user_id, _, fila = heapq.heappop(self._monticulo)
+            self._vivas[user_id] -= 1
+            avisos.append((user_id, fila))
+            self._limpiar_cima()
+        return avisos
+
+    def siguiente(self):
+        # Momento en que hay que volver a mirar: el próximo aviso o el final de la ventana cargada
+        self._limpiar_cima()
+        if self._monticulo:
+            return min(self._monticulo[0][0], self.horizonte)
+        return self.horizonte
@@ -0,0 +1,202 @@
+# --- TRAZAS ---
+# Para saber en qué se fueron los 8 segundos de un /agendar: cada actualización muestreada abre una traza
+# y las partes por las que pasa (espera de turno, handler, extracción de datos, cada operación del
+# repositorio, cola y generación del LLM, envíos a Telegram...) abren tramos hijos dentro de ella.
+#   with trazas.tramo("extraer_datos_cita"):
+#       datos = await asyncio.to_thread(extraer_datos_cita, texto)
+# La traza en curso viaja en una contextvar: llega sola a las tareas y a asyncio.to_thread. Fuera de una
+# traza (o si la actualización no salió en el muestreo) tramo() no hace nada y apenas cuesta.
+# Las trazas terminadas se escriben en un hilo aparte en el formato Trace Event de Chrome, un evento por
+# línea: el archivo se abre tal cual en https://ui.perfetto.dev o chrome://tracing (la primera línea es
+# "[" y cada evento acaba en coma; el formato admite que falte el "]" final). Cada traza ocupa su propia fila.
+import contextvars
+import functools
+import inspect
+import itertools
+import json
+import logging
+import os
+import queue
+import random
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+TRAZA_ACTUAL = contextvars.ContextVar("traza_actual", default=None)
+CONFIGURACION = {"muestreo": 0.0, "archivo": None}
+_IDS = itertools.count(1)
+_PENDIENTES = queue.SimpleQueue()
+_ESCRITOR = {"hilo": None}
+
+
+class _Nada:
+    # Tramo vacío para cuando no se traza
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    def anotar(self, **atributos):
+        pass
+
+
+NADA = _Nada()
+
+
+class Traza:
+
+    def __init__(self, nombre):
+        self.id = next(_IDS)
+        self.nombre = nombre
+        self.eventos = []  # list.append es atómico: los tramos pueden cerrarse desde otros hilos
+
+
+class Tramo:
+
+    def __init__(self, traza, nombre, categoria, atributos):
+        self.traza = traza
+        self.nombre = nombre
+        self.categoria = categoria
+        self.atributos = atributos
+
+    def anotar(self, **atributos):
+        self.atributos.update(atributos)
+
+    def _empezar(self, inicio=None):
+        # 'inicio' (time.perf_counter()) permite empezar el tramo en un momento ya pasado
+        ahora = time.perf_counter()
+        self.inicio = ahora if inicio is None else inicio
+        self.marca = time.time_ns() // 1000 - round((ahora - self.inicio) * 1_000_000)
+
+    def __enter__(self):
+        self._empezar()
+        return self
+
+    def __exit__(self, tipo, error, _traza):
+        duracion = time.perf_counter() - self.inicio
+        if tipo is not None:
+            self.atributos["error"] = tipo.__name__
+        self.traza.eventos.append({
+            "name": self.nombre, "cat": self.categoria, "ph": "X",
+            "ts": self.marca, "dur": round(duracion * 1_000_000),
+            "pid": os.getpid(), "tid": self.traza.id,
+            "args": {clave: str(valor) for clave, valor in self.atributos.items()},
+        })
+        return False
+
+    async def __aenter__(self):
+        return self.__enter__()
+
+    async def __aexit__(self, *exc):
+        return self.__exit__(*exc)
+
+
+class _Raiz(Tramo):
+    # El tramo de la actualización entera: publica la traza en la contextvar y la entrega al escritor al cerrar
+
+    def __init__(self, traza, nombre, categoria, atributos, desde=None):
+        super().__init__(traza, nombre, categoria, atributos)
+        self.desde = desde
+
+    def __enter__(self):
+        self._ficha = TRAZA_ACTUAL.set(self.traza)
+        self._empezar(self.desde)
+        return self
+
+    def __exit__(self, *exc):
+        super().__exit__(*exc)
+        TRAZA_ACTUAL.reset(self._ficha)
+        _PENDIENTES.put(self.traza)
+        return False
+
+
+def configurar(muestreo, archivo):
+    # muestreo: fracción de actualizaciones que se trazan (0 desactiva, 1 todas)
+    CONFIGURACION["muestreo"] = muestreo
+    CONFIGURACION["archivo"] = archivo
+    if muestreo > 0 and _ESCRITOR["hilo"] is None:
+        _ESCRITOR["hilo"] = threading.Thread(target=_escribir, name="trazas", daemon=True)
+        _ESCRITOR["hilo"].start()
+
+
+def traza(nombre, categoria="actualizacion", desde=None, **atributos):
+    # Abre una traza nueva si sale en el muestreo (y no hay ya una en curso); 'desde' como en tramo_desde
+    muestreo = CONFIGURACION["muestreo"]
+    if not muestreo or TRAZA_ACTUAL.get() is not None or random.random() >= muestreo:
+        return NADA
+    return _Raiz(Traza(nombre), nombre, categoria, atributos, desde)
+
+
+def tramo(nombre, categoria="bot", **atributos):
+    traza_actual = TRAZA_ACTUAL.get()
+    if traza_actual is None:
+        return NADA
+    return Tramo(traza_actual, nombre, categoria, atributos)
+
+
+def tramo_desde(inicio, nombre, categoria="bot", **atributos):
+    # Registra un tramo que ya ha terminado: desde 'inicio' (time.perf_counter()) hasta ahora
+    traza_actual = TRAZA_ACTUAL.get()
+    if traza_actual is None:
+        return
+    terminado = Tramo(traza_actual, nombre, categoria, atributos)
+    terminado._empezar(inicio)
+    terminado.__exit__(None, None, None)
+
+
+def instrumentar(objeto, nombres, categoria):
+    # Como metricas.instrumentar: cada método de 'nombres' abre un tramo con su nombre (los generadores no)
+    for nombre in nombres:
+        metodo = getattr(objeto, nombre)
+        if inspect.isgeneratorfunction(metodo):
+            continue
+
+        @functools.wraps(metodo)
+        def trazado(*args, _metodo=metodo, _nombre=nombre, **kwargs):
+            if TRAZA_ACTUAL.get() is None:
+                return _metodo(*args, **kwargs)
+            with tramo(_nombre, categoria):
+                return _metodo(*args, **kwargs)
+
+        setattr(objeto, nombre, trazado)
+
+
+def _escribir():
+    archivo = None
+    while True:
+        traza_terminada = _PENDIENTES.get()
+        if traza_terminada is None:
+            break
+        try:
+            if archivo is None:
+                nuevo = not os.path.exists(CONFIGURACION["archivo"]) or not os.path.getsize(CONFIGURACION["archivo"])
+                archivo = open(CONFIGURACION["archivo"], "a", encoding="utf-8")
+                if nuevo:
+                    archivo.write("[\n")
+            # Un evento de metadatos pone nombre a la fila de la traza
+            eventos = [{"name": "thread_name", "ph": "M", "pid": os.getpid(), "tid": traza_terminada.id,
+                        "args": {"name": f"{traza_terminada.nombre} #{traza_terminada.id}"}}]
+            eventos += sorted(traza_terminada.eventos, key=lambda evento: (evento["ts"], -evento["dur"]))
+            archivo.write("".join(json.dumps(evento, ensure_ascii=False) + ",\n" for evento in eventos))
+            archivo.flush()
+        except OSError as e:
+            logger.warning(f"No se pudo escribir la traza en {CONFIGURACION['archivo']}: {e}")
+    if archivo:
+        archivo.close()
+
+
+def detener():
+    # Escribe las trazas que queden y para el escritor
+    if _ESCRITOR["hilo"] is not None:
+        _PENDIENTES.put(None)
+        _ESCRITOR["hilo"].join(timeout=5)
+        _ESCRITOR["hilo"] = None
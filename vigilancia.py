@@ -0,0 +1,122 @@
+# --- VIGILANCIA DEL BUCLE DE EVENTOS ---
+# Una llamada bloqueante dentro de un handler (requests, sqlite3, dateparser...) para a todo el bot.
+# Este vigilante lo detecta mientras ocurre:
+#   * En el bucle, un latido cada 'intervalo' segundos que anota la hora y mide cuánto tarda en despertar
+#     (el retraso del bucle, que va a un histograma).
+#   * En un hilo aparte, si el último latido tiene más de 'umbral' segundos, el bucle está bloqueado:
+#     se captura la pila del hilo del bucle con sys._current_frames() y se anota el sitio de nuestro
+#     código más interno que aparece en ella (archivo:línea función).
+# Al terminar cada bloqueo se registra en el log con su duración y la pila, y se cuenta por sitio
+# (métrica bloqueos_total{sitio}) para ver qué cambio ha vuelto a meter E/S síncrona.
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import Counter
+
+import metricas
+
+logger = logging.getLogger(__name__)
+
+RETRASO = metricas.histograma(
+    "bucle_retraso_segundos", "Retraso del bucle de eventos en despertar un latido",
+    cubetas=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+)
+BLOQUEOS = metricas.contador("bucle_bloqueos_total", "Bloqueos del bucle de eventos por encima del umbral, por sitio", ["sitio"])
+CARPETA_PROYECTO = os.path.dirname(os.path.abspath(__file__))
+
+
+def _es_nuestro(archivo):
+    archivo = os.path.abspath(archivo)
+    return archivo.startswith(CARPETA_PROYECTO) and "site-packages" not in archivo and os.sep + "venv" + os.sep not in archivo
+
+
+def sitio_de(pila):
+    # El marco más interno de nuestro código (es el que ha hecho la llamada bloqueante); si no hay, el más interno
+    for marco in reversed(pila):
+        if _es_nuestro(marco.filename):
+            return f"{os.path.basename(marco.filename)}:{marco.lineno} {marco.name}"
+    marco = pila[-1]
+    return f"{os.path.basename(marco.filename)}:{marco.lineno} {marco.name}"
+
+
+class VigilanteBucle:
+
+    def __init__(self, umbral=0.25, intervalo=0.05):
+        self.umbral = umbral
+        self.intervalo = intervalo
+        self.bloqueos = 0
+        self.sitios = Counter()  # sitio -> bloqueos
+        self.peor = None         # (segundos, sitio) del bloqueo más largo
+        self._latido = time.monotonic()
+        self._hilo_bucle = None
+        self._tarea = None
+        self._hilo = None
+        self._parar = threading.Event()
+
+    async def _latir(self):
+        while True:
+            inicio = time.monotonic()
+            self._latido = inicio
+            await asyncio.sleep(self.intervalo)
+            RETRASO.observar(max(0.0, time.monotonic() - inicio - self.intervalo))
+
+    def iniciar(self):
+        # Hay que llamarlo desde el bucle de eventos que se quiere vigilar
+        self._hilo_bucle = threading.get_ident()
+        self._latido = time.monotonic()
+        self._tarea = asyncio.get_running_loop().create_task(self._latir())
+        self._parar.clear()
+        self._hilo = threading.Thread(target=self._vigilar, name="vigilante-bucle", daemon=True)
+        self._hilo.start()
+
+    async def detener(self):
+        if self._tarea:
+            self._tarea.cancel()
+            try:
+                await self._tarea
+            except asyncio.CancelledError:
+                pass
+            self._tarea = None
+        self._parar.set()
+        if self._hilo:
+            self._hilo.join(timeout=1)
+            self._hilo = None
+        if self.sitios:
+            resumen = ", ".join(f"{sitio} ({veces})" for sitio, veces in self.sitios.most_common(5))
+            logger.warning(f"Sitios que han bloqueado el bucle de eventos: {resumen}")
+
+    def _vigilar(self):
+        bloqueo = None  # (latido en el que se quedó parado, sitio, pila)
+        while not self._parar.wait(self.intervalo):
+            latido = self._latido
+            if bloqueo is None:
+                if time.monotonic() - latido > self.umbral:
+                    marco = sys._current_frames().get(self._hilo_bucle)
+                    if marco is None:
+                        continue
+                    pila = traceback.extract_stack(marco)
+                    bloqueo = (latido, sitio_de(pila), pila)
+            elif latido != bloqueo[0]:
+                # El bucle ha vuelto a latir: el bloqueo duró desde el latido anterior hasta este, menos la espera normal
+                self._registrar(latido - bloqueo[0] - self.intervalo, bloqueo[1], bloqueo[2])
+                bloqueo = None
+
+    def _registrar(self, segundos, sitio, pila):
+        self.bloqueos += 1
+        self.sitios[sitio] += 1
+        BLOQUEOS.inc(sitio)
+        if self.peor is None or segundos > self.peor[0]:
+            self.peor = (segundos, sitio)
+        logger.warning(
+            f"Bucle de eventos bloqueado {segundos * 1000:.0f} ms en {sitio}:\n" + "".join(traceback.format_list(pila))
+        )
+
+    def describir(self):
+        if not self.bloqueos:
+            return "sin bloqueos"
+        segundos, sitio = self.peor
+        return f"{self.bloqueos} bloqueos, el peor de {segundos * 1000:.0f} ms en {sitio}"